@@ -333,6 +333,12 @@ def run(command_args, prog, description):
         action="store_true",
         help="Validate model configuration against several checks",
     )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="EVAL_ID",
+        help="Resume the interrupted evaluation with outputs in the EVAL_ID subdirectory of the output directory",
+    )
 
     args = parser.parse_args(command_args)
     coloredlogs.install(level=args.log_level)
@@ -1,4 +1,9 @@
+import concurrent.futures
+import contextlib
 import logging
+import multiprocessing
+import pickle
+import sys
 import numpy as np
 import cv2
 import colour
@@ -199,64 +204,288 @@ def insert_patch(
     :param cc_scene: colorchecker values in the scene. Type ndarray.
     :param apply_realistic_effects: apply effects such as color correction, blurring, and shadowing. Type bool.
     """
+    context = PatchInsertionContext(
+        gs_coords,
+        gs_im,
+        patch.shape,
+        gs_shape,
+        cc_gt,
+        cc_scene,
+        apply_realistic_effects,
+    )
+    return context.insert(patch)
 
-    if apply_realistic_effects:
-        # calculate color matrix
-        ccm = calculate_ccm(cc_scene, cc_gt, Vandermonde=True)
 
-        # get edge coords
-        edge_coords = [
-            (gs_coords[0, 0] + 10, gs_coords[0, 1] - 20),
-            (gs_coords[0, 0] + 10, gs_coords[0, 1] + 20),
-        ]
-        edge_coords = np.array(edge_coords)
+class PatchInsertionContext:
+    """
+    The parts of insert_patch which depend only on the image and its green screen
+        metadata, and not on the patch itself
+
+    These are the color correction matrix, the homography from the patch to the
+        enlarged green screen, the warped insertion mask, and the shadow ratios from
+        the HSV values of the green screen. Building the context once per image lets
+        an attack insert a new patch at each iteration by only color correcting,
+        warping, and blending it.
 
-        # apply color matrix to patch
-        patch = apply_ccm(patch.astype("float32"), ccm)
+    :param patch_shape: shape of the patches which will be inserted, before resizing.
+    Other parameters are as for insert_patch.
+    """
+
+    def __init__(
+        self,
+        gs_coords,
+        gs_im,
+        patch_shape,
+        gs_shape,
+        cc_gt,
+        cc_scene,
+        apply_realistic_effects,
+    ):
+        self.gs_shape = gs_shape
+        self.apply_realistic_effects = apply_realistic_effects
+        h, w = patch_shape[:2]
+
+        if apply_realistic_effects:
+            # calculate color matrix
+            self.ccm = calculate_ccm(cc_scene, cc_gt, Vandermonde=True)
+
+            # size of the patch after resizing, which blurs it
+            scale = (np.amax(gs_coords[:, 1]) - np.amin(gs_coords[:, 1])) / h
+            h, w = int(h * scale), int(w * scale)
+            self.resized_size = (w, h)
+        else:
+            self.ccm = None
+            self.resized_size = None
+
+        enlarged_coords = np.copy(gs_coords)
+        pad_amt_x = int(0.03 * (enlarged_coords[2, 0] - enlarged_coords[0, 0]))
+        pad_amt_y = int(0.03 * (gs_coords[2, 1] - gs_coords[0, 1]))
+        enlarged_coords[0, 0] -= pad_amt_x
+        enlarged_coords[0, 1] -= pad_amt_y
+        enlarged_coords[1, 0] += pad_amt_x
+        enlarged_coords[1, 1] -= pad_amt_y
+        enlarged_coords[2, 0] += pad_amt_x
+        enlarged_coords[2, 1] += pad_amt_y
+        enlarged_coords[3, 0] -= pad_amt_x
+        enlarged_coords[3, 1] += pad_amt_y
+
+        # calculate homography
+        patch_coords = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+        self.homography, _ = cv2.findHomography(patch_coords, enlarged_coords)
+        self.image_size = (gs_im.shape[1], gs_im.shape[0])
 
-        # resize patch and apply blurring
-        scale = (np.amax(gs_coords[:, 1]) - np.amin(gs_coords[:, 1])) / patch.shape[0]
-        patch = cv2.resize(
-            patch, (int(patch.shape[1] * scale), int(patch.shape[0] * scale))
+        # mask to aid with insertion
+        mask = np.ones((h, w, 3))
+        mask_out = cv2.warpPerspective(
+            mask, self.homography, self.image_size, cv2.INTER_CUBIC
         )
 
-        # datatype correction
-        patch = patch * 255
-    patch = patch.astype("uint8")
-
-    # convert for use with cv2
-    patch = cv2.cvtColor(patch, cv2.COLOR_RGB2BGR)
-
-    enlarged_coords = np.copy(gs_coords)
-    pad_amt_x = int(0.03 * (enlarged_coords[2, 0] - enlarged_coords[0, 0]))
-    pad_amt_y = int(0.03 * (gs_coords[2, 1] - gs_coords[0, 1]))
-    enlarged_coords[0, 0] -= pad_amt_x
-    enlarged_coords[0, 1] -= pad_amt_y
-    enlarged_coords[1, 0] += pad_amt_x
-    enlarged_coords[1, 1] -= pad_amt_y
-    enlarged_coords[2, 0] += pad_amt_x
-    enlarged_coords[2, 1] += pad_amt_y
-    enlarged_coords[3, 0] -= pad_amt_x
-    enlarged_coords[3, 1] += pad_amt_y
-
-    # insert transformed patch
-    image_digital, image_physical = insert_transformed_patch(
-        patch, gs_im, gs_shape, image_coords=enlarged_coords
-    )
+        # image outside of the patch, onto which the warped patch is added
+        background = np.copy(gs_im)
+        background[mask_out != 0] = 0
+        self.background = background.astype("float32")
 
-    if apply_realistic_effects:
-        return image_physical
-    else:
-        return image_digital
+        if apply_realistic_effects:
+            v_avg = 0.5647  # V value (in HSV) for the green screen, which is #00903a
+
+            # mask image for patch insert
+            image_cp = np.copy(gs_im)
+            image_cp[mask_out == 0] = 0
+
+            # convert to HSV space for shadow estimation
+            target_hsv = cv2.cvtColor(image_cp, cv2.COLOR_BGR2HSV)
+            target_hsv = target_hsv.astype("float32")
+            target_hsv /= 255.0
+            self.shadow_ratios = (target_hsv[:, :, 2] / v_avg)[:, :, np.newaxis]
+        else:
+            self.shadow_ratios = None
+
+    def insert(self, patch):
+        """
+        Return the image with patch inserted, as insert_patch does
+
+        :param patch: adversarial patch, with shape patch_shape. Type ndarray
+        """
+        if self.apply_realistic_effects:
+            # apply color matrix to patch
+            patch = apply_ccm(patch.astype("float32"), self.ccm)
+
+            # resize patch and apply blurring
+            patch = cv2.resize(patch, self.resized_size)
+
+            # datatype correction
+            patch = patch * 255
+        patch = patch.astype("uint8")
+
+        # convert for use with cv2
+        patch = cv2.cvtColor(patch, cv2.COLOR_RGB2BGR)
+
+        # warp patch to destination coordinates
+        im_out = cv2.warpPerspective(
+            patch, self.homography, self.image_size, cv2.INTER_CUBIC
+        )
+        im_out = im_out.astype("float32")
+
+        if self.apply_realistic_effects:
+            # apply shadows to patch
+            im_out *= self.shadow_ratios
+            np.minimum(im_out, 255.0, out=im_out)
+
+        return self.background + im_out
+
+
+class ImagePatchContext:
+    """
+    The state of the patch attack on one image: the shape of its patch, its green
+        screen, occlusion mask, and colorchecker metadata, and everything derived
+        from them which does not change as the patch is optimized
+
+    :param x: Sample image. Shape=(HW3) or (HW6)
+    :param patch_metadata: Patch metadata of x, with gs_coords, shape, mask,
+        cc_ground_truth, and cc_scene.
+    """
+
+    def __init__(self, x, patch_metadata):
+        self.gs_coords = patch_metadata["gs_coords"]
+        patch_width = np.max(self.gs_coords[:, 0]) - np.min(self.gs_coords[:, 0])
+        patch_height = np.max(self.gs_coords[:, 1]) - np.min(self.gs_coords[:, 1])
+        self.patch_shape = (
+            patch_height,
+            patch_width,
+            x.shape[-1],
+        )
+
+        self.patch_geometric_shape = str(patch_metadata["shape"])
+
+        # this masked to embed patch into the background in the event of occlusion
+        self.binarized_patch_mask = patch_metadata["mask"]
+        self.occluded = np.all(self.binarized_patch_mask == 0, axis=-1)
+
+        # get colorchecker information from ground truth and scene
+        self.cc_gt = patch_metadata["cc_ground_truth"]
+        self.cc_scene = patch_metadata["cc_scene"]
+
+        # insert_patch() uses BGR color ordering for input and output
+        rgb_img = (x[:, :, :3] * 255.0).astype("float32")
+        self.insertion = PatchInsertionContext(
+            self.gs_coords,
+            rgb_img[:, :, ::-1],  # input image needs to be BGR
+            self.patch_shape,
+            self.patch_geometric_shape,
+            cc_gt=self.cc_gt,
+            cc_scene=self.cc_scene,
+            apply_realistic_effects=True,
+        )
+
+        # homography from the green screen back to the patch, for the gradients
+        h, w, _ = self.patch_shape
+        patch_coords = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+        self.gradient_homography, _ = cv2.findHomography(self.gs_coords, patch_coords)
+
+    def apply_patch(self, x, patch):
+        """
+        Insert patch into image x using the DAPRICOT transform
+
+        :param x: Sample image, as given to the constructor.
+        :param patch: RGB channels of the patch to be applied.
+        """
+        if x.shape[-1] == 3:
+            rgb_img = (x * 255.0).astype("float32")
+        else:
+            rgb_img = (x[:, :, :3] * 255.0).astype("float32")
+            depth_img = (x[:, :, 3:] * 255.0).astype("float32")
+
+        # apply patch using DAPRICOT transform to RGB channels only
+        rgb_img_with_patch = self.insertion.insert(patch * 255.0)
+
+        # embed patch into background
+        rgb_img_with_patch[self.occluded] = rgb_img[self.occluded][:, ::-1]
+
+        if x.shape[-1] == 3:
+            img_with_patch = rgb_img_with_patch
+        else:
+            img_with_patch = np.concatenate(
+                (depth_img[:, :, ::-1], rgb_img_with_patch), axis=-1
+            )
+        return img_with_patch[:, :, ::-1] / 255.0  # convert back to RGB
+
+
+@contextlib.contextmanager
+def _seeded(seed):
+    """
+    Seed the random, numpy, and torch random number generators within the context,
+        and restore their previous states after it
+    """
+    state = (random.getstate(), np.random.get_state())
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch_state = torch.get_rng_state()
+        torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        if torch is not None:
+            torch.set_rng_state(torch_state)
+
+
+# The attack of a pool worker process, unpickled once by _init_pool_worker
+_pool_attack = None
+
+
+def _init_pool_worker(pickled_attack):
+    global _pool_attack
+    _pool_attack = pickle.loads(pickled_attack)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        # cores are shared between the workers
+        torch.set_num_threads(1)
+
+
+def _generate_pool_patch(x, y, patch_metadata, seed):
+    context = ImagePatchContext(x, patch_metadata)
+    return _pool_attack._generate_patch(x, y, context, seed)
 
 
 class CARLADapricotPatch(RobustDPatch):
     """
+    Robust DPatch optimized separately for each image, and inserted into its green
+        screen with a perspective transform, color correction, and shadows
+
+    num_workers - if > 1, optimize the patches of the images of a batch concurrently
+        in a pool of that many spawned processes. The estimator must run on CPU and
+        the attack must be picklable, otherwise patches are optimized serially.
+    seed - if not None, seed the random number generators before optimizing each
+        patch with a seed derived from it and the index of the image, counting
+        all images attacked so far, so that patches are reproducible regardless of
+        num_workers
+
+    Example attack config:
+        "attack": {
+            "knowledge": "white",
+            "kwargs": {
+                "batch_size": 1,
+                "learning_rate": 0.01,
+                "max_iter": 10000,
+                "num_workers": 8,
+                "seed": 1,
+                "verbose": false
+            },
+            "module": "armory.art_experimental.attacks.carla_obj_det_patch",
+            "name": "CARLADapricotPatch",
+            "use_label": false
+        }
     """
 
-    def __init__(self, estimator, **kwargs):
+    def __init__(self, estimator, num_workers=0, seed=None, **kwargs):
         # attack only RGB channels, assuming they have indices (0,1,2)
         self.attacked_channels = (0, 1, 2)
+        self.num_workers = int(num_workers)
+        self.seed = seed
+        self._num_images = 0
         super().__init__(estimator=estimator, **kwargs)
 
     def _augment_images_with_patch(self, x, y, patch, channels_first):
@@ -270,10 +499,8 @@ class CARLADapricotPatch(RobustDPatch):
         :param channels_first: Set channels first or last.
         """
 
-        if x.shape[0] != len(self.gs_coords):
-            raise ValueError(
-                "Number of images should be equal to the number of arrays of green screen coordinates"
-            )
+        if x.shape[0] != 1:
+            raise ValueError("Patches should be optimized for one image at a time")
         if y is not None and (x.shape[0] != len(y)):
             raise ValueError(
                 "Number of images should be equal to the number of targets"
@@ -281,44 +508,14 @@ class CARLADapricotPatch(RobustDPatch):
 
         transformations = dict()
         x_copy = x.copy()
-        patch_copy = patch.copy()
 
         # Apply patch:
-        x_patch = []
-        for xi, gs_coords in zip(x_copy, self.gs_coords):
-
-            if xi.shape[-1] == 3:
-                rgb_img = (xi * 255.0).astype("float32")
-            else:
-                rgb_img = (xi[:, :, :3] * 255.0).astype("float32")
-                depth_img = (xi[:, :, 3:] * 255.0).astype("float32")
-
-            # apply patch using DAPRICOT transform to RGB channels only
-            # insert_patch() uses BGR color ordering for input and output
-            rgb_img_with_patch = insert_patch(
-                gs_coords,
-                rgb_img[:, :, ::-1],  # input image needs to be BGR
-                patch_copy[:, :, self.attacked_channels] * 255.0,
-                self.patch_geometric_shape,
-                cc_gt=self.cc_gt,
-                cc_scene=self.cc_scene,
-                apply_realistic_effects=True,
-            )
-
-            # embed patch into background
-            rgb_img_with_patch[
-                np.all(self.binarized_patch_mask == 0, axis=-1)
-            ] = rgb_img[np.all(self.binarized_patch_mask == 0, axis=-1)][:, ::-1]
-
-            if xi.shape[-1] == 3:
-                img_with_patch = rgb_img_with_patch.copy()
-            else:
-                img_with_patch = np.concatenate(
-                    (depth_img[:, :, ::-1], rgb_img_with_patch), axis=-1
-                )
-
-            x_patch.append(img_with_patch[:, :, ::-1] / 255.0)  # convert back to RGB
-        x_patch = np.asarray(x_patch)
+        x_patch = np.asarray(
+            [
+                self._context.apply_patch(xi, patch[:, :, self.attacked_channels])
+                for xi in x_copy
+            ]
+        )
 
         # 1) crop images: not used.
         if self.crop_range[0] != 0 and self.crop_range[1] != 0:
@@ -362,25 +559,24 @@ class CARLADapricotPatch(RobustDPatch):
         :param transforms: The transformations in forward direction.
         :param channels_first: Set channels first or last.
         """
-        if gradients.shape[0] != len(self.gs_coords):
-            raise ValueError(
-                "Number of gradient arrays should be equal to the number of arrays of green screen coordinates"
-            )
+        if gradients.shape[0] != 1:
+            raise ValueError("Patches should be optimized for one image at a time")
 
         # Account for brightness adjustment:
         gradients = transforms["brightness"] * gradients
 
         # Undo perspective transform for gradients
-        h, w, c = self.patch_shape
-        patch_coords = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
-        gradients_tmp = []
-        for grads, gs_coords in zip(gradients, self.gs_coords):
-            h, _ = cv2.findHomography(gs_coords, patch_coords)
-            grads_tmp = cv2.warpPerspective(
-                grads, h, (self.patch_shape[1], self.patch_shape[0]), cv2.INTER_CUBIC
-            )
-            gradients_tmp.append(grads_tmp)
-        gradients = np.asarray(gradients_tmp)
+        gradients = np.asarray(
+            [
+                cv2.warpPerspective(
+                    grads,
+                    self._context.gradient_homography,
+                    (self.patch_shape[1], self.patch_shape[0]),
+                    cv2.INTER_CUBIC,
+                )
+                for grads in gradients
+            ]
+        )
 
         # get channels not attacked and then set the gradients of those channels to zero
         non_attacked_channels = list(
@@ -390,45 +586,18 @@ class CARLADapricotPatch(RobustDPatch):
 
         return gradients
 
-    def generate(self, x, y=None, y_patch_metadata=None):
+    def _generate_patch(self, x, y, context, seed):
         """
-        param x: Sample images. For single-modality, shape=(NHW3). For multimodality, shape=(NHW6)
-        param y: [Optional] Sample labels. List of dictionaries,
-            ith dictionary contains bounding boxes, class labels, and class scores
-        param y_patch_metadata: Patch metadata. List of N dictionaries, ith dictionary contains patch metadata for x[i]
-        """
-        if x.shape[0] > 1:
-            logger.info("To perform per-example patch attack, batch size must be 1")
-        assert x.shape[-1] in [3, 6], "x must have either 3 or 6 color channels"
-
-        num_imgs = x.shape[0]
-        attacked_images = []
-
-        for i in range(num_imgs):
-
-            if x.shape[-1] == 3:
-                rgb_img = (x[i] * 255.0).astype("float32")
-            else:
-                rgb_img = (x[i][:, :, :3] * 255.0).astype("float32")
-                depth_img = (x[i][:, :, 3:] * 255.0).astype("float32")
-
-            gs_coords = y_patch_metadata[i]["gs_coords"]
-            patch_width = np.max(gs_coords[:, 0]) - np.min(gs_coords[:, 0])
-            patch_height = np.max(gs_coords[:, 1]) - np.min(gs_coords[:, 1])
-            self.patch_shape = (
-                patch_height,
-                patch_width,
-                x.shape[-1],
-            )
-
-            self.patch_geometric_shape = str(y_patch_metadata[i]["shape"])
+        Optimize the patch of one image
 
-            # this masked to embed patch into the background in the event of occlusion
-            self.binarized_patch_mask = y_patch_metadata[i]["mask"]
-
-            # get colorchecker information from ground truth and scene
-            self.cc_gt = y_patch_metadata[i]["cc_ground_truth"]
-            self.cc_scene = y_patch_metadata[i]["cc_scene"]
+        :param x: Sample image.
+        :param y: [Optional] Sample label.
+        :param context: ImagePatchContext of x.
+        :param seed: [Optional] Seed of the random number generators.
+        """
+        with (_seeded(seed) if seed is not None else contextlib.nullcontext()):
+            self._context = context
+            self.patch_shape = context.patch_shape
 
             # self._patch needs to be re-initialized with the correct shape
             if self.estimator.clip_values is None:
@@ -441,40 +610,98 @@ class CARLADapricotPatch(RobustDPatch):
                     + self.estimator.clip_values[0]
                 )
 
-            self.gs_coords = [gs_coords]
-
             if y is None:
-                patch = super().generate(
-                    np.expand_dims(x[i], axis=0)
-                )  # untargeted attack
+                return super().generate(np.expand_dims(x, axis=0))  # untargeted attack
             else:
-                patch = super().generate(
-                    np.expand_dims(x[i], axis=0), y=[y[i]]
+                return super().generate(
+                    np.expand_dims(x, axis=0), y=[y]
                 )  # targeted attack
 
-            # apply patch using DAPRICOT transform to RGB channels only
-            # insert_patch() uses BGR color ordering for input and output
-            rgb_img_with_patch = insert_patch(
-                self.gs_coords[0],
-                rgb_img[:, :, ::-1],
-                patch[:, :, self.attacked_channels] * 255.0,
-                self.patch_geometric_shape,
-                cc_gt=self.cc_gt,
-                cc_scene=self.cc_scene,
-                apply_realistic_effects=True,
+    def _image_seeds(self, num_imgs):
+        """
+        Return the seed of each of the next num_imgs images
+        """
+        indices = range(self._num_images, self._num_images + num_imgs)
+        self._num_images += num_imgs
+        if self.seed is not None:
+            return [
+                int(np.random.SeedSequence([self.seed, i]).generate_state(1)[0])
+                for i in indices
+            ]
+        if self.num_workers > 1 and num_imgs > 1:
+            # worker processes would otherwise not follow the random state of this one
+            return [int(s) for s in np.random.randint(2 ** 31, size=num_imgs)]
+        return [None] * num_imgs
+
+    def _generate_patches_in_pool(self, jobs):
+        """
+        Return the patch of each tuple (x, y, patch_metadata, seed) in jobs, optimizing
+            them concurrently in spawned worker processes
+
+        Workers are spawned rather than forked, since forking a process whose other
+            threads may hold locks (e.g. of the framework runtime) can deadlock the child
+        """
+        device = getattr(self.estimator, "device", None)
+        if getattr(device, "type", "cpu") != "cpu":
+            logger.warning(
+                f"Optimizing patches serially: cannot share {device} between processes"
             )
+            pickled_attack = None
+        else:
+            try:
+                pickled_attack = pickle.dumps(self)
+            except Exception as e:
+                logger.warning(
+                    f"Optimizing patches serially: cannot pickle attack: {e}"
+                )
+                pickled_attack = None
+        if pickled_attack is None:
+            return [
+                self._generate_patch(x, y, ImagePatchContext(x, patch_metadata), seed)
+                for x, y, patch_metadata, seed in jobs
+            ]
+
+        num_workers = min(self.num_workers, len(jobs))
+        logger.info(f"Optimizing {len(jobs)} patches with {num_workers} processes")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pool_worker,
+            initargs=(pickled_attack,),
+        ) as executor:
+            futures = [executor.submit(_generate_pool_patch, *job) for job in jobs]
+            return [future.result() for future in futures]
 
-            # embed patch into background
-            rgb_img_with_patch[
-                np.all(self.binarized_patch_mask == 0, axis=-1)
-            ] = rgb_img[np.all(self.binarized_patch_mask == 0, axis=-1)][:, ::-1]
+    def generate(self, x, y=None, y_patch_metadata=None):
+        """
+        param x: Sample images. For single-modality, shape=(NHW3). For multimodality, shape=(NHW6)
+        param y: [Optional] Sample labels. List of dictionaries,
+            ith dictionary contains bounding boxes, class labels, and class scores
+        param y_patch_metadata: Patch metadata. List of N dictionaries, ith dictionary contains patch metadata for x[i]
+        """
+        if x.shape[0] > 1 and self.num_workers <= 1:
+            logger.info("To perform per-example patch attack, batch size must be 1")
+        assert x.shape[-1] in [3, 6], "x must have either 3 or 6 color channels"
 
-            if x.shape[-1] == 3:
-                img_with_patch = rgb_img_with_patch.copy()
-            else:
-                img_with_patch = np.concatenate(
-                    (depth_img[:, :, ::-1], rgb_img_with_patch), axis=-1
-                )
-            attacked_images.append(img_with_patch[:, :, ::-1] / 255.0)
+        num_imgs = x.shape[0]
+        contexts = [
+            ImagePatchContext(x[i], y_patch_metadata[i]) for i in range(num_imgs)
+        ]
+        ys = [None] * num_imgs if y is None else y
+        seeds = self._image_seeds(num_imgs)
 
+        if self.num_workers > 1 and num_imgs > 1:
+            patches = self._generate_patches_in_pool(
+                list(zip(x, ys, y_patch_metadata, seeds))
+            )
+        else:
+            patches = [
+                self._generate_patch(x_i, y_i, context, seed)
+                for x_i, y_i, context, seed in zip(x, ys, contexts, seeds)
+            ]
+
+        attacked_images = [
+            context.apply_patch(x_i, patch[:, :, self.attacked_channels])
+            for x_i, context, patch in zip(x, contexts, patches)
+        ]
         return np.array(attacked_images)
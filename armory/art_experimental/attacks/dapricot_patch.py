@@ -1,6 +1,7 @@
 """
 Copyright 2021 The MITRE Corporation. All rights reserved
 """
+import functools
 import logging
 import numpy as np
 import cv2
@@ -10,6 +11,9 @@ from art.attacks.evasion import ProjectedGradientDescent
 
 logger = logging.getLogger(__name__)
 
+# Number of (shape, height, width) masks kept by create_mask
+MASK_CACHE_SIZE = 64
+
 
 def shape_coords(h, w, obj_shape):
     if obj_shape == "octagon":
@@ -98,19 +102,41 @@ def in_polygon(x, y, vertices):
     return c
 
 
+def polygon_mask(vertices, h, w):
+    """
+    Return a boolean (h, w) array whose element (i, j) is in_polygon(i, j, vertices)
+
+    All points are tested against each edge at once, with the same arithmetic as
+        in_polygon, so that the result is identical.
+    """
+    vertices = np.asarray(vertices)
+    x = np.arange(h).reshape(-1, 1)
+    y = np.arange(w).reshape(1, -1)
+    inside = np.zeros((h, w), dtype=bool)
+    for i in range(len(vertices)):
+        x_i, y_i = vertices[i]
+        x_j, y_j = vertices[i - 1]
+        if y_i == y_j:
+            # the y coordinate of the point cannot be between those of the vertices
+            continue
+        between = ((y_i <= y) & (y < y_j)) | ((y_j <= y) & (y < y_i))
+        crossing = (x_j - x_i) * (y - y_i) / (y_j - y_i) + x_i
+        inside ^= between & (x < crossing)
+    return inside
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
 def create_mask(mask_type, h, w):
     """
     create mask according to shape
-    """
 
-    mask = np.zeros((h, w, 3))
+    Masks are cached, as only a few shapes and sizes occur in a dataset. The returned
+        array is read-only.
+    """
     coords = shape_coords(h, w, mask_type)
-
-    for i in range(h):
-        for j in range(w):
-            if in_polygon(i, j, coords):
-                mask[i, j, :] = 1
-
+    mask = np.repeat(polygon_mask(coords, h, w)[..., np.newaxis], 3, axis=2)
+    mask = mask.astype(np.float64)
+    mask.flags.writeable = False
     return mask
 
 
@@ -27,6 +27,9 @@ class FGMBinarySearch(FastGradientMethod):
         Iteratively compute the minimal perturbation necessary to make the
         class prediction change, using binary search.
 
+        All samples of the batch are searched together, with per-sample epsilon bounds
+        and a single prediction per step.
+
         batch - np array of features for batch (x)
         batch_labels - np array of labels for batch, a 2D array of probabilites (y)
         adv_batch - same shape as batch (x^hat)
@@ -44,31 +47,33 @@ class FGMBinarySearch(FastGradientMethod):
         mask = None
         perturbation = self._compute_perturbation(batch, batch_labels, mask)
 
-        def check_epsilon(i, epsilon):
-            adv_batch = self._apply_perturbation(batch[[i]], perturbation[[i]], epsilon)
-            adv_pred = self.estimator.predict(adv_batch)
-            adv_class = np.argmax(adv_pred, axis=1)
+        # Assume endpoints are correct
+        tolerance = self.eps_step
+        min_eps = np.zeros(len(batch))
+        max_eps = np.full(len(batch), float(self.eps))
+        active = np.where(max_eps - min_eps > tolerance)[0]
+        while active.size > 0:
+            mid_eps = (max_eps[active] + min_eps[active]) / 2
+            # Broadcast each sample's epsilon over its features, in the batch dtype
+            #     so adversarial samples are not promoted to float64
+            eps_shape = (len(active),) + (1,) * (batch.ndim - 1)
+            adv_active = self._apply_perturbation(
+                batch[active],
+                perturbation[active],
+                mid_eps.astype(batch.dtype).reshape(eps_shape),
+            )
+
+            # Check for success with a single prediction for all active samples
+            adv_classes = np.argmax(self.estimator.predict(adv_active), axis=1)
             if self.targeted:
-                success = batch_classes[[i]] == adv_class
+                success = batch_classes[active] == adv_classes
             else:
-                success = batch_classes[[i]] != adv_class
-            return success, adv_batch
+                success = batch_classes[active] != adv_classes
+            adv_batch[active[success]] = adv_active[success]
+            max_eps[active[success]] = mid_eps[success]
+            min_eps[active[~success]] = mid_eps[~success]
 
-        tolerance = self.eps_step
-        for i in range(len(batch)):
-            # Assume endpoints are correct
-            min_eps = 0
-            max_eps = self.eps
-            while max_eps - min_eps > tolerance:
-                mid_eps = (max_eps + min_eps) / 2
-                # print(min_eps, mid_eps, max_eps, tolerance)
-
-                success, adv_i = check_epsilon(i, mid_eps)
-                if success:
-                    adv_batch[[i]] = adv_i
-                    max_eps = mid_eps
-                else:
-                    min_eps = mid_eps
+            active = active[max_eps[active] - min_eps[active] > tolerance]
 
         return adv_batch
 
@@ -42,47 +42,72 @@ class KenansvilleDFT:
             raise ValueError("Negative SNR (dB) is not allowed")
 
     def _attack(self, x):
+        """
+        Attack each row of a 2D array x, or a 1D array x, in one vectorized pass
+        """
         if not np.isreal(x).all():
             raise ValueError("Input must be real")
-        if not len(x):
+        if not x.shape[-1]:
             return np.copy(x)
 
         # Determine power spectral density using real FFT
         #     Double power spectral density for paired frequencies (non-DC, non-nyquist)
-        x_rfft = np.fft.rfft(x)
+        length = x.shape[-1]
+        x_rfft = np.fft.rfft(x, axis=-1)
         x_psd = np.abs(x_rfft) ** 2
-        if len(x) % 2:  # odd: DC frequency
-            x_psd[1:] *= 2
+        if length % 2:  # odd: DC frequency
+            x_psd[..., 1:] *= 2
         else:  # even: DC and Nyquist frequencies
-            x_psd[1:-1] *= 2
+            x_psd[..., 1:-1] *= 2
 
         # Scale the threshold based on the power of the signal
         # Find frequencies in order with cumulative perturbation less than threshold
         #     Sort frequencies by power density in ascending order
-        x_psd_index = np.argsort(x_psd)
-        reordered = x_psd[x_psd_index]
-        cumulative = np.cumsum(reordered)
-        norm_threshold = self.threshold * cumulative[-1]
-        i = np.searchsorted(cumulative, norm_threshold, side="right")
+        x_psd_index = np.argsort(x_psd, axis=-1)
+        reordered = np.take_along_axis(x_psd, x_psd_index, axis=-1)
+        cumulative = np.cumsum(reordered, axis=-1)
+        norm_threshold = self.threshold * cumulative[..., -1:]
+        i = (cumulative <= norm_threshold).sum(axis=-1, keepdims=True)
 
         # Zero out low power frequencies and invert to time domain
-        x_rfft[x_psd_index[:i]] = 0
-        return np.fft.irfft(x_rfft, len(x)).astype(x.dtype)
+        low_power = np.empty(x_psd.shape, dtype=bool)
+        ranks = np.arange(x_psd.shape[-1])
+        np.put_along_axis(low_power, x_psd_index, ranks < i, axis=-1)
+        x_rfft[low_power] = 0
+        return np.fft.irfft(x_rfft, length, axis=-1).astype(x.dtype)
+
+    def _partial_attack(self, x):
+        """
+        Split x into segments of attack_len and attack each with probability attack_prob
+
+        Attacked segments of full length are processed together as rows of a 2D array
+        """
+        seg_len = self.attack_len
+        num_full = len(x) // seg_len
+        num_segments = int(np.ceil(len(x) / seg_len))
+        # Same draws as np.random.rand(1) per segment, in order
+        attacked = np.random.rand(num_segments) < self.attack_prob
+
+        x_adv = np.copy(x)
+        segments = x_adv[: num_full * seg_len].reshape(num_full, seg_len)
+        segments[attacked[:num_full]] = self._attack(segments[attacked[:num_full]])
+        if num_segments > num_full and attacked[-1]:
+            x_adv[num_full * seg_len :] = self._attack(x[num_full * seg_len :])
+        return x_adv
 
     def generate(self, x, y=None):
         x_out = np.empty((len(x),), dtype=object)
+        if not self.partial_attack and isinstance(x, np.ndarray) and x.ndim == 2:
+            # equal length samples are attacked together
+            x_adv = self._attack(x)
+            for i, x_example in enumerate(x_adv):
+                x_out[i] = x_example
+            return x_out
+
         for i, x_example in enumerate(x):
             if self.partial_attack:
-                # split input into multiple segments and attack each with some probability
-                x_adv = np.zeros_like(x_example)
-                seg_len = self.attack_len
-                for j in range(int(np.ceil(len(x_example) / seg_len))):
-                    xs = x_example[seg_len * j : min((j + 1) * seg_len, len(x_example))]
-                    if np.random.rand(1) < self.attack_prob:
-                        xs = self._attack(xs)
-                    x_adv[seg_len * j : min((j + 1) * seg_len, len(x_example))] = xs
+                x_out[i] = self._partial_attack(x_example)
             else:
-                x_adv = self._attack(x_example)
-            x_out[i] = x_adv
+                x_out[i] = self._attack(x_example)
 
         return x_out
@@ -9,7 +9,56 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class SNR_PGDRange:
+class _SNR_PGDSearch:
+    """
+    Shared logic of the searches for the maximum SNR of each sample of a batch
+
+    PGD runs one sample at a time, as the SNR bound depends on the power of each
+        signal, but all samples of a search step are checked with one prediction.
+        If warm_start, each run is warm-started from the best adversarial example
+        found so far for that sample, which was found at a neighboring SNR.
+        Otherwise, each run starts from the sample, as in a search of one sample.
+
+    After generate, eps_per_sample holds the eps achieved for each sample, or NaN
+        if the sample was originally misclassified or the attack failed.
+    """
+
+    def _labels(self, y):
+        y = np.asarray(y)
+        if y.ndim == 2:
+            return y.argmax(axis=1)
+        return y
+
+    def _is_adversarial(self, x, y):
+        return self.estimator.predict(x).argmax(axis=1) != y
+
+    def _attack_samples(self, attacks, x, y, x_init, indices, **kwargs):
+        """
+        Attack sample i of x with attacks[i], starting from x_init[i], for each index
+
+        Return the adversarial samples and whether each attack succeeded
+        """
+        x_adv = [
+            attacks[i].generate(
+                x[i : i + 1],
+                y[i : i + 1],
+                x_init=x_init[i] if self.warm_start else None,
+                **kwargs,
+            )
+            for i in indices
+        ]
+        x_adv = np.concatenate(x_adv)
+        return x_adv, self._is_adversarial(x_adv, y[indices])
+
+    def _log_eps_per_sample(self):
+        for i, eps in enumerate(self.eps_per_sample):
+            if np.isnan(eps):
+                logger.info(f"Attack failed for sample {i}")
+            else:
+                logger.info(f"Best attack for sample {i} with eps {eps}")
+
+
+class SNR_PGDRange(_SNR_PGDSearch):
     """
     Finds the maximum SNR for each sample (if possible), via binary search.
 
@@ -34,53 +83,64 @@ class SNR_PGDRange:
         }
     """
 
-    def __init__(self, estimator, eps_range=(0, 10, 20, 30, 40, 50), **kwargs):
+    def __init__(
+        self, estimator, eps_range=(0, 10, 20, 30, 40, 50), warm_start=True, **kwargs
+    ):
         if "eps" in kwargs:
             raise ValueError("Use 'eps_range' instead of 'eps'")
         self.estimator = estimator
+        self.warm_start = bool(warm_start)
         self.eps_range = sorted(eps_range)
         if len(eps_range) < 2:
             raise ValueError("Please select multiple values for eps_range")
         self.attacks = []
-        for eps in eps_range:
+        for eps in self.eps_range:
             self.attacks.append(SNR_PGD(estimator, eps=eps, **kwargs))
+        self.eps_per_sample = None
 
     def generate(self, x, y=None, **kwargs):
         if y is None:
             raise ValueError("This attack requires given labels")
-        if self.estimator.predict(x).argmax() != y:
-            logger.info("Original prediction failed. Returning original x.")
-            return x
+        y = self._labels(y)
+        x_best = x.copy()
+        x_init = [None] * len(x)
+        self.eps_per_sample = np.full(len(x), np.nan)
+
+        # find best eps via bisection, per sample
+        i_min = np.zeros(len(x), dtype=int)
+        i_max = np.full(len(x), len(self.eps_range))
+        misclassified = self._is_adversarial(x, y)
+        if misclassified.any():
+            logger.info(
+                f"Original prediction failed for samples {np.flatnonzero(misclassified)}"
+            )
+            i_max[misclassified] = 0
 
-        # find best eps via bisection
-        i_min = 0
-        i_max = len(self.eps_range)
-        x_best = None
-        eps_best = None
-        while i_min < i_max:
+        while (i_min < i_max).any():
+            active = np.flatnonzero(i_min < i_max)
             i_mid = (i_min + i_max) // 2
-            x_adv = self.attacks[i_mid].generate(x, y, **kwargs)
-            eps = self.eps_range[i_mid]
-            if self.estimator.predict(x_adv).argmax() != y:
-                # attack success (will also succeed for lower SNR)
-                logger.info(f"Success with eps {eps}")
-                x_best = x_adv
-                eps_best = eps
-                i_min = i_mid + 1
-            else:
-                # attack failure (will also fail for higher SNR)
-                logger.info(f"Failure with eps {eps}")
-                i_max = i_mid
-
-        if x_best is None:
-            logger.info("Attack failed. Returning original x.")
-            return x
-        if x_best is not None:
-            logger.info(f"Returning best attack with eps {eps_best}")
-            return x_best
+            attacks = {i: self.attacks[i_mid[i]] for i in active}
+            x_adv, success = self._attack_samples(
+                attacks, x, y, x_init, active, **kwargs
+            )
+            for i, x_adv_i, success_i in zip(active, x_adv, success):
+                if success_i:
+                    # attack success (will also succeed for lower SNR)
+                    x_best[i] = x_adv_i
+                    self.eps_per_sample[i] = self.eps_range[i_mid[i]]
+                    i_min[i] = i_mid[i] + 1
+                else:
+                    # attack failure (will also fail for higher SNR)
+                    i_max[i] = i_mid[i]
+                if success_i or x_init[i] is None:
+                    x_init[i] = x_adv_i[np.newaxis]
+            logger.info(f"Success for {success.sum()} of {len(active)} samples")
+
+        self._log_eps_per_sample()
+        return x_best
 
 
-class SNR_PGDRange2:
+class SNR_PGDRange2(_SNR_PGDSearch):
     """
     Finds the maximum SNR for each sample, with a given tolerance
 
@@ -106,7 +166,14 @@ class SNR_PGDRange2:
     """
 
     def __init__(
-        self, estimator, attack="l2", eps_min=10, eps_max=50, tolerance=1, **kwargs
+        self,
+        estimator,
+        attack="l2",
+        eps_min=10,
+        eps_max=50,
+        tolerance=1,
+        warm_start=True,
+        **kwargs,
     ):
         if eps_min > eps_max:
             raise ValueError(f"eps_min {eps_min} > eps_max {eps_max}")
@@ -127,6 +194,7 @@ class SNR_PGDRange2:
         self.eps_min = eps_min
         self.eps_max = eps_max
         self.estimator = estimator
+        self.warm_start = bool(warm_start)
         self.kwargs = kwargs
         tolerance = float(tolerance)
         if not (tolerance >= 0):
@@ -135,56 +203,168 @@ class SNR_PGDRange2:
             logger.warning("Using minimum float tolerance instead of 0")
 
         self.tolerance = tolerance
+        self.eps_per_sample = None
 
     def generate(self, x, y=None, **kwargs):
         if y is None:
             raise ValueError("This attack requires given labels")
-        if self.estimator.predict(x).argmax() != y:
-            logger.info("Original prediction failed. Returning original x.")
-            return x
+        y = self._labels(y)
+        x_best = x.copy()
+        x_init = [None] * len(x)
+        self.eps_per_sample = np.full(len(x), np.nan)
+
+        misclassified = self._is_adversarial(x, y)
+        if misclassified.any():
+            logger.info(
+                f"Original prediction failed for samples {np.flatnonzero(misclassified)}"
+            )
+        remaining = np.flatnonzero(~misclassified)
         if self.eps_min == self.eps_max:
-            return self.min_attack.generate(x, y, **kwargs)
+            attacks = {i: self.min_attack for i in remaining}
+            x_adv, success = self._attack_samples(
+                attacks, x, y, x_init, remaining, **kwargs
+            )
+            x_best[remaining] = x_adv
+            self.eps_per_sample[remaining[success]] = self.eps_min
+            return x_best
 
         # test endpoints
-        x_adv = self.max_attack.generate(x, y, **kwargs)
-        if self.estimator.predict(x_adv).argmax() != y:
-            logger.info(f"Success at upper boundary eps = {self.eps_max}")
-            return x_adv
-        else:
-            logger.info(f"Failure at upper boundary eps = {self.eps_max}")
-            upper_eps = self.eps_max
-
-        x_adv = self.min_attack.generate(x, y, **kwargs)
-        if self.estimator.predict(x_adv).argmax() != y:
-            logger.info(f"Success at lower boundary eps = {self.eps_min}")
-            lower_eps = self.eps_min
-            x_best = x_adv
-            eps_best = lower_eps
-        else:
-            logger.info(f"Failure at lower boundary eps = {self.eps_min}")
-            return x_adv
-
-        while upper_eps - lower_eps > self.tolerance:
+        attacks = {i: self.max_attack for i in remaining}
+        x_adv, success = self._attack_samples(
+            attacks, x, y, x_init, remaining, **kwargs
+        )
+        logger.info(
+            f"Success at upper boundary eps = {self.eps_max} for "
+            f"{success.sum()} of {len(remaining)} samples"
+        )
+        x_best[remaining[success]] = x_adv[success]
+        self.eps_per_sample[remaining[success]] = self.eps_max
+        for i, x_adv_i in zip(remaining, x_adv):
+            x_init[i] = x_adv_i[np.newaxis]
+        remaining = remaining[~success]
+
+        attacks = {i: self.min_attack for i in remaining}
+        x_adv, success = self._attack_samples(
+            attacks, x, y, x_init, remaining, **kwargs
+        )
+        logger.info(
+            f"Success at lower boundary eps = {self.eps_min} for "
+            f"{success.sum()} of {len(remaining)} samples"
+        )
+        x_best[remaining] = x_adv
+        self.eps_per_sample[remaining[success]] = self.eps_min
+        for i, x_adv_i in zip(remaining, x_adv):
+            x_init[i] = x_adv_i[np.newaxis]
+        remaining = remaining[success]
+
+        lower_eps = np.full(len(x), float(self.eps_min))
+        upper_eps = np.full(len(x), float(self.eps_max))
+        mid_attacks = {}
+        while len(remaining):
+            remaining = remaining[
+                upper_eps[remaining] - lower_eps[remaining] > self.tolerance
+            ]
             mid_eps = (upper_eps + lower_eps) / 2
-            if mid_eps == lower_eps or mid_eps == upper_eps:
-                logger.info("Reached floating point tolerance limit")
+            at_limit = (mid_eps[remaining] == lower_eps[remaining]) | (
+                mid_eps[remaining] == upper_eps[remaining]
+            )
+            if at_limit.any():
+                logger.info(
+                    f"Reached floating point tolerance limit for samples "
+                    f"{remaining[at_limit]}"
+                )
+                remaining = remaining[~at_limit]
+            if not len(remaining):
                 break
-            attack = self.Attack(self.estimator, eps=mid_eps, **self.kwargs)
-            x_adv = attack.generate(x, y, **kwargs)
-            if self.estimator.predict(x_adv).argmax() != y:
-                logger.info(f"Success at eps = {mid_eps}")
-                lower_eps = mid_eps
-                x_best = x_adv
-                eps_best = lower_eps
-            else:
-                logger.info(f"Failure at eps = {mid_eps}")
-                upper_eps = mid_eps
 
-        logger.info(f"Returning best attack with eps {eps_best}")
+            attacks = {}
+            for i in remaining:
+                if mid_eps[i] not in mid_attacks:
+                    mid_attacks[mid_eps[i]] = self.Attack(
+                        self.estimator, eps=mid_eps[i], **self.kwargs
+                    )
+                attacks[i] = mid_attacks[mid_eps[i]]
+            x_adv, success = self._attack_samples(
+                attacks, x, y, x_init, remaining, **kwargs
+            )
+            for i, x_adv_i, success_i in zip(remaining, x_adv, success):
+                if success_i:
+                    lower_eps[i] = mid_eps[i]
+                    x_best[i] = x_adv_i
+                    self.eps_per_sample[i] = mid_eps[i]
+                    x_init[i] = x_adv_i[np.newaxis]
+                else:
+                    upper_eps[i] = mid_eps[i]
+            logger.info(f"Success for {success.sum()} of {len(remaining)} samples")
+
+        self._log_eps_per_sample()
         return x_best
 
 
-class SNR_PGD_Numpy(ProjectedGradientDescentNumpy):
+class _WarmStartPGD:
+    """
+    Lets generate start PGD from x_init, e.g. an adversarial example of x found with
+        a different bound, rather than from x itself
+
+    x_init is projected into the bound of the attack. If num_random_init > 0, the
+        random initialization is applied around it.
+    """
+
+    _x_warm = None
+
+    def _set_warm_start(self, x, x_init, eps):
+        if x_init is None:
+            self._x_warm = None
+            return
+        if x_init.shape != x.shape:
+            raise ValueError(
+                f"x_init shape {x_init.shape} does not match x shape {x.shape}"
+            )
+
+        delta = x_init - x
+        if self.norm == 2:
+            delta_l2 = np.linalg.norm(delta)
+            if delta_l2 > eps:
+                delta = delta * (eps / delta_l2)
+        else:
+            delta = np.clip(delta, -eps, eps)
+        x_warm = x + delta
+        if self.estimator.clip_values is not None:
+            x_warm = np.clip(x_warm, *self.estimator.clip_values)
+        self._x_warm = x_warm
+
+    def _warm_start(self, x):
+        """
+        Return the warm start in place of x at the first iteration of each PGD run
+
+        ART sets _i_max_iter before each iteration, including those of each restart
+        """
+        if self._x_warm is None or self._i_max_iter != 0:
+            return x
+        if isinstance(x, np.ndarray):
+            return self._x_warm.astype(x.dtype)
+
+        import torch
+
+        return torch.from_numpy(self._x_warm).to(device=x.device, dtype=x.dtype)
+
+    def _compute(self, x, x_init, *args, **kwargs):
+        return super()._compute(self._warm_start(x), x_init, *args, **kwargs)
+
+    def _compute_pytorch(self, x, x_init, *args, **kwargs):
+        return super()._compute_pytorch(self._warm_start(x), x_init, *args, **kwargs)
+
+    def _generate_from(self, x, y, x_init, eps, **kwargs):
+        eps_step = eps * self.step_fraction
+        self.set_params(eps=eps, eps_step=eps_step)
+        self._set_warm_start(x, x_init, eps)
+        try:
+            return super().generate(x, y=y, **kwargs)
+        finally:
+            self._x_warm = None
+
+
+class SNR_PGD_Numpy(_WarmStartPGD, ProjectedGradientDescentNumpy):
     def __init__(
         self, estimator, norm="snr", eps=10, eps_step=0.5, batch_size=1, **kwargs
     ):
@@ -216,7 +396,7 @@ class SNR_PGD_Numpy(ProjectedGradientDescentNumpy):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
+    def generate(self, x, y=None, x_init=None, **kwargs):
         x_l2 = np.linalg.norm(x, ord=2)
         if x_l2 == 0:
             logger.warning("Input all 0. Not making any change.")
@@ -225,12 +405,10 @@ class SNR_PGD_Numpy(ProjectedGradientDescentNumpy):
             return x
 
         eps = x_l2 * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
+        return self._generate_from(x, y, x_init, eps, **kwargs)
 
 
-class SNR_PGD(ProjectedGradientDescentPyTorch):
+class SNR_PGD(_WarmStartPGD, ProjectedGradientDescentPyTorch):
     """
     Applies L2 PGD to signal based on an SNR bound defined by norm 'snr' or 'snr_db'.
         This is a *lower* bound on allowable SNR (as opposed to L2 upper bound)
@@ -280,7 +458,7 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
+    def generate(self, x, y=None, x_init=None, **kwargs):
         if x.shape[1] == 0:
             logger.warning("Length 0 signal. Returning original.")
             return x
@@ -293,9 +471,7 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
             return x
 
         eps = x_l2 * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
+        return self._generate_from(x, y, x_init, eps, **kwargs)
 
     def _compute_perturbation(self, x, y, mask):
         """
@@ -374,7 +550,7 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
         return x
 
 
-class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
+class SNR_PGD_Linf(_WarmStartPGD, ProjectedGradientDescentPyTorch):
     """
     Applies Linf PGD to signal based on an SNR bound defined by norm 'snr' or 'snr_db'.
 
@@ -416,7 +592,7 @@ class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
+    def generate(self, x, y=None, x_init=None, **kwargs):
         if x.shape[1] == 0:
             logger.warning("Length 0 signal. Returning original.")
             return x
@@ -429,6 +605,4 @@ class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
             return x
 
         eps = x_rms * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
+        return self._generate_from(x, y, x_init, eps, **kwargs)
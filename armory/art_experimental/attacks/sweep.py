@@ -72,8 +72,16 @@ class SweepAttack(EvasionAttack):
             self.attacks.append(subattack_i)
 
     def generate(self, x, y=None, **kwargs):
-        if x.shape[0] != 1:
-            raise ValueError("Dataset batch_size should be set to 1")
+        """
+        Return, for each sample of x, the weakest-strength successful attack, or the
+        sample itself if the attack fails at all search points
+
+        The bisection runs for all samples of the batch at once. At each step, the
+        samples that share a search point are attacked together, and only samples that
+        are still unresolved are attacked. The outcome of each (sample, search point)
+        pair is recorded, so no pair is attacked or predicted twice. Values in kwargs
+        are passed to every attack unchanged, so they must not be per-sample.
+        """
         if y is None:
             raise ValueError(
                 "This attack requires given labels. Ensure that attack['use_label'] is set to True."
@@ -87,54 +95,92 @@ class SweepAttack(EvasionAttack):
                 f"in attack_config['generate_kwargs'] will be ignored."
             )
 
-        y_pred = self._estimator.predict(x)
-        if not self._is_robust(y, y_pred):
+        num_samples = len(x)
+        robust = self._is_robust_per_sample(y, self._estimator.predict(x))
+        if not robust.any():
             logger.info(
                 f"Estimator is not robust to original x as measured with metric "
                 f"function {self.metric_fn.__name__} and threshold "
                 f"{self.metric_threshold}. Returning original x."
             )
             return x
+        if not robust.all():
+            logger.info(
+                f"Estimator is not robust to {num_samples - robust.sum()} of "
+                f"{num_samples} original samples. Returning them unchanged."
+            )
 
-        i_min = 0
-        i_max = self.num_search_points
-        x_best = None
-        while i_min < i_max:
+        # outcomes[k, i] is 1 if the attack at search point i succeeded on sample k,
+        # -1 if it failed, and 0 if it was not attempted
+        outcomes = np.zeros((num_samples, self.num_search_points), dtype=np.int8)
+        i_min = np.zeros(num_samples, dtype=np.int64)
+        i_max = np.where(robust, self.num_search_points, 0)
+        x_best = x.copy()
+        best_point = np.full(num_samples, -1)
+        while (i_min < i_max).any():
+            unresolved = np.where(i_min < i_max)[0]
             i_mid = (i_min + i_max) // 2
-            attack_kwargs = {k: v[i_mid] for k, v in self.sweep_kwargs.items()}
-            generate_kwargs = {
-                k: v[i_mid] for k, v in self.sweep_generate_kwargs.items()
-            }
-            kwargs.update(generate_kwargs)
-            x_adv = self.attacks[i_mid].generate(x, y, **kwargs)
-            y_pred = self._estimator.predict(x_adv)
-            if not self._is_robust(y, y_pred):
-                # attack success
-                logger.info(
-                    f"Success with kwargs {attack_kwargs} and generate_kwargs {generate_kwargs}"
-                )
-                x_best = x_adv
-                best_attack_kwargs = attack_kwargs
-                best_generate_kwargs = generate_kwargs
-                i_max = i_mid
-            else:
-                # attack failure
-                i_min = i_mid + 1
-                logger.info(
-                    f"Failure with kwargs {attack_kwargs} and generate_kwargs {generate_kwargs}"
-                )
+            for point in np.unique(i_mid[unresolved]):
+                samples = unresolved[i_mid[unresolved] == point]
+                to_attack = samples[outcomes[samples, point] == 0]
+                if len(to_attack):
+                    x_adv, success = self._attack_samples(
+                        x, y, to_attack, point, kwargs
+                    )
+                    outcomes[to_attack, point] = np.where(success, 1, -1)
+                    # Successful search points only decrease for each sample, so the
+                    # latest success is the weakest
+                    for j in np.where(success)[0]:
+                        x_best[to_attack[j]] = x_adv[j]
+                        best_point[to_attack[j]] = point
+                succeeded = outcomes[samples, point] == 1
+                i_max[samples[succeeded]] = point
+                i_min[samples[~succeeded]] = point + 1
 
-        if x_best is None:
+        if (best_point == -1).all():
             logger.info(
                 "Sweep attack concluded. Returning original x since attack failed at all sweep points."
             )
             return x
-        if x_best is not None:
+        for point in np.unique(best_point[best_point >= 0]):
             logger.info(
-                f"Sweep attack concluded. Returning the weakest-strength successful attack with "
-                f"kwargs {best_attack_kwargs} and generate_kwargs {best_generate_kwargs}"
+                f"Sweep attack concluded. Returning the weakest-strength successful attack "
+                f"for {(best_point == point).sum()} of {num_samples} samples with "
+                f"kwargs {self._point_kwargs(point)[0]} and generate_kwargs "
+                f"{self._point_kwargs(point)[1]}"
             )
-            return x_best
+        return x_best
+
+    def _point_kwargs(self, point):
+        attack_kwargs = {k: v[point] for k, v in self.sweep_kwargs.items()}
+        generate_kwargs = {k: v[point] for k, v in self.sweep_generate_kwargs.items()}
+        return attack_kwargs, generate_kwargs
+
+    def _attack_samples(self, x, y, samples, point, kwargs):
+        """
+        Attack x[samples] at a search point, returning the adversarial samples and a
+        boolean array indicating which attacks succeeded
+        """
+        attack_kwargs, generate_kwargs = self._point_kwargs(point)
+        y_samples = _select(y, samples)
+        x_adv = self.attacks[point].generate(
+            x[samples], y_samples, **dict(kwargs, **generate_kwargs)
+        )
+        success = ~self._is_robust_per_sample(y_samples, self._estimator.predict(x_adv))
+        logger.info(
+            f"Success for {success.sum()} of {len(samples)} samples with kwargs "
+            f"{attack_kwargs} and generate_kwargs {generate_kwargs}"
+        )
+        return x_adv, success
+
+    def _is_robust_per_sample(self, y, y_pred):
+        return np.array(
+            [
+                self._is_robust(_select(y, [k]), _select(y_pred, [k]))
+                for k in range(len(y_pred))
+            ],
+            dtype=bool,
+        )
 
     def _is_robust(self, y, y_pred):
         metric_result = self._get_metric_result(y, y_pred)
@@ -144,7 +190,7 @@ class SweepAttack(EvasionAttack):
             return metric_result > self.metric_threshold
 
     def _get_metric_result(self, y, y_pred):
-        if isinstance(y, np.ndarray) and y.dtype == np.object:
+        if isinstance(y, np.ndarray) and y.dtype == object:
             # convert np object array to list of dicts
             metric_result = self.metric_fn([y[0]], y_pred)
         else:
@@ -229,3 +275,12 @@ class SweepAttack(EvasionAttack):
                     "attack_config['sweep_params']['metric']['threshold'] must be "
                     "specified as well."
                 )
+
+
+def _select(values, indices):
+    """
+    Return the elements of a numpy array or list at indices, in the same type
+    """
+    if isinstance(values, np.ndarray):
+        return values[indices]
+    return [values[i] for i in indices]
@@ -77,39 +77,121 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
                 where a report is None (for future ART compatibility)
                 where is_clean is a list, where is_clean_lst[i]=1 means that x_train[i]
                 there is clean and is_clean_lst[i]=0, means that x_train[i] was classified as poison.
+
+        Activations are computed batch by batch in two passes over x_train, so that
+        they are never held in memory for the whole training set. The first pass
+        accumulates the mean and covariance of the activations of each class, whose
+        top eigenvector is the top right singular vector of the centered activations.
+        The second pass scores each sample by its squared projection onto it.
+
+        If the covariances of all classes would be larger than the activations
+        themselves, i.e. n_classes * dim > len(x_train), the activations are held
+        in memory instead and the centered activations of each class are scored
+        with an SVD, which is also cheaper than an eigendecomposition in that case.
         """
 
         self.set_params(**kwargs)
 
         n_classes = self.classifier.nb_classes()
-        nb_layers = len(self.classifier.layer_names)
-
-        features_x_poisoned = self.classifier.get_activations(
-            self.x_train, layer=nb_layers - 1, batch_size=self.batch_size
-        )
+        labels = np.asarray(self.y_train).astype(int)
+
+        counts = np.bincount(labels, minlength=n_classes)
+        nonempty = counts > 0
+        shift, sums, outer_sums, activations = None, None, None, None
+        for indices, features in self._activation_batches():
+            if shift is None:
+                # Accumulate about an offset to limit cancellation in the covariance
+                shift = features.mean(axis=0)
+                dim = len(shift)
+                if n_classes * dim > len(labels):
+                    logger.info(
+                        f"Covariances of {n_classes} classes of {dim} activations "
+                        f"are larger than the activations of {len(labels)} samples. "
+                        "Holding activations in memory instead."
+                    )
+                    activations = np.empty((len(labels), dim))
+                else:
+                    sums = np.zeros((n_classes, dim))
+                    outer_sums = np.zeros((n_classes, dim, dim))
+            if activations is not None:
+                activations[indices] = features
+                continue
+            features = features - shift
+            batch_labels = labels[indices]
+            np.add.at(sums, batch_labels, features)
+            for label in np.unique(batch_labels):
+                class_features = features[batch_labels == label]
+                outer_sums[label] += class_features.T @ class_features
+
+        if shift is None:
+            return None, np.zeros_like(labels)
+        if activations is not None:
+            scores = np.empty(len(labels))
+            for label in np.flatnonzero(nonempty):
+                in_class = labels == label
+                scores[in_class] = SpectralSignatureDefense.spectral_signature_scores(
+                    activations[in_class]
+                )[:, 0]
+            return None, self._is_clean(scores, labels, nonempty)
+
+        centered_means = np.zeros_like(sums)
+        centered_means[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+        means = centered_means + shift
+        signatures = np.zeros_like(sums)
+        for label in np.flatnonzero(nonempty):
+            covariance = outer_sums[label] / counts[label] - np.outer(
+                centered_means[label], centered_means[label]
+            )
+            signatures[label] = SpectralSignatureDefense.top_eigenvector(covariance)
 
-        features_split = SpectralSignatureDefense.split_by_class(
-            features_x_poisoned, self.y_train, n_classes
-        )
-        keep_by_class = []
-        for idx, feature in enumerate(features_split):
-            score = SpectralSignatureDefense.spectral_signature_scores(feature)
-            score_cutoff = np.quantile(
-                score, max(1 - self.eps_multiplier * self.ub_pct_poison, 0.0)
+        scores = np.empty(len(labels))
+        for indices, features in self._activation_batches():
+            batch_labels = labels[indices]
+            projections = np.einsum(
+                "ij,ij->i", features - means[batch_labels], signatures[batch_labels]
             )
-            keep_by_class.append(score < score_cutoff)
+            scores[indices] = projections ** 2
 
-        base_indices_by_class = SpectralSignatureDefense.split_by_class(
-            np.arange(self.y_train.shape[0]), self.y_train, 10
-        )
-        is_clean_lst = np.zeros_like(self.y_train, dtype=np.int)
+        return None, self._is_clean(scores, labels, nonempty)
 
-        for keep_booleans, indices in zip(keep_by_class, base_indices_by_class):
-            for keep_boolean, idx in zip(keep_booleans, indices):
-                if keep_boolean:
-                    is_clean_lst[idx] = 1
+    def _is_clean(self, scores, labels, nonempty):
+        """
+        Return whether each score is below the cutoff quantile of the scores of its class
+        """
+        quantile = max(1 - self.eps_multiplier * self.ub_pct_poison, 0.0)
+        is_clean_lst = np.zeros_like(labels)
+        for label in np.flatnonzero(nonempty):
+            in_class = labels == label
+            score_cutoff = np.quantile(scores[in_class], quantile)
+            is_clean_lst[in_class] = scores[in_class] < score_cutoff
+        return is_clean_lst
+
+    def _activation_batches(self):
+        """
+        Yield the indices and last-layer activations of successive batches of x_train
+        """
+        nb_layers = len(self.classifier.layer_names)
+        for start in range(0, len(self.x_train), self.batch_size):
+            indices = np.arange(start, min(start + self.batch_size, len(self.x_train)))
+            features = self.classifier.get_activations(
+                self.x_train[start : indices[-1] + 1],
+                layer=nb_layers - 1,
+                batch_size=self.batch_size,
+            )
+            features = np.asarray(features, dtype=np.float64)
+            yield indices, features.reshape(len(indices), -1)
 
-        return None, is_clean_lst
+    @staticmethod
+    def top_eigenvector(covariance):
+        """
+        :param covariance: Symmetric positive semi-definite matrix
+        :return: Unit eigenvector of its largest eigenvalue
+        """
+        # eigh returns eigenvalues in ascending order. Unlike an iterative method, it is
+        # exact even when the top eigenvalues are close, so scores match those of an SVD.
+        # detect_poison only calls it when dim is at most the mean class size
+        _, eigenvectors = np.linalg.eigh(covariance)
+        return eigenvectors[:, -1]
 
     @staticmethod
     def spectral_signature_scores(R):
@@ -132,10 +214,9 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
         :param num_classes: Number of classes of labels
         :return: List of numpy arrays of features split by labels
         """
-        split = [[] for _ in range(num_classes)]
-        for idx, label in enumerate(labels):
-            split[int(label)].append(data[idx])
-        return [np.asarray(dat) for dat in split]
+        data = np.asarray(data)
+        labels = np.asarray(labels).astype(int)
+        return [data[labels == label] for label in range(num_classes)]
 
     def set_params(self, **kwargs):
         """
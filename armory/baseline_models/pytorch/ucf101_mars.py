@@ -13,7 +13,6 @@ from torch import optim
 
 from MARS.opts import parse_opts
 from MARS.models.model import generate_model
-from MARS.dataset import preprocess_data
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +22,33 @@ MEAN = np.array([114.7748, 107.7354, 99.4750], dtype=np.float32)
 STD = np.array([1, 1, 1], dtype=np.float32)
 
 
+# Frame size of MARS test-time preprocessing, its opt.sample_size
+SAMPLE_SIZE = 112
+
+
+def _scale_crop_frame(frame: np.ndarray) -> Image.Image:
+    """
+    Scale the shorter side of frame to SAMPLE_SIZE and center crop it, as the
+        test-time preprocess_data.scale_crop of MARS does
+    """
+    image = Image.fromarray(frame)
+    width, height = image.size
+    if not (
+        (width <= height and width == SAMPLE_SIZE)
+        or (height <= width and height == SAMPLE_SIZE)
+    ):
+        if width < height:
+            size = (SAMPLE_SIZE, int(SAMPLE_SIZE * height / width))
+        else:
+            size = (int(SAMPLE_SIZE * width / height), SAMPLE_SIZE)
+        image = image.resize(size, Image.BILINEAR)
+
+    width, height = image.size
+    left = int(round((width - SAMPLE_SIZE) / 2.0))
+    top = int(round((height - SAMPLE_SIZE) / 2.0))
+    return image.crop((left, top, left + SAMPLE_SIZE, top + SAMPLE_SIZE))
+
+
 def preprocessing_fn_numpy(batch: np.ndarray):
     """
     batch is a batch of videos, (batch, frames, height, width, channels)
@@ -31,6 +57,10 @@ def preprocessing_fn_numpy(batch: np.ndarray):
     each video to (n_stack, 3, 16, height, width), where n_stack = int(time/16).
 
     Outputs a list of videos, each of shape (n_stack, 3, 16, 112, 112)
+        Videos of 8 to 15 frames have n_stack = 0, so their shape is (0, 3, 16, 112, 112)
+
+    This reproduces the scaling, center cropping, and normalizing of MARS'
+        preprocess_data.scale_crop at test time, only for the frames in stacks
     """
     sample_duration = 16  # expected number of consecutive frames as input to the model
 
@@ -55,22 +85,25 @@ def preprocessing_fn_numpy(batch: np.ndarray):
             x = np.vstack([x, x[: sample_duration - total_frames]])
 
         # apply MARS preprocessing: scaling, cropping, normalizing
-        opt = parse_opts(arguments=[])
-        opt.modality = "RGB"
-        opt.sample_size = 112
-        x_Image = []  # convert each frame to PIL Image
-        for frame in x:
-            x_Image.append(Image.fromarray(frame))
-        x_mars_preprocessed = preprocess_data.scale_crop(x_Image, 0, opt)
-
-        # reshape
-        x_reshaped = []
-        for ns in range(int(total_frames / sample_duration)):
-            np_frames = x_mars_preprocessed[
-                :, ns * sample_duration : (ns + 1) * sample_duration, :, :
-            ].numpy()
-            x_reshaped.append(np_frames)
-        outputs.append(np.array(x_reshaped, dtype=np.float32))
+        n_stack = int(total_frames / sample_duration)
+        frames = np.empty(
+            (n_stack * sample_duration, SAMPLE_SIZE, SAMPLE_SIZE, 3), dtype=np.uint8
+        )
+        for j in range(len(frames)):
+            frames[j] = _scale_crop_frame(x[j])
+
+        # (n_stack, stack_frames, height, width, channel)
+        #     to (n_stack, channel, stack_frames, height, width)
+        frames = frames.reshape((n_stack, sample_duration) + frames.shape[1:])
+        output = np.empty(
+            (n_stack, 3, sample_duration, SAMPLE_SIZE, SAMPLE_SIZE), dtype=np.float32
+        )
+        channel_shape = (3, 1, 1, 1)
+        np.subtract(
+            frames.transpose(0, 4, 1, 2, 3), MEAN.reshape(channel_shape), out=output
+        )
+        output /= STD.reshape(channel_shape)
+        outputs.append(output)
     return outputs
 
 
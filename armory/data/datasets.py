@@ -8,10 +8,13 @@ data is found at '<dataset_dir>/cifar10'
 The 'downloads' subdirectory under <dataset_dir> is reserved for caching.
 """
 
+import hashlib
 import logging
 import json
 import os
+import queue
 import re
+import threading
 from typing import Callable, Union, Tuple, List
 
 import numpy as np
@@ -32,6 +35,7 @@ from armory.data.utils import (
     _read_validate_scenario_config,
     add_checksums_dir,
 )
+from armory.data.preprocessed_cache import PreprocessedCache, function_cache_key
 from armory import paths
 from armory.data.librispeech import librispeech_dev_clean_split  # noqa: F401
 from armory.data.librispeech import librispeech_full as lf  # noqa: F401
@@ -53,12 +57,23 @@ tfds.download.add_checksums_dir(CHECKSUMS_DIR)
 CACHED_CHECKSUMS_DIR = os.path.join(os.path.dirname(__file__), "cached_s3_checksums")
 add_checksums_dir(CACHED_CHECKSUMS_DIR)
 
+# Label index files of dataset splits, used for class filtering
+SPLIT_INDEX_SUBDIR = "split_index"
+# Maximum number of runs of contiguous records to read as separate TFDS split slices
+MAX_SPLIT_RUNS = 100
+
 
 class ArmoryDataGenerator(DataGenerator):
     """
     Returns batches of numpy data.
 
     variable_length - if True, returns a 1D object array of arrays for x.
+    padded - if True, the generator yields (x, x_shapes, y) zero-padded batches, and x
+        is returned as a numpy masked array in which the padding is masked.
+    prefetch_batches - if > 0, batches are built and preprocessed on a background
+        thread, up to prefetch_batches ahead of the consumer. Batch order is unchanged.
+    batches_per_epoch - number of batches in an epoch, if not ceil(size / batch_size),
+        e.g. when each bucket of a bucketed dataset ends with a partial batch
     """
 
     def __init__(
@@ -71,7 +86,10 @@ class ArmoryDataGenerator(DataGenerator):
         label_preprocessing_fn=None,
         variable_length=False,
         variable_y=False,
+        padded=False,
         context=None,
+        prefetch_batches=0,
+        batches_per_epoch=None,
     ):
         super().__init__(size, batch_size)
         self.preprocessing_fn = preprocessing_fn
@@ -81,18 +99,32 @@ class ArmoryDataGenerator(DataGenerator):
         self.epochs = epochs
         self.samples_per_epoch = size
 
-        # drop_remainder is False
-        self.batches_per_epoch = self.samples_per_epoch // batch_size + bool(
-            self.samples_per_epoch % batch_size
-        )
+        if batches_per_epoch is None:
+            # drop_remainder is False
+            batches_per_epoch = self.samples_per_epoch // batch_size + bool(
+                self.samples_per_epoch % batch_size
+            )
+        self.batches_per_epoch = batches_per_epoch
 
         self.variable_length = variable_length
         self.variable_y = variable_y
         if self.variable_length or self.variable_y:
             self.current = 0
+        self.padded = padded
 
         self.context = context
 
+        if not isinstance(prefetch_batches, int) or prefetch_batches < 0:
+            raise ValueError(
+                f"prefetch_batches must be a nonnegative int, not {prefetch_batches}"
+            )
+        self.prefetch_batches = prefetch_batches
+        self._prefetch_queue = None
+        self._prefetch_thread = None
+
+        # Optional armory.utils.instrumentation.Instrumentation timing preprocessing
+        self.instrumentation = None
+
     @staticmethod
     def np_1D_object_array(x_list):
         """
@@ -105,7 +137,52 @@ class ArmoryDataGenerator(DataGenerator):
             x[i] = x_list[i][0]
         return x
 
+    @staticmethod
+    def np_masked_array(x, x_shapes):
+        """
+        Take a zero-padded batch and the unpadded shape of each element and return a
+            numpy masked array in which the padding is masked
+        """
+        mask = np.ones(x.shape, dtype=bool)
+        for i, shape in enumerate(x_shapes):
+            mask[(i,) + tuple(slice(0, n) for n in shape)] = False
+        return np.ma.MaskedArray(x, mask=mask)
+
     def get_batch(self) -> Tuple[np.ndarray, Union[np.ndarray, List]]:
+        if not self.prefetch_batches:
+            return self._build_batch()
+
+        if self._prefetch_thread is None:
+            self._prefetch_queue = queue.Queue(maxsize=self.prefetch_batches)
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch, name="ArmoryDataGenerator-prefetch", daemon=True
+            )
+            self._prefetch_thread.start()
+
+        batch, error = self._prefetch_queue.get()
+        if error is not None:
+            # The producer has stopped, so put the error back for any later calls
+            self._prefetch_queue.put((None, error))
+            raise error
+        return batch
+
+    def _prefetch(self):
+        """
+        Producer loop of the prefetch thread
+
+        A single producer fills a FIFO queue, so batches arrive in generator order.
+        Errors, including the StopIteration at the end of the data, are passed through
+        the queue and raised by get_batch on the consumer side.
+        """
+        while True:
+            try:
+                batch = self._build_batch()
+            except BaseException as e:
+                self._prefetch_queue.put((None, e))
+                return
+            self._prefetch_queue.put((batch, None))
+
+    def _build_batch(self) -> Tuple[np.ndarray, Union[np.ndarray, List]]:
         if self.variable_length or self.variable_y:
             # build the batch
             x_list, y_list = [], []
@@ -151,9 +228,20 @@ class ArmoryDataGenerator(DataGenerator):
                     y = tuple(np.hstack(i) for i in zip(*y_list))
                 else:
                     y = np.hstack(y_list)
+        elif self.padded:
+            x, x_shapes, y = next(self.generator)
+            x = self.np_masked_array(x, x_shapes)
         else:
             x, y = next(self.generator)
 
+        if self.instrumentation is not None and (
+            self.preprocessing_fn or self.label_preprocessing_fn
+        ):
+            with self.instrumentation.stage("preprocessing"):
+                return self._preprocess(x, y)
+        return self._preprocess(x, y)
+
+    def _preprocess(self, x, y):
         if self.label_preprocessing_fn:
             y = self.label_preprocessing_fn(x, y)
 
@@ -272,13 +360,10 @@ def parse_split_index(split: str):
     return "+".join(output_tokens)
 
 
-def filter_by_index(dataset: "tf.data.Dataset", index: list, dataset_size: int):
+def _sorted_index(index: list, dataset_size: int):
     """
-    index must be a list or iterable of integer values
-
-    returns the dataset and the indexed size
+    Validate an index list and return its values sorted and deduplicated
     """
-    logger.info(f"Filtering dataset to the following indices: {index}")
     dataset_size = int(dataset_size)
     sorted_index = sorted([int(x) for x in set(index)])
     if len(sorted_index) == 0:
@@ -289,6 +374,17 @@ def filter_by_index(dataset: "tf.data.Dataset", index: list, dataset_size: int):
         raise ValueError(
             f"The specified dataset 'index' values exceed dataset size {dataset_size}"
         )
+    return sorted_index
+
+
+def filter_by_index(dataset: "tf.data.Dataset", index: list, dataset_size: int):
+    """
+    index must be a list or iterable of integer values
+
+    returns the dataset and the indexed size
+    """
+    logger.info(f"Filtering dataset to the following indices: {index}")
+    sorted_index = _sorted_index(index, dataset_size)
     num_valid_indices = len(sorted_index)
 
     index_tensor = tf.constant(sorted_index, dtype=tf.int64)
@@ -354,9 +450,9 @@ def parse_str_slice(index: str):
     return lower, upper
 
 
-def filter_by_str_slice(dataset: "tf.data.Dataset", index: str, dataset_size: int):
+def _str_slice_bounds(index: str, dataset_size: int):
     """
-    returns the dataset and the indexed size
+    Parse a string slice and return its (lower, upper) bounds within the dataset
     """
     lower, upper = parse_str_slice(index)
     if lower is None:
@@ -367,6 +463,14 @@ def filter_by_str_slice(dataset: "tf.data.Dataset", index: str, dataset_size: in
         raise ValueError(f"lower {lower} must be less than dataset_size {dataset_size}")
     if upper > dataset_size:
         upper = dataset_size
+    return lower, upper
+
+
+def filter_by_str_slice(dataset: "tf.data.Dataset", index: str, dataset_size: int):
+    """
+    returns the dataset and the indexed size
+    """
+    lower, upper = _str_slice_bounds(index, dataset_size)
     indexed_size = upper - lower
 
     def slice_index(i, x):
@@ -375,6 +479,107 @@ def filter_by_str_slice(dataset: "tf.data.Dataset", index: str, dataset_size: in
     return dataset.enumerate().filter(slice_index).map(lambda i, x: x), indexed_size
 
 
+def _split_labels(
+    dataset: "tf.data.Dataset",
+    dataset_dir: str,
+    dataset_name: str,
+    split: str,
+    as_supervised: bool,
+    supervised_xy_keys,
+    lambda_map: Callable,
+    graph=None,
+):
+    """
+    Return an array of the label of each record in the split, or None if the labels are
+    not integer scalars
+
+    The labels are read from a sidecar file under dataset_dir. If it does not exist yet,
+    it is written after reading the labels from the whole split once.
+    """
+    element_spec = dataset.element_spec
+    if not (isinstance(element_spec, tuple) and len(element_spec) == 2):
+        return None
+    y_spec = element_spec[1]
+    if not (
+        isinstance(y_spec, tf.TensorSpec)
+        and y_spec.shape.rank == 0
+        and y_spec.dtype.is_integer
+    ):
+        return None
+    lambda_map_key = function_cache_key(lambda_map)
+    if lambda_map is not None and lambda_map_key is None:
+        return None
+
+    config = {
+        "dataset_name": dataset_name,
+        "split": split,
+        "as_supervised": as_supervised,
+        "supervised_xy_keys": supervised_xy_keys,
+        "lambda_map": lambda_map_key,
+    }
+    key = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(dataset_dir, SPLIT_INDEX_SUBDIR, f"{key}.npy")
+    if os.path.isfile(path):
+        return np.load(path)
+
+    logger.info(
+        f"Indexing the labels of {dataset_name} split {split}. This reads the whole "
+        "split once"
+    )
+    label_batches = tfds.as_numpy(dataset.map(lambda x, y: y).batch(4096), graph=graph)
+    labels = np.concatenate([np.zeros(0, dtype=np.int64)] + list(label_batches))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+    np.save(tmp_path, labels.astype(np.int64))
+    os.replace(tmp_path, path)
+    return labels
+
+
+def _select_records(
+    dataset_size: int, labels: np.ndarray = None, class_ids=None, index=None
+):
+    """
+    Return the sorted positions in the split of the records kept by class_ids and index
+
+    Matches filter_by_class followed by filter_by_index or filter_by_str_slice
+    labels - the label of each record, required if class_ids is not None
+    """
+    selected = np.arange(int(dataset_size))
+    if class_ids is not None:
+        logger.info(f"Filtering dataset to the following class IDs: {class_ids}")
+        if len(class_ids) == 0:
+            raise ValueError(
+                "The specified dataset 'class_ids' param must have at least one value"
+            )
+        selected = selected[np.isin(labels, class_ids)]
+        if len(selected) == 0:
+            raise ValueError(
+                "All elements of dataset were removed. Please ensure the specified class_ids appear in the dataset"
+            )
+
+    if isinstance(index, list):
+        logger.info(f"Filtering dataset to the following indices: {index}")
+        selected = selected[_sorted_index(index, len(selected))]
+    elif isinstance(index, str):
+        lower, upper = _str_slice_bounds(index, len(selected))
+        selected = selected[lower:upper]
+    return selected
+
+
+def _split_from_records(split: str, selected: np.ndarray):
+    """
+    Return a list of TFDS split slices which together read the selected records in order
+
+    Each slice covers one contiguous run of records. TFDS skips the shards that hold
+    none of them, using the per-shard record counts in the dataset info.
+    """
+    run_starts = np.flatnonzero(np.diff(selected) != 1) + 1
+    starts = selected[np.concatenate([[0], run_starts])]
+    stops = selected[np.concatenate([run_starts - 1, [len(selected) - 1]])] + 1
+    return [f"{split}[{start}:{stop}]" for start, stop in zip(starts, stops)]
+
+
 def _generator_from_tfds(
     dataset_name: str,
     split: str,
@@ -395,6 +600,10 @@ def _generator_from_tfds(
     context=None,
     class_ids=None,
     index=None,
+    prefetch_batches: int = 0,
+    preprocessed_cache: bool = False,
+    padded_batches: bool = False,
+    bucket_boundaries: list = None,
 ) -> Union[ArmoryDataGenerator, tf.data.Dataset]:
     """
     If as_supervised=False, must designate keys as a tuple in supervised_xy_keys:
@@ -403,10 +612,44 @@ def _generator_from_tfds(
     if variable_length=True and batch_size > 1:
         output batches are 1D np.arrays of objects
     lambda_map - if not None, mapping function to apply to dataset elements
+    prefetch_batches - if > 0, number of numpy batches to prepare in the background
+    preprocessed_cache - if True, cache the preprocessed samples under dataset_dir and
+        load them from there in later runs with the same configuration
+    padded_batches - if True and variable_length=True, output batches are zero-padded
+        dense arrays instead, returned as numpy masked arrays for the numpy framework
+    bucket_boundaries - if not None with padded_batches, group elements into buckets
+        by length before batching so that batches need less padding
     """
     if not dataset_dir:
         dataset_dir = paths.runtime_paths().dataset_dir
 
+    cache = None
+    if preprocessed_cache:
+        cache = _preprocessed_cache(
+            dataset_dir,
+            dataset_name=dataset_name,
+            split=split,
+            as_supervised=as_supervised,
+            supervised_xy_keys=supervised_xy_keys,
+            shuffle_files=shuffle_files,
+            framework=framework,
+            preprocessing_fn=preprocessing_fn,
+            label_preprocessing_fn=label_preprocessing_fn,
+            lambda_map=lambda_map,
+            class_ids=class_ids,
+            index=index,
+        )
+    if cache is not None and cache.is_complete():
+        logger.info(f"Loading preprocessed {dataset_name} from {cache.path}")
+        return ArmoryDataGenerator(
+            cache.batches(batch_size, epochs),
+            size=cache.size(),
+            batch_size=batch_size,
+            epochs=epochs,
+            context=context,
+            prefetch_batches=prefetch_batches,
+        )
+
     if cache_dataset:
         _cache_dataset(
             dataset_dir, dataset_name=dataset_name,
@@ -417,103 +660,143 @@ def _generator_from_tfds(
     if not isinstance(split, str):
         raise ValueError(f"split must be str, not {type(split)}")
 
-    try:
-        ds, ds_info = tfds.load(
-            dataset_name,
-            split=split,
-            as_supervised=as_supervised,
-            data_dir=dataset_dir,
-            with_info=True,
-            download_and_prepare_kwargs=download_and_prepare_kwargs,
-            shuffle_files=shuffle_files,
-        )
-    except AssertionError as e:
-        if not str(e).startswith("Unrecognized instruction format: "):
-            raise
-        logger.warning(f"Caught AssertionError in TFDS load split argument: {e}")
-        logger.warning(f"Attempting to parse split {split}")
-        split = parse_split_index(split)
-        logger.warning(f"Replacing split with {split}")
-        ds, ds_info = tfds.load(
-            dataset_name,
-            split=split,
-            as_supervised=as_supervised,
-            data_dir=dataset_dir,
-            with_info=True,
-            download_and_prepare_kwargs=download_and_prepare_kwargs,
-            shuffle_files=shuffle_files,
-        )
-
-    if not as_supervised:
+    def load(split):
         try:
-            x_key, y_key = supervised_xy_keys
-        except (TypeError, ValueError):
-            raise ValueError(
-                f"When as_supervised=False, supervised_xy_keys must be a (x_key, y_key)"
-                f" tuple, not {supervised_xy_keys}"
+            ds, ds_info = tfds.load(
+                dataset_name,
+                split=split,
+                as_supervised=as_supervised,
+                data_dir=dataset_dir,
+                with_info=True,
+                download_and_prepare_kwargs=download_and_prepare_kwargs,
+                shuffle_files=shuffle_files,
             )
-        for key in [x_key, y_key]:
-            if not (isinstance(key, str) or isinstance(key, tuple)):
-                raise ValueError(
-                    f"supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
-                    f" not {type(x_key), type(y_key)}"
-                )
-        if isinstance(x_key, tuple):
-            if isinstance(y_key, tuple):
+        except AssertionError as e:
+            if not str(e).startswith("Unrecognized instruction format: "):
+                raise
+            logger.warning(f"Caught AssertionError in TFDS load split argument: {e}")
+            logger.warning(f"Attempting to parse split {split}")
+            split = parse_split_index(split)
+            logger.warning(f"Replacing split with {split}")
+            ds, ds_info = tfds.load(
+                dataset_name,
+                split=split,
+                as_supervised=as_supervised,
+                data_dir=dataset_dir,
+                with_info=True,
+                download_and_prepare_kwargs=download_and_prepare_kwargs,
+                shuffle_files=shuffle_files,
+            )
+
+        if not as_supervised:
+            try:
+                x_key, y_key = supervised_xy_keys
+            except (TypeError, ValueError):
                 raise ValueError(
-                    "Only one of (x_key, y_key) can be a tuple while the other must be a string."
+                    f"When as_supervised=False, supervised_xy_keys must be a (x_key, y_key)"
+                    f" tuple, not {supervised_xy_keys}"
                 )
-            for k in x_key:
-                if not (isinstance(k, str)):
+            for key in [x_key, y_key]:
+                if not (isinstance(key, str) or isinstance(key, tuple)):
                     raise ValueError(
-                        "supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
+                        f"supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
+                        f" not {type(x_key), type(y_key)}"
                     )
-            ds = ds.map(lambda x: (tuple(x[k] for k in x_key), x[y_key]))
-        elif isinstance(y_key, tuple):
-            for k in y_key:
-                if not (isinstance(k, str)):
+            if isinstance(x_key, tuple):
+                if isinstance(y_key, tuple):
                     raise ValueError(
-                        "supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
+                        "Only one of (x_key, y_key) can be a tuple while the other must be a string."
                     )
-            ds = ds.map(lambda x: (x[x_key], tuple(x[k] for k in y_key)))
-        else:
-            ds = ds.map(lambda x: (x[x_key], x[y_key]))
-    if lambda_map is not None:
-        ds = ds.map(lambda_map)
+                for k in x_key:
+                    if not (isinstance(k, str)):
+                        raise ValueError(
+                            "supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
+                        )
+                ds = ds.map(lambda x: (tuple(x[k] for k in x_key), x[y_key]))
+            elif isinstance(y_key, tuple):
+                for k in y_key:
+                    if not (isinstance(k, str)):
+                        raise ValueError(
+                            "supervised_xy_keys must be a tuple of strings or a tuple of tuple of strings"
+                        )
+                ds = ds.map(lambda x: (x[x_key], tuple(x[k] for k in y_key)))
+            else:
+                ds = ds.map(lambda x: (x[x_key], x[y_key]))
+        if lambda_map is not None:
+            ds = ds.map(lambda_map)
+        return ds, ds_info, split
+
+    ds, ds_info, split = load(split)
 
     dataset_size = ds_info.splits[split].num_examples
 
-    # Add class-based filtering
-    if class_ids is not None:
-        if split == "train":
-            logger.warning(
-                "Filtering by class entails iterating over the whole dataset and thus "
-                "can be very slow if using the 'train' split"
+    if isinstance(class_ids, int):
+        class_ids = [class_ids]
+    elif class_ids is not None and not isinstance(class_ids, list):
+        raise ValueError(
+            f"class_ids must be a list, int, or None, not {type(class_ids)}"
+        )
+    if index is not None and not isinstance(index, (list, str)):
+        raise ValueError(f"index must be a list, str, or None, not {type(index)}")
+
+    # Read only the selected records of the split if they can be determined up front
+    selected = None
+    if (class_ids is not None or index is not None) and (
+        not shuffle_files and re.match(r"^\w+$", split)
+    ):
+        labels = None
+        if class_ids is not None:
+            labels = _split_labels(
+                ds,
+                dataset_dir,
+                dataset_name=dataset_name,
+                split=split,
+                as_supervised=as_supervised,
+                supervised_xy_keys=supervised_xy_keys,
+                lambda_map=lambda_map,
+                graph=default_graph,
             )
-        if isinstance(class_ids, list):
-            ds, dataset_size = filter_by_class(ds, class_ids=class_ids)
-        elif isinstance(class_ids, int):
-            ds, dataset_size = filter_by_class(ds, class_ids=[class_ids])
+        if class_ids is None or (labels is not None and len(labels) == dataset_size):
+            selected = _select_records(dataset_size, labels, class_ids, index)
+
+    if selected is not None:
+        run_splits = _split_from_records(split, selected)
+        if len(run_splits) <= MAX_SPLIT_RUNS:
+            ds, _, _ = load("+".join(run_splits))
         else:
-            raise ValueError(
-                f"class_ids must be a list, int, or None, not {type(class_ids)}"
-            )
+            # Read the range that covers the selected records and filter within it
+            first, last = int(selected[0]), int(selected[-1]) + 1
+            ds, _, _ = load(f"{split}[{first}:{last}]")
+            ds, _ = filter_by_index(ds, (selected - first).tolist(), last - first)
+        dataset_size = len(selected)
+    else:
+        # Add class-based filtering
+        if class_ids is not None:
+            if split == "train":
+                logger.warning(
+                    "Filtering by class entails iterating over the whole dataset and thus "
+                    "can be very slow if using the 'train' split"
+                )
+            ds, dataset_size = filter_by_class(ds, class_ids=class_ids)
 
-    # Add index-based filtering
-    if isinstance(index, list):
-        ds, dataset_size = filter_by_index(ds, index, dataset_size)
-    elif isinstance(index, str):
-        ds, dataset_size = filter_by_str_slice(ds, index, dataset_size)
-    elif index is not None:
-        raise ValueError(f"index must be a list, str, or None, not {type(index)}")
+        # Add index-based filtering
+        if isinstance(index, list):
+            ds, dataset_size = filter_by_index(ds, index, dataset_size)
+        elif isinstance(index, str):
+            ds, dataset_size = filter_by_str_slice(ds, index, dataset_size)
 
-    ds = ds.repeat(epochs)
-    if shuffle_files:
-        ds = ds.shuffle(batch_size * 10, reshuffle_each_iteration=True)
-    if variable_length or variable_y and batch_size > 1:
-        ds = ds.batch(1, drop_remainder=False)
-    else:
-        ds = ds.batch(batch_size, drop_remainder=False)
+    padded = bool(padded_batches and batch_size > 1)
+    ds, batches_per_epoch = _batch_dataset(
+        ds,
+        batch_size,
+        epochs,
+        shuffle_files=shuffle_files,
+        variable_length=variable_length,
+        variable_y=variable_y,
+        padded=padded,
+        bucket_boundaries=bucket_boundaries,
+        graph=default_graph,
+    )
     ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
 
     if framework != "numpy" and (
@@ -522,6 +805,10 @@ def _generator_from_tfds(
         raise ValueError(
             f"Data/label preprocessing functions only supported for numpy framework.  Selected {framework} framework"
         )
+    if framework != "numpy" and prefetch_batches:
+        raise ValueError(
+            f"prefetch_batches only supported for numpy framework.  Selected {framework} framework"
+        )
 
     if framework == "numpy":
         ds = tfds.as_numpy(ds, graph=default_graph)
@@ -532,10 +819,23 @@ def _generator_from_tfds(
             epochs=epochs,
             preprocessing_fn=preprocessing_fn,
             label_preprocessing_fn=label_preprocessing_fn,
-            variable_length=bool(variable_length and batch_size > 1),
+            variable_length=bool(variable_length and batch_size > 1 and not padded),
             variable_y=bool(variable_y and batch_size > 1),
+            padded=padded,
             context=context,
+            prefetch_batches=0 if cache is not None else prefetch_batches,
+            batches_per_epoch=batches_per_epoch,
         )
+        if cache is not None:
+            generator = ArmoryDataGenerator(
+                cache.record(generator, dataset_size),
+                size=dataset_size,
+                batch_size=batch_size,
+                epochs=epochs,
+                context=context,
+                prefetch_batches=prefetch_batches,
+                batches_per_epoch=batches_per_epoch,
+            )
 
     elif framework == "tf":
         generator = ds
@@ -554,6 +854,126 @@ def _generator_from_tfds(
     return generator
 
 
+def _batch_dataset(
+    dataset: "tf.data.Dataset",
+    batch_size: int,
+    epochs: int,
+    shuffle_files: bool,
+    variable_length: bool,
+    variable_y: bool,
+    padded: bool,
+    bucket_boundaries: list = None,
+    graph=None,
+):
+    """
+    Repeat, shuffle, and batch dataset for the given number of epochs
+
+    Return the batched dataset and its number of batches per epoch, or None if that is
+        the number of batches of batch_size elements. Bucketed datasets are bucketed
+        one epoch at a time, so that no batch mixes elements of different epochs, and
+        each bucket ends an epoch with its own partial batch.
+    """
+    if padded and (not variable_length or variable_y):
+        raise ValueError(
+            "padded_batches is only supported for datasets with variable length x"
+            " and fixed size y"
+        )
+    if padded and bucket_boundaries:
+        batches_per_epoch = _bucketed_batch_count(
+            dataset, batch_size, bucket_boundaries, graph=graph
+        )
+        if shuffle_files:
+            dataset = dataset.shuffle(batch_size * 10, reshuffle_each_iteration=True)
+        dataset = _padded_batch(
+            dataset, batch_size, bucket_boundaries=bucket_boundaries
+        )
+        return dataset.repeat(epochs), batches_per_epoch
+
+    dataset = dataset.repeat(epochs)
+    if shuffle_files:
+        dataset = dataset.shuffle(batch_size * 10, reshuffle_each_iteration=True)
+    if padded:
+        dataset = _padded_batch(dataset, batch_size)
+    elif variable_length or variable_y and batch_size > 1:
+        dataset = dataset.batch(1, drop_remainder=False)
+    else:
+        dataset = dataset.batch(batch_size, drop_remainder=False)
+    return dataset, None
+
+
+def _bucketed_batch_count(
+    dataset: "tf.data.Dataset", batch_size: int, bucket_boundaries: list, graph=None
+) -> int:
+    """
+    Return the number of batches in one epoch of dataset batched by _padded_batch with
+        bucket_boundaries
+
+    This reads the length of every element once, as it depends on the number of
+        elements in each bucket.
+    """
+    logger.info("Counting the elements of each length bucket. This reads the dataset")
+    length_batches = tfds.as_numpy(
+        dataset.map(lambda x, y: tf.shape(x)[0]).batch(4096), graph=graph
+    )
+    lengths = np.concatenate([np.zeros(0, dtype=np.int64)] + list(length_batches))
+    buckets = np.searchsorted(np.asarray(bucket_boundaries), lengths, side="right")
+    bucket_sizes = np.bincount(buckets, minlength=len(bucket_boundaries) + 1)
+    return int(np.sum(-(-bucket_sizes // batch_size)))
+
+
+def _padded_batch(
+    dataset: "tf.data.Dataset", batch_size: int, bucket_boundaries: list = None
+):
+    """
+    Batch (x, y) elements with variable length x into (x, x_shapes, y) batches, where x
+        is padded with zeros and x_shapes holds the unpadded shape of each x
+
+    If bucket_boundaries is not None, elements are grouped by the length of x into the
+        buckets [0, b_0), [b_0, b_1), ..., [b_n, inf) and each batch is drawn from a
+        single bucket. This changes the order of elements, but deterministically.
+    """
+    if not isinstance(dataset.element_spec[0], tf.TensorSpec):
+        raise ValueError("padded_batches requires x to be a single tensor")
+    dataset = dataset.map(lambda x, y: (x, tf.shape(x), y))
+    if not bucket_boundaries:
+        return dataset.padded_batch(batch_size)
+
+    return dataset.apply(
+        tf.data.experimental.bucket_by_sequence_length(
+            lambda x, x_shape, y: x_shape[0],
+            bucket_boundaries=list(bucket_boundaries),
+            bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+        )
+    )
+
+
+def unpad_batch(batch, padded_batch=None):
+    """
+    Return the samples of a padded batch as a 1D object array of unpadded arrays
+
+    padded_batch - masked array with the padding masked, if not batch itself. This
+        allows unpadding a batch that was computed from a padded batch without its mask,
+        such as an adversarial batch.
+    If padded_batch is not a masked array, batch is returned unchanged.
+    """
+    if padded_batch is None:
+        padded_batch = batch
+    if not isinstance(padded_batch, np.ma.MaskedArray):
+        return batch
+
+    mask = np.ma.getmaskarray(padded_batch)
+    data = np.ma.getdata(batch)
+    samples = np.empty((len(data),), dtype=object)
+    for i in range(len(data)):
+        unmasked = ~mask[i]
+        shape = [
+            unmasked.any(axis=tuple(a for a in range(unmasked.ndim) if a != axis)).sum()
+            for axis in range(unmasked.ndim)
+        ]
+        samples[i] = data[i][tuple(slice(0, n) for n in shape)]
+    return samples
+
+
 def preprocessing_chain(*args):
     """
     Wraps and returns a sequence of functions
@@ -567,6 +987,8 @@ def preprocessing_chain(*args):
             x = function(x)
         return x
 
+    # Allows the chain to be identified by the preprocessed dataset cache
+    wrapped.preprocessing_chain = functions
     return wrapped
 
 
@@ -610,21 +1032,51 @@ class VideoContext(ImageContext):
         self.frame_rate = frame_rate
 
 
-def canonical_image_preprocess(context, batch):
-    check_shapes(batch.shape, (None,) + context.x_shape)
-    if batch.dtype != context.input_type:
-        raise ValueError("input batch dtype {batch.dtype} != {context.input_type}")
-    assert batch.min() >= context.input_min
-    assert batch.max() <= context.input_max
+def _canonical_quantize(context, x):
+    """
+    Check that x is within the input range of context, and return it quantized
 
-    batch = batch.astype(context.output_type) / context.quantization
+    Input ranges are only scanned where the dtype of x can exceed them, and the
+        output range follows from the input range. x is cast and divided in a single
+        pass, so that the output is the only array allocated.
+    """
+    if np.issubdtype(x.dtype, np.integer):
+        dtype_info = np.iinfo(x.dtype)
+        check_min = dtype_info.min < context.input_min
+        check_max = dtype_info.max > context.input_max
+    else:
+        check_min = check_max = True
+    if x.size:
+        if check_min:
+            assert x.min() >= context.input_min
+        if check_max:
+            assert x.max() <= context.input_max
+
+    output_range = (
+        np.array([context.input_min, context.input_max], dtype=context.output_type)
+        / context.quantization
+    )
+    assert output_range[0] >= context.output_min
+    assert output_range[1] <= context.output_max
+
+    data = np.ma.getdata(x)
+    output = np.true_divide(
+        data,
+        context.quantization,
+        out=np.empty(data.shape, dtype=context.output_type),
+        dtype=context.output_type,
+    )
+    if isinstance(x, np.ma.MaskedArray):
+        # e.g. padded batches
+        output = np.ma.MaskedArray(output, mask=np.ma.getmaskarray(x).copy())
+    return output
 
-    if batch.dtype != context.output_type:
-        raise ValueError("output batch dtype {batch.dtype} != {context.output_type}")
-    assert batch.min() >= context.output_min
-    assert batch.max() <= context.output_max
 
-    return batch
+def canonical_image_preprocess(context, batch):
+    check_shapes(batch.shape, (None,) + context.x_shape)
+    if batch.dtype != context.input_type:
+        raise ValueError(f"input batch dtype {batch.dtype} != {context.input_type}")
+    return _canonical_quantize(context, batch)
 
 
 def canonical_variable_image_preprocess(context, batch):
@@ -635,34 +1087,19 @@ def canonical_variable_image_preprocess(context, batch):
         for x in batch:
             check_shapes(x.shape, context.x_shape)
             assert x.dtype == context.input_type
-            assert x.min() >= context.input_min
-            assert x.max() <= context.input_max
 
         quantized_batch = np.zeros_like(batch, dtype=np.object)
         for i in range(len(batch)):
-            quantized_batch[i] = (
-                batch[i].astype(context.output_type) / context.quantization
-            )
-        batch = quantized_batch
+            quantized_batch[i] = _canonical_quantize(context, batch[i])
+        return quantized_batch
     elif batch.dtype == context.input_type:
         check_shapes(batch.shape, (None,) + context.x_shape)
-        assert batch.dtype == context.input_type
-        assert batch.min() >= context.input_min
-        assert batch.max() <= context.input_max
-
-        batch = batch.astype(context.output_type) / context.quantization
+        return _canonical_quantize(context, batch)
     else:
         raise ValueError(
             f"input dtype {batch.dtype} not in ({context.input_type}, 'O')"
         )
 
-    for x in batch:
-        assert x.dtype == context.output_type
-        assert x.min() >= context.output_min
-        assert x.max() <= context.output_max
-
-    return batch
-
 
 mnist_context = ImageContext(x_shape=(28, 28, 1))
 cifar10_context = ImageContext(x_shape=(32, 32, 3))
@@ -746,32 +1183,12 @@ def canonical_audio_preprocess(context, batch):
         for x in batch:
             check_shapes(x.shape, context.x_shape)
             assert x.dtype == context.input_type
-            assert x.min() >= context.input_min
-            assert x.max() <= context.input_max
 
-        batch = np.array(
-            [x.astype(context.output_type) / context.quantization for x in batch],
-            dtype=object,
-        )
-
-        for x in batch:
-            assert x.dtype == context.output_type
-            assert x.min() >= context.output_min
-            assert x.max() <= context.output_max
-        return batch
+        return np.array([_canonical_quantize(context, x) for x in batch], dtype=object)
 
     check_shapes(batch.shape, (None,) + context.x_shape)
     assert batch.dtype == context.input_type
-    assert batch.min() >= context.input_min
-    assert batch.max() <= context.input_max
-
-    batch = batch.astype(context.output_type) / context.quantization  # 2**15
-
-    assert batch.dtype == context.output_type
-    assert batch.min() >= context.output_min
-    assert batch.max() <= context.output_max
-
-    return batch
+    return _canonical_quantize(context, batch)
 
 
 digit_context = AudioContext(x_shape=(None,), sample_rate=8000)
@@ -1727,6 +2144,50 @@ def _cache_dataset(dataset_dir: str, dataset_name: str):
         )
 
 
+def _preprocessed_cache(
+    dataset_dir: str,
+    dataset_name: str,
+    split: str,
+    shuffle_files: bool,
+    framework: str,
+    preprocessing_fn: Callable,
+    label_preprocessing_fn: Callable,
+    lambda_map: Callable,
+    **config,
+):
+    """
+    Return the PreprocessedCache for a dataset configuration, or None if it cannot be cached
+    """
+    if framework != "numpy":
+        logger.warning(
+            f"Not caching preprocessed dataset: framework {framework} is not numpy"
+        )
+        return None
+    if shuffle_files:
+        logger.warning("Not caching preprocessed dataset: shuffle_files is True")
+        return None
+
+    for name, function in [
+        ("preprocessing_fn", preprocessing_fn),
+        ("label_preprocessing_fn", label_preprocessing_fn),
+        ("lambda_map", lambda_map),
+    ]:
+        config[name] = function_cache_key(function)
+        if function is not None and config[name] is None:
+            logger.warning(
+                f"Not caching preprocessed dataset: {name} {function} cannot be "
+                "identified across runs"
+            )
+            return None
+
+    config.update(dataset_name=dataset_name, split=split)
+    try:
+        return PreprocessedCache(dataset_dir, config)
+    except TypeError as e:
+        logger.warning(f"Not caching preprocessed dataset: {e}")
+        return None
+
+
 def _parse_dataset_name(dataset_name: str):
     try:
         name_config, version = dataset_name.split(":")
@@ -0,0 +1,244 @@
+"""
+On-disk cache of preprocessed numpy datasets
+
+Each cache entry resides in its own subdirectory under <dataset_dir>/preprocessed_cache
+named after a hash of everything that determines the preprocessed samples: the dataset,
+split, filters, and the preprocessing functions. It holds the preprocessed x and y of one
+epoch as .npy files, which later runs memory-map so that batches are views into them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import types
+
+import numpy as np
+
+from armory import __version__
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUBDIR = "preprocessed_cache"
+METADATA_FILE = "metadata.json"
+
+# Closure and default argument values that can be part of a function's cache key
+SIMPLE_TYPES = (str, int, float, bool, type(None))
+
+
+def function_cache_key(function):
+    """
+    Return a JSON-serializable description of function, or None if it cannot be
+    identified across runs
+
+    Functions are identified by name, by their code, and by their default argument
+    values, so that editing a function invalidates the cache entries made with it.
+    Nested functions and lambdas are also identified by the values they close over.
+    Default and closure values must be simple values or functions that can themselves
+    be identified. Functions wrapped by datasets.preprocessing_chain are identified by
+    the chain. Functions called by function are not part of its key.
+    """
+    if function is None:
+        return None
+
+    chain = getattr(function, "preprocessing_chain", None)
+    if chain is not None:
+        keys = [function_cache_key(f) for f in chain]
+        if any(k is None for k in keys):
+            return None
+        return {"chain": keys}
+
+    if not isinstance(function, types.FunctionType):
+        return None
+    key = {"function": f"{function.__module__}.{function.__qualname__}"}
+    code = function.__code__
+    if "<" in function.__qualname__:
+        key["line"] = code.co_firstlineno
+    key["code"] = _code_digest(code)
+    values = list(function.__defaults__ or ())
+    kwdefaults = function.__kwdefaults__ or {}
+    values += [kwdefaults[name] for name in sorted(kwdefaults)]
+    values += [cell.cell_contents for cell in function.__closure__ or ()]
+    key["values"] = []
+    for value in values:
+        if isinstance(value, types.FunctionType):
+            value = function_cache_key(value)
+            if value is None:
+                return None
+        elif isinstance(value, (tuple, list)):
+            if not all(isinstance(v, SIMPLE_TYPES) for v in value):
+                return None
+            value = list(value)
+        elif not isinstance(value, SIMPLE_TYPES):
+            return None
+        key["values"].append(value)
+    return key
+
+
+def _code_digest(code):
+    """
+    Return a hash of the bytecode, constants, and referenced names of a code object,
+    including those of the code objects nested in it
+    """
+    sha256 = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = _code_digest(const)
+        elif isinstance(const, frozenset):
+            # The iteration order of a set of strings varies between runs
+            const = sorted(repr(c) for c in const)
+        sha256.update(repr(const).encode())
+    sha256.update(repr(code.co_names).encode())
+    return sha256.hexdigest()
+
+
+class PreprocessedCache:
+    """
+    A single cache entry, keyed on the dataset configuration
+
+    config - JSON-serializable dict with everything that determines the samples
+    """
+
+    def __init__(self, dataset_dir: str, config: dict):
+        self.config = dict(config, armory_version=__version__)
+        self.key = hashlib.sha256(
+            json.dumps(self.config, sort_keys=True).encode()
+        ).hexdigest()
+        self.path = os.path.join(dataset_dir, CACHE_SUBDIR, self.key)
+
+    def is_complete(self) -> bool:
+        return os.path.isfile(os.path.join(self.path, METADATA_FILE))
+
+    def size(self) -> int:
+        with open(os.path.join(self.path, METADATA_FILE)) as f:
+            return json.load(f)["size"]
+
+    def load(self):
+        """
+        Return memory-mapped x and y arrays
+
+        Arrays are mapped copy-on-write, so in-place modification of a batch does not
+        affect the cache on disk
+        """
+        x = np.load(os.path.join(self.path, "x.npy"), mmap_mode="c")
+        y = np.load(os.path.join(self.path, "y.npy"), mmap_mode="c")
+        return x, y
+
+    def batches(self, batch_size: int, epochs: int):
+        """
+        Yield (x, y) batches from the cache
+
+        As with batching a repeated tf.data.Dataset, batches are filled across epoch
+        boundaries. Only those batches are copied, the others are views into the cache.
+        """
+        x, y = self.load()
+        size = len(x)
+        total = size * epochs
+        for start in range(0, total, batch_size):
+            stop = min(start + batch_size, total)
+            yield _take(x, start, stop), _take(y, start, stop)
+
+    def record(self, generator, size: int):
+        """
+        Yield the batches of generator, writing the samples of the first epoch to the cache
+
+        generator - iterable of preprocessed (x, y) batches
+        size - number of samples in an epoch
+
+        If a batch cannot be stored, a warning is logged and the batches are only passed
+        through. The cache entry is only made visible once the whole epoch is written.
+        """
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        recording = True
+        arrays = None
+        offset = 0
+        try:
+            for x, y in generator:
+                if recording:
+                    if arrays is None:
+                        arrays = self._allocate(tmp_path, x, y, size)
+                        recording = arrays is not None
+                    if recording:
+                        offset = self._write(arrays, x, y, offset, size)
+                        recording = offset is not None
+                    if recording and offset == size:
+                        self._finalize(tmp_path, arrays, size)
+                        recording = False
+                    elif not recording:
+                        shutil.rmtree(tmp_path, ignore_errors=True)
+                yield x, y
+        finally:
+            if recording:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _allocate(self, tmp_path, x, y, size):
+        for name, array in ("x", x), ("y", y):
+            if (
+                not isinstance(array, np.ndarray)
+                or isinstance(array, np.ma.MaskedArray)
+                or array.dtype == object
+            ):
+                logger.warning(
+                    f"Not caching preprocessed dataset: {name} batches are of type "
+                    f"{type(array)} rather than fixed-shape numpy arrays"
+                )
+                return None
+
+        os.makedirs(tmp_path, exist_ok=True)
+        return tuple(
+            np.lib.format.open_memmap(
+                os.path.join(tmp_path, f"{name}.npy"),
+                mode="w+",
+                dtype=array.dtype,
+                shape=(size,) + array.shape[1:],
+            )
+            for name, array in (("x", x), ("y", y))
+        )
+
+    def _write(self, arrays, x, y, offset, size):
+        """
+        Write a batch at offset, returning the new offset or None on failure
+        """
+        for name, array, target in ("x", x, arrays[0]), ("y", y, arrays[1]):
+            if (
+                not isinstance(array, np.ndarray)
+                or array.dtype != target.dtype
+                or array.shape[1:] != target.shape[1:]
+            ):
+                logger.warning(
+                    f"Not caching preprocessed dataset: {name} batches vary in shape or dtype"
+                )
+                return None
+
+        # The last batch of an epoch may extend into the next epoch
+        num_samples = min(len(x), size - offset)
+        arrays[0][offset : offset + num_samples] = x[:num_samples]
+        arrays[1][offset : offset + num_samples] = y[:num_samples]
+        return offset + num_samples
+
+    def _finalize(self, tmp_path, arrays, size):
+        for array in arrays:
+            array.flush()
+        with open(os.path.join(tmp_path, METADATA_FILE), "w") as f:
+            json.dump({"config": self.config, "size": size}, f, sort_keys=True)
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # Another run completed the same cache entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            logger.info(f"Cached preprocessed dataset to {self.path}")
+
+
+def _take(array, start, stop):
+    """
+    Return samples start to stop of array repeated end to end
+    """
+    size = len(array)
+    first_epoch, last_epoch = start // size, (stop - 1) // size
+    if first_epoch == last_epoch:
+        return array[start - first_epoch * size : stop - first_epoch * size]
+
+    indices = np.arange(start, stop) % size
+    return array[indices]
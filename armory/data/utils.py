@@ -11,6 +11,7 @@ import random
 import string
 import json
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore import UNSIGNED
@@ -27,6 +28,10 @@ logger = logging.getLogger(__name__)
 
 CHECKSUMS_DIRS = []
 
+# Parallel HTTP Range downloads
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_PART_SIZE = 8 * 2 ** 20
+
 
 def add_checksums_dir(dir):
     global CHECKSUMS_DIRS
@@ -166,20 +171,152 @@ def download_private_file_from_s3(bucket_name: str, key: str, local_path: str):
         logger.info("Reusing cached S3 data file...")
 
 
-def download_requests(url: str, dirpath: str, filename: str):
-    verify_ssl = get_verify_ssl()
+def download_requests(
+    url: str,
+    dirpath: str,
+    filename: str,
+    num_connections: int = DOWNLOAD_CONNECTIONS,
+    part_size: int = DOWNLOAD_PART_SIZE,
+) -> str:
+    """
+    Download url to dirpath/filename and return the sha256 hash of its contents
 
+    If the server accepts HTTP Range requests, the file is downloaded in parts of
+    part_size bytes over num_connections parallel connections. Downloaded parts are
+    recorded next to the partial file, so an interrupted download resumes from them
+    when called again. Otherwise, the file is streamed over a single connection.
+    """
+    verify_ssl = get_verify_ssl()
     filepath = os.path.join(dirpath, filename)
-    chunk_size = 4096
-    r = requests.get(url, stream=True, verify=verify_ssl)
-    with open(filepath, "wb") as f:
-        progress_bar = tqdm(
-            unit="B", total=int(r.headers["Content-Length"]), unit_scale=True
+    sha256_hash = hashlib.sha256()
+    consume = sha256_hash.update
+
+    with requests.head(url, allow_redirects=True, verify=verify_ssl) as r:
+        r.raise_for_status()
+        size = int(r.headers.get("Content-Length", -1))
+        accepts_ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+    if accepts_ranges and size > 0 and num_connections > 1:
+        _download_parts(
+            url, filepath, size, consume, num_connections, part_size, verify_ssl
         )
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            if chunk:  # filter keep-alive chunks
-                progress_bar.update(len(chunk))
-                f.write(chunk)
+    else:
+        _download_stream(url, filepath, consume, verify_ssl)
+    return sha256_hash.hexdigest()
+
+
+def _download_stream(url: str, filepath: str, consume, verify_ssl):
+    chunk_size = 4096
+    part_filepath = filepath + ".part"
+    with requests.get(url, stream=True, verify=verify_ssl) as r:
+        r.raise_for_status()
+        with open(part_filepath, "wb") as f:
+            progress_bar = tqdm(
+                unit="B", total=int(r.headers["Content-Length"]), unit_scale=True
+            )
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:  # filter keep-alive chunks
+                    progress_bar.update(len(chunk))
+                    f.write(chunk)
+                    consume(chunk)
+            progress_bar.close()
+    os.replace(part_filepath, filepath)
+
+
+def _download_parts(
+    url: str,
+    filepath: str,
+    size: int,
+    consume,
+    num_connections: int,
+    part_size: int,
+    verify_ssl,
+):
+    """
+    Download the parts of a file in parallel, passing them to consume in order
+
+    Parts are written into a preallocated filepath + ".part" file as they arrive. The
+    parts that have been consumed are listed in a .json file next to it, which is used
+    to resume an interrupted download.
+    """
+    part_filepath = filepath + ".part"
+    state_filepath = part_filepath + ".json"
+    num_parts = (size + part_size - 1) // part_size
+    state = {"url": url, "size": size, "part_size": part_size, "completed": []}
+
+    completed = set()
+    if os.path.isfile(part_filepath) and os.path.isfile(state_filepath):
+        try:
+            with open(state_filepath) as f:
+                saved_state = json.load(f)
+        except ValueError:
+            saved_state = {}
+        if all(saved_state.get(k) == state[k] for k in ("url", "size", "part_size")):
+            completed = set(saved_state["completed"])
+            logger.info(
+                f"Resuming download of {url} with {len(completed)} of {num_parts} parts"
+            )
+    if not completed:
+        with open(part_filepath, "wb") as f:
+            f.truncate(size)
+
+    def fetch(i):
+        start = i * part_size
+        end = min(start + part_size, size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        with requests.get(url, headers=headers, verify=verify_ssl) as r:
+            r.raise_for_status()
+            if r.status_code != 206 or len(r.content) != end - start + 1:
+                raise requests.exceptions.ContentDecodingError(
+                    f"Invalid response to range request {headers['Range']} for {url}"
+                )
+            data = r.content
+        with open(part_filepath, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+        return data
+
+    def read(i):
+        with open(part_filepath, "rb") as f:
+            f.seek(i * part_size)
+            return f.read(part_size)
+
+    def save_state():
+        state["completed"] = sorted(completed)
+        tmp_filepath = state_filepath + ".tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_filepath, state_filepath)
+
+    # Bound the number of parts held in memory ahead of the one being consumed
+    max_pending = 2 * num_connections
+    progress_bar = tqdm(unit="B", total=size, unit_scale=True)
+    executor = ThreadPoolExecutor(max_workers=num_connections)
+    pending = {}
+    try:
+        next_part = 0
+        for i in range(num_parts):
+            while next_part < num_parts and len(pending) < max_pending:
+                if next_part not in completed:
+                    pending[next_part] = executor.submit(fetch, next_part)
+                next_part += 1
+
+            if i in completed:
+                data = read(i)
+            else:
+                data = pending.pop(i).result()
+                completed.add(i)
+                save_state()
+            progress_bar.update(len(data))
+            consume(data)
+    finally:
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True)
+        progress_bar.close()
+
+    os.replace(part_filepath, filepath)
+    os.remove(state_filepath)
 
 
 def sha256(filepath: str, block_size=4096):
@@ -190,7 +327,9 @@ def sha256(filepath: str, block_size=4096):
         return sha256_hash.hexdigest()
 
 
-def verify_sha256(filepath: str, hash_value: str, block_size: int = 4096):
+def verify_sha256(
+    filepath: str, hash_value: str, block_size: int = 4096, value: str = None
+):
     """
     Verify that the target filepath has the given sha256 hash_value
         Raise ValueError if False
@@ -198,6 +337,7 @@ def verify_sha256(filepath: str, hash_value: str, block_size: int = 4096):
     filepath - target filepath
     hash_value - hex encoded value of the hash
     block_size - block size for chunked reading from file
+    value - if not None, the already computed hash of filepath, which is not read
     """
 
     if len(hash_value) != 64:
@@ -206,7 +346,8 @@ def verify_sha256(filepath: str, hash_value: str, block_size: int = 4096):
     if not all(x in "0123456789abcdef" for x in hash_value):
         raise ValueError(f"Invalid hash_value: {hash_value} contains non-hex chars")
 
-    value = sha256(filepath, block_size=block_size)
+    if value is None:
+        value = sha256(filepath, block_size=block_size)
     if value != hash_value:
         raise ValueError(f"sha256 hash of {filepath}: {value} != {hash_value}")
 
@@ -251,6 +392,7 @@ def download_verify_dataset_cache(dataset_dir, checksum_file, name):
     os.makedirs(cache_dir, exist_ok=True)
     tar_filepath = os.path.join(cache_dir, os.path.basename(s3_key))
     already_verified = False
+    download_hash = None
     if os.path.exists(tar_filepath):
         # Check existing download to avoid falling back to processing data
         logger.info(f"{tar_filepath} exists. Verifying...")
@@ -269,21 +411,23 @@ def download_verify_dataset_cache(dataset_dir, checksum_file, name):
         try:
             s3_url_region = "us-east-2"
             url = f"https://{s3_bucket_name}.s3.{s3_url_region}.amazonaws.com/{s3_key}"
-            download_requests(url, dataset_dir, tar_filepath)
+            download_hash = download_requests(url, dataset_dir, tar_filepath)
         except KeyboardInterrupt:
             logger.exception("Keyboard interrupt caught")
-            if os.path.exists(tar_filepath):
-                os.remove(tar_filepath)
             raise
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Download failed: {str(e)}")
+            logger.warning("Falling back to processing data...")
+            return
     else:
         logger.info("Dataset already downloaded.")
 
-    # verification
+    # verification, before anything is extracted from the archive
     if not already_verified:
         try:
             verify_size(tar_filepath, int(file_length))
             logger.info("Verifying sha256 hash of download...")
-            verify_sha256(tar_filepath, hash)
+            verify_sha256(tar_filepath, hash, value=download_hash)
         except ValueError:
             if os.path.exists(tar_filepath):
                 os.remove(tar_filepath)
@@ -42,9 +42,18 @@ class Evaluator(object):
         else:
             self.armory_global_config = {"verify_ssl": True}
 
-        date_time = datetime.datetime.utcnow().isoformat().replace(":", "")
-        output_dir = self.config["sysconfig"].get("output_dir", None)
-        eval_id = f"{output_dir}_{date_time}" if output_dir else date_time
+        self.resume = self.config["sysconfig"].get("resume")
+        if self.resume:
+            # Write to the output directory of the interrupted evaluation
+            eval_id = self.resume
+            if not os.path.isdir(os.path.join(self.host_paths.output_dir, eval_id)):
+                raise ValueError(
+                    f"Cannot resume {eval_id}: no such directory in {self.host_paths.output_dir}"
+                )
+        else:
+            date_time = datetime.datetime.utcnow().isoformat().replace(":", "")
+            output_dir = self.config["sysconfig"].get("output_dir", None)
+            eval_id = f"{output_dir}_{date_time}" if output_dir else date_time
 
         self.config["eval_id"] = eval_id
         self.output_dir = os.path.join(self.host_paths.output_dir, eval_id)
@@ -488,6 +497,8 @@ class Evaluator(object):
             options += " --skip-misclassified"
         if validate_config:
             options += " --validate-config"
+        if self.resume:
+            options += " --resume"
         return options
 
     def _constructor_options(
@@ -504,6 +515,7 @@ class Evaluator(object):
             skip_benign=skip_benign,
             skip_attack=skip_attack,
             skip_misclassified=skip_misclassified,
+            resume=bool(self.resume),
         )
         options = "".join(f", {str(k)}={str(v)}" for k, v in kwargs.items() if v)
         return options
@@ -40,9 +40,12 @@ class CarlaObjectDetectionTask(Scenario):
 
         x.flags.writeable = False
 
-        with metrics.resource_context(name="Inference", **self.profiler_kwargs):
+        with self.instrumentation.stage("benign_predict"), metrics.resource_context(
+            name="Inference", **self.profiler_kwargs
+        ):
             y_pred = self.model.predict(x, **self.predict_kwargs)
-        self.metrics_logger.update_task(y_object, y_pred)
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y_object, y_pred)
         self.y_pred = y_pred
 
     def run_attack(self):
@@ -52,7 +55,9 @@ class CarlaObjectDetectionTask(Scenario):
         # convert dict to List[dict] to comply with ART format
         y_object = [y_object]
 
-        with metrics.resource_context(name="Attack", **self.profiler_kwargs):
+        with self.instrumentation.stage("attack_generate"), metrics.resource_context(
+            name="Attack", **self.profiler_kwargs
+        ):
             if self.use_label:
                 y_target = [y_object]
             elif self.targeted:
@@ -69,16 +74,18 @@ class CarlaObjectDetectionTask(Scenario):
 
         # Ensure that input sample isn't overwritten by model
         x_adv.flags.writeable = False
-        y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
-        self.metrics_logger.update_task(y_object, y_pred_adv, adversarial=True)
-        self.metrics_logger_wrt_benign_preds.update_task(
-            self.y_pred, y_pred_adv, adversarial=True
-        )
-        if self.targeted:
-            self.metrics_logger.update_task(
-                y_target, y_pred_adv, adversarial=True, targeted=True
+        with self.instrumentation.stage("adversarial_predict"):
+            y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y_object, y_pred_adv, adversarial=True)
+            self.metrics_logger_wrt_benign_preds.update_task(
+                self.y_pred, y_pred_adv, adversarial=True
             )
-        self.metrics_logger.update_perturbation(x, x_adv)
+            if self.targeted:
+                self.metrics_logger.update_task(
+                    y_target, y_pred_adv, adversarial=True, targeted=True
+                )
+            self.metrics_logger.update_perturbation(x, x_adv)
 
         # If using multimodal input, add a warning if depth channels are perturbed
         if x.shape[-1] == 6:
@@ -86,7 +93,8 @@ class CarlaObjectDetectionTask(Scenario):
                 logger.warning("Adversarial attack perturbed depth channels")
 
         if self.sample_exporter is not None:
-            self.sample_exporter.export(x, x_adv, y, y_pred_adv)
+            with self.instrumentation.stage("export"):
+                self.sample_exporter.export(x, x_adv, y, y_pred_adv)
 
         self.x_adv, self.y_target, self.y_pred_adv = x_adv, y_target, y_pred_adv
 
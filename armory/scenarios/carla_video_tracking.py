@@ -32,9 +32,12 @@ class CarlaVideoTracking(Scenario):
         y_object, y_patch_metadata = y
         y_init = np.expand_dims(y_object[0]["boxes"][0], axis=0)
         x.flags.writeable = False
-        with metrics.resource_context(name="Inference", **self.profiler_kwargs):
+        with self.instrumentation.stage("benign_predict"), metrics.resource_context(
+            name="Inference", **self.profiler_kwargs
+        ):
             y_pred = self.model.predict(x, y_init=y_init, **self.predict_kwargs)
-        self.metrics_logger.update_task(y_object, y_pred)
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y_object, y_pred)
         self.y_pred = y_pred
 
     def run_attack(self):
@@ -42,7 +45,9 @@ class CarlaVideoTracking(Scenario):
         y_object, y_patch_metadata = y
         y_init = np.expand_dims(y_object[0]["boxes"][0], axis=0)
 
-        with metrics.resource_context(name="Attack", **self.profiler_kwargs):
+        with self.instrumentation.stage("attack_generate"), metrics.resource_context(
+            name="Attack", **self.profiler_kwargs
+        ):
             if self.use_label:
                 y_target = y_object
             elif self.targeted:
@@ -60,16 +65,19 @@ class CarlaVideoTracking(Scenario):
         # Ensure that input sample isn't overwritten by model
         x_adv.flags.writeable = False
 
-        y_pred_adv = self.model.predict(x_adv, y_init=y_init, **self.predict_kwargs)
+        with self.instrumentation.stage("adversarial_predict"):
+            y_pred_adv = self.model.predict(x_adv, y_init=y_init, **self.predict_kwargs)
 
-        self.metrics_logger.update_task(y_object, y_pred_adv, adversarial=True)
-        if self.targeted:
-            self.metrics_logger.update_task(
-                y_target, y_pred_adv, adversarial=True, targeted=True
-            )
-        self.metrics_logger.update_perturbation(x, x_adv)
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y_object, y_pred_adv, adversarial=True)
+            if self.targeted:
+                self.metrics_logger.update_task(
+                    y_target, y_pred_adv, adversarial=True, targeted=True
+                )
+            self.metrics_logger.update_perturbation(x, x_adv)
 
         if self.sample_exporter is not None:
-            self.sample_exporter.export(x, x_adv, y, y_pred_adv)
+            with self.instrumentation.stage("export"):
+                self.sample_exporter.export(x, x_adv, y, y_pred_adv)
 
         self.x_adv, self.y_target, self.y_pred_adv = x_adv, y_target, y_pred_adv
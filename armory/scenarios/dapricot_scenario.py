@@ -97,7 +97,9 @@ class ObjectDetectionTask(Scenario):
     def run_attack(self):
         x, y = self.x, self.y
 
-        with metrics.resource_context(name="Attack", **self.profiler_kwargs):
+        with self.instrumentation.stage("attack_generate"), metrics.resource_context(
+            name="Attack", **self.profiler_kwargs
+        ):
 
             if x.shape[0] != 1:
                 raise ValueError("D-APRICOT batch size must be set to 1")
@@ -114,20 +116,25 @@ class ObjectDetectionTask(Scenario):
 
         # Ensure that input sample isn't overwritten by model
         x_adv.flags.writeable = False
-        y_pred_adv = self.model.predict(x_adv)
-        for img_idx in range(len(y_object)):
-            y_i_target = y_target[img_idx]
-            y_i_pred = y_pred_adv[img_idx]
-            self.metrics_logger.update_task(
-                [y_i_target], [y_i_pred], adversarial=True, targeted=True
-            )
-
-        self.metrics_logger.update_perturbation(x, x_adv)
+        with self.instrumentation.stage("adversarial_predict"):
+            y_pred_adv = self.model.predict(x_adv)
+        with self.instrumentation.stage("metric_update"):
+            for img_idx in range(len(y_object)):
+                y_i_target = y_target[img_idx]
+                y_i_pred = y_pred_adv[img_idx]
+                self.metrics_logger.update_task(
+                    [y_i_target], [y_i_pred], adversarial=True, targeted=True
+                )
+
+            self.metrics_logger.update_perturbation(x, x_adv)
 
         if self.sample_exporter is not None:
-            self.sample_exporter.export(x, x_adv, y_object, y_pred_adv)
+            with self.instrumentation.stage("export"):
+                self.sample_exporter.export(x, x_adv, y_object, y_pred_adv)
         self.x_adv, self.y_target, self.y_pred_adv = x_adv, y_target, y_pred_adv
 
     def finalize_results(self):
+        if self.sample_exporter is not None:
+            self.sample_exporter.flush()
         self.metrics_logger.log_task(adversarial=True, targeted=True)
         self.results = self.metrics_logger.results()
@@ -113,6 +113,7 @@ def get(
     skip_benign=None,
     skip_attack=None,
     skip_misclassified=None,
+    resume=False,
 ):
     """
     Init environment variables and initialize scenario class with config;
@@ -141,6 +142,7 @@ def get(
             skip_benign=skip_benign,
             skip_attack=skip_attack,
             skip_misclassified=skip_misclassified,
+            resume=resume,
         )
     )
     scenario_config["kwargs"] = kwargs
@@ -217,6 +219,11 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip attack of inputs that are already misclassified",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume evaluation from the checkpoint in the output directory",
+    )
     args = parser.parse_args()
     coloredlogs.install(level=args.log_level)
     calling_version = os.getenv(environment.ARMORY_VERSION, "UNKNOWN")
@@ -247,6 +254,7 @@ if __name__ == "__main__":
             skip_benign=args.skip_benign,
             skip_attack=args.skip_attack,
             skip_misclassified=args.skip_misclassified,
+            resume=args.resume,
         )
     print(
         armory.END_SENTINEL
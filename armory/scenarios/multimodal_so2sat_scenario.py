@@ -118,7 +118,9 @@ class So2SatClassification(Scenario):
     def run_attack(self):
         x, y, y_pred = self.x, self.y, self.y_pred
 
-        with metrics.resource_context(name="Attack", **self.profiler_kwargs):
+        with self.instrumentation.stage("attack_generate"), metrics.resource_context(
+            name="Attack", **self.profiler_kwargs
+        ):
             if self.attack_type == "preloaded":
                 logger.warning(
                     "Specified preloaded attack. Ignoring `attack_modality` parameter"
@@ -165,35 +167,43 @@ class So2SatClassification(Scenario):
         else:
             # Ensure that input sample isn't overwritten by model
             x_adv.flags.writeable = False
-            y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
+            with self.instrumentation.stage("adversarial_predict"):
+                y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
+
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y, y_pred_adv, adversarial=True)
+            if self.targeted:
+                self.metrics_logger.update_task(
+                    y_target, y_pred_adv, adversarial=True, targeted=True
+                )
 
-        self.metrics_logger.update_task(y, y_pred_adv, adversarial=True)
-        if self.targeted:
-            self.metrics_logger.update_task(
-                y_target, y_pred_adv, adversarial=True, targeted=True
+            # Update perturbation metrics for SAR/EO separately
+            x_sar = np.stack(
+                (x[..., 0] + 1j * x[..., 1], x[..., 2] + 1j * x[..., 3]), axis=3
             )
-
-        # Update perturbation metrics for SAR/EO separately
-        x_sar = np.stack(
-            (x[..., 0] + 1j * x[..., 1], x[..., 2] + 1j * x[..., 3]), axis=3
-        )
-        x_adv_sar = np.stack(
-            (x_adv[..., 0] + 1j * x_adv[..., 1], x_adv[..., 2] + 1j * x_adv[..., 3],),
-            axis=3,
-        )
-        x_eo = x[..., 4:]
-        x_adv_eo = x_adv[..., 4:]
-        if self.sar_perturbation_logger is not None:
-            self.sar_perturbation_logger.update_perturbation(x_sar, x_adv_sar)
-        if self.eo_perturbation_logger is not None:
-            self.eo_perturbation_logger.update_perturbation(x_eo, x_adv_eo)
+            x_adv_sar = np.stack(
+                (
+                    x_adv[..., 0] + 1j * x_adv[..., 1],
+                    x_adv[..., 2] + 1j * x_adv[..., 3],
+                ),
+                axis=3,
+            )
+            x_eo = x[..., 4:]
+            x_adv_eo = x_adv[..., 4:]
+            if self.sar_perturbation_logger is not None:
+                self.sar_perturbation_logger.update_perturbation(x_sar, x_adv_sar)
+            if self.eo_perturbation_logger is not None:
+                self.eo_perturbation_logger.update_perturbation(x_eo, x_adv_eo)
 
         if self.sample_exporter is not None:
-            self.sample_exporter.export(x, x_adv, y, y_pred_adv)
+            with self.instrumentation.stage("export"):
+                self.sample_exporter.export(x, x_adv, y, y_pred_adv)
 
         self.x_adv, self.y_target, self.y_pred_adv = x_adv, y_target, y_pred_adv
 
     def finalize_results(self):
+        if self.sample_exporter is not None:
+            self.sample_exporter.flush()
         metrics_logger = self.metrics_logger
         metrics_logger.log_task()
         metrics_logger.log_task(adversarial=True)
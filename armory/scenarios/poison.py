@@ -10,12 +10,71 @@ import random
 
 import numpy as np
 
-from armory.scenarios.scenario import Scenario
+from armory import paths
+from armory.scenarios.scenario import Scenario, _get_rng_state, _set_rng_state
 from armory.scenarios.utils import to_categorical
 from armory.utils import config_loading, metrics
+from armory.utils.defense_cache import DefenseCache, array_digest
 
 logger = logging.getLogger(__name__)
 
+# Number of samples copied at a time into memory-mapped arrays
+MEMMAP_CHUNK_SIZE = 1024
+
+
+def stack_to_memmap(batches, directory):
+    """
+    Write the x and y of (x, y) batches to files in directory, returning them as
+        memory-mapped arrays that are writable without affecting the batches
+
+    Only one batch is held in memory at a time
+    """
+    specs = {}
+    num_samples = 0
+    try:
+        for x, y in batches:
+            for name, array in ("x", x), ("y", y):
+                array = np.ascontiguousarray(array)
+                if name not in specs:
+                    f = open(os.path.join(directory, f"{name}.bin"), "wb")
+                    specs[name] = (f, array.dtype, array.shape[1:])
+                f, dtype, shape = specs[name]
+                if array.dtype != dtype or array.shape[1:] != shape:
+                    raise ValueError(
+                        f"{name} batches vary in shape or dtype: {array.dtype} "
+                        f"{array.shape[1:]} != {dtype} {shape}"
+                    )
+                f.write(array.tobytes())
+            num_samples += len(x)
+    finally:
+        for f, _, _ in specs.values():
+            f.close()
+    if not num_samples:
+        raise ValueError("No samples to write")
+
+    return tuple(
+        np.memmap(
+            os.path.join(directory, f"{name}.bin"),
+            dtype=dtype,
+            mode="r+",
+            shape=(num_samples,) + shape,
+        )
+        for name, (_, dtype, shape) in specs.items()
+    )
+
+
+def take_to_memmap(x, index, filepath):
+    """
+    Return x[index] as a memory-mapped array at filepath, copied in chunks
+    """
+    out = np.memmap(
+        filepath, dtype=x.dtype, mode="w+", shape=(len(index),) + x.shape[1:]
+    )
+    for start in range(0, len(index), MEMMAP_CHUNK_SIZE):
+        stop = start + MEMMAP_CHUNK_SIZE
+        out[start:stop] = x[index[start:stop]]
+    return out
+
 
 class DatasetPoisoner:
     def __init__(self, attack, source_class, target_class, fraction=1.0):
@@ -46,24 +105,41 @@ class DatasetPoisoner:
             logger.warning(f"0 of {total} poisoned for class {self.source_class}.")
         return np.sort(np.random.choice(source_index, size=poison_count, replace=False))
 
-    def poison_dataset(self, x, y, return_index=False, fraction=None):
+    def poison_dataset(
+        self, x, y, return_index=False, fraction=None, out=None, batch_size=256
+    ):
         """
         Return a poisoned version of dataset x, y
             if return_index, return x, y, index
         If fraction is not None, use it to override default
+
+        Poisoned x is written to out, if given, which must have the shape and dtype
+            of x. It may be x itself, to poison in place, or e.g. a np.memmap.
+            Otherwise, x is copied once. The trigger is applied to batch_size
+            selected samples at a time, as a batch of images.
         """
         if len(x) != len(y):
             raise ValueError("Sizes of x and y do not match")
-        poison_x, poison_y = list(x), list(y)
+        if out is None:
+            out = np.array(x)
+        elif out is not x:
+            if out.shape != x.shape:
+                raise ValueError(f"out shape {out.shape} != x shape {x.shape}")
+            out[...] = x
+        poison_y = np.array(y, dtype=int)
+
         poison_index = self.get_poison_index(y, fraction=fraction)
-        for i in poison_index:
-            poison_x_i, poison_y[i] = self.attack.poison(x[i], [self.target_class])
-            poison_x[i] = np.asarray(poison_x_i, dtype=x[i].dtype)
-        poison_x, poison_y = np.array(poison_x), np.array(poison_y, dtype=int)
+        for start in range(0, len(poison_index), batch_size):
+            index = poison_index[start : start + batch_size]
+            poison_x_batch, _ = self.attack.poison(
+                out[index], np.full(len(index), self.target_class)
+            )
+            out[index] = np.asarray(poison_x_batch, dtype=out.dtype)
+        poison_y[poison_index] = self.target_class
 
         if return_index:
-            return poison_x, poison_y, poison_index
-        return poison_x, poison_y
+            return out, poison_y, poison_index
+        return out, poison_y
 
 
 class Poison(Scenario):
@@ -145,6 +221,14 @@ class Poison(Scenario):
         else:
             self.label_function = lambda y: y
 
+        # Flag to back the training set with memory-mapped files in the tmp dir
+        self.memmap_dir = None
+        if adhoc_config.get("memmap_train_dataset", False):
+            self.memmap_dir = os.path.join(
+                paths.runtime_paths().tmp_dir, self.config["eval_id"], "train_dataset"
+            )
+            os.makedirs(self.memmap_dir, exist_ok=True)
+
         dataset_config = self.config["dataset"]
         logger.info(f"Loading dataset {dataset_config['name']}...")
         ds = config_loading.load_dataset(
@@ -152,7 +236,13 @@ class Poison(Scenario):
             split=dataset_config.get("train_split", "train"),
             **self.dataset_kwargs,
         )
-        self.x_clean, self.y_clean = (np.concatenate(z, axis=0) for z in zip(*list(ds)))
+        if self.memmap_dir is not None:
+            logger.info(f"Writing memory-mapped training set to {self.memmap_dir}")
+            self.x_clean, self.y_clean = stack_to_memmap(ds, self.memmap_dir)
+        else:
+            self.x_clean, self.y_clean = (
+                np.concatenate(z, axis=0) for z in zip(*list(ds))
+            )
 
     def load_poisoner(self):
         adhoc_config = self.config.get("adhoc") or {}
@@ -175,12 +265,14 @@ class Poison(Scenario):
 
     def poison_dataset(self):
         if self.use_poison:
+            # x_clean is not used after poisoning, so it is poisoned in place
+            #     rather than holding two copies of the training set
             (
                 self.x_poison,
                 self.y_poison,
                 self.poison_index,
             ) = self.poisoner.poison_dataset(
-                self.x_clean, self.y_clean, return_index=True
+                self.x_clean, self.y_clean, return_index=True, out=self.x_clean
             )
         else:
             self.x_poison, self.y_poison, self.poison_index = (
@@ -205,23 +297,46 @@ class Poison(Scenario):
                 "defense_model", self.config["model"]
             )
             classifier_for_defense, _ = config_loading.load_model(defense_model_config)
-            logger.info(
-                f"Fitting model {defense_model_config['module']}.{defense_model_config['name']} "
-                f"for defense {defense_config['name']}..."
+            defense_train_epochs = adhoc_config.get(
+                "defense_train_epochs", self.train_epochs
             )
             # Flag to determine whether defense_classifier is trained directly
             #     (default API) or is trained as part of detect_poisons method
-            if adhoc_config.get("fit_defense_classifier_outside_defense", True):
-                classifier_for_defense.fit(
-                    self.x_poison,
-                    self.label_function(self.y_poison),
-                    batch_size=self.fit_batch_size,
-                    nb_epochs=adhoc_config.get(
-                        "defense_train_epochs", self.train_epochs
-                    ),
-                    verbose=False,
-                    shuffle=True,
+            fit_outside_defense = adhoc_config.get(
+                "fit_defense_classifier_outside_defense", True
+            )
+            cache = None
+            if adhoc_config.get("cache_defense_model", False):
+                cache = self._defense_cache(
+                    classifier_for_defense,
+                    defense_model_config,
+                    defense_train_epochs,
+                    fit_outside_defense,
                 )
+
+            if fit_outside_defense:
+                rng_state = cache.load_rng_state() if cache is not None else None
+                if rng_state is not None and cache.load_weights(classifier_for_defense):
+                    # Continue as if the classifier had been fit in this run
+                    _set_rng_state(rng_state)
+                else:
+                    logger.info(
+                        f"Fitting model {defense_model_config['module']}.{defense_model_config['name']} "
+                        f"for defense {defense_config['name']}..."
+                    )
+                    classifier_for_defense.fit(
+                        self.x_poison,
+                        self.label_function(self.y_poison),
+                        batch_size=self.fit_batch_size,
+                        nb_epochs=defense_train_epochs,
+                        verbose=False,
+                        shuffle=True,
+                    )
+                    if cache is not None:
+                        cache.save_rng_state(_get_rng_state())
+                        cache.save_weights(classifier_for_defense)
+            if cache is not None:
+                cache.cache_activations(classifier_for_defense, self.x_poison)
             defense_fn = config_loading.load_fn(defense_config)
             defense = defense_fn(
                 classifier_for_defense,
@@ -235,19 +350,58 @@ class Poison(Scenario):
             logger.info(f"Total clean data points: {np.sum(is_clean)}")
 
             logger.info("Filtering out detected poisoned samples")
-            indices_to_keep = is_clean == 1  # TODO: redundant?
+            indices_to_keep = np.flatnonzero(is_clean == 1)
+            if self.memmap_dir is not None:
+                self.x_train = take_to_memmap(
+                    self.x_poison,
+                    indices_to_keep,
+                    os.path.join(self.memmap_dir, "x_train.bin"),
+                )
+            else:
+                self.x_train = self.x_poison[indices_to_keep]
+            self.y_train = self.y_poison[indices_to_keep]
 
         else:
             logger.info(
                 "Defense does not require filtering. Model fitting will use all data."
             )
             indices_to_keep = ...
+            self.x_train, self.y_train = self.x_poison, self.y_poison
 
         # TODO: measure TP and FP rates for filtering
-        self.x_train = self.x_poison[indices_to_keep]
-        self.y_train = self.y_poison[indices_to_keep]
         self.indices_to_keep = indices_to_keep
 
+    def _defense_cache(
+        self, classifier, defense_model_config, train_epochs, fit_outside_defense
+    ):
+        """
+        Return the DefenseCache entry for the defense classifier, or None if it cannot
+            be cached
+        """
+        if not fit_outside_defense:
+            logger.warning(
+                "Not caching defense model: it is fit as part of the defense, as "
+                "'fit_defense_classifier_outside_defense' is false"
+            )
+            return None
+        cache_config = {
+            "x_poison": array_digest(self.x_poison),
+            "y_poison": array_digest(self.y_poison),
+            "poison_index": array_digest(self.poison_index),
+            "defense_model": defense_model_config,
+            "train_epochs": train_epochs,
+            "fit_batch_size": self.fit_batch_size,
+            "categorical_labels": self.categorical_labels,
+            "seed": self.seed,
+        }
+        cache = DefenseCache(paths.runtime_paths().saved_model_dir, cache_config)
+        if not cache.supports(classifier):
+            logger.warning(
+                f"Not caching defense model: cannot save weights of {type(classifier)}"
+            )
+            return None
+        return cache
+
     def fit(self):
         if len(self.x_train):
             logger.info("Fitting model")
@@ -305,13 +459,15 @@ class Poison(Scenario):
         x, y = self.x, self.y
 
         x.flags.writeable = False
-        y_pred = self.model.predict(x, **self.predict_kwargs)
+        with self.instrumentation.stage("benign_predict"):
+            y_pred = self.model.predict(x, **self.predict_kwargs)
 
-        self.benign_validation_metric.add_results(y, y_pred)
-        source = y == self.source_class
-        # NOTE: uses source->target trigger
-        if source.any():
-            self.target_class_benign_metric.add_results(y[source], y_pred[source])
+        with self.instrumentation.stage("metric_update"):
+            self.benign_validation_metric.add_results(y, y_pred)
+            source = y == self.source_class
+            # NOTE: uses source->target trigger
+            if source.any():
+                self.target_class_benign_metric.add_results(y[source], y_pred[source])
 
         self.y_pred = y_pred
         self.source = source
@@ -320,16 +476,19 @@ class Poison(Scenario):
         x, y = self.x, self.y
         source = self.source
 
-        x_adv, _ = self.test_poisoner.poison_dataset(x, y, fraction=1.0)
+        with self.instrumentation.stage("attack_generate"):
+            x_adv, _ = self.test_poisoner.poison_dataset(x, y, fraction=1.0)
         x_adv.flags.writeable = False
-        y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
-
-        self.poisoned_test_metric.add_results(y, y_pred_adv)
-        # NOTE: uses source->target trigger
-        if source.any():
-            self.poisoned_targeted_test_metric.add_results(
-                [self.target_class] * source.sum(), y_pred_adv[source]
-            )
+        with self.instrumentation.stage("adversarial_predict"):
+            y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
+
+        with self.instrumentation.stage("metric_update"):
+            self.poisoned_test_metric.add_results(y, y_pred_adv)
+            # NOTE: uses source->target trigger
+            if source.any():
+                self.poisoned_targeted_test_metric.add_results(
+                    [self.target_class] * source.sum(), y_pred_adv[source]
+                )
 
         self.x_adv = x_adv
         self.y_pred_adv = y_pred_adv
@@ -16,7 +16,14 @@ class CleanDatasetPoisoner:
         self.attack = attack
         self.categorical = bool(categorical)
 
-    def poison_dataset(self, x, y, return_index=False):
+    def poison_dataset(self, x, y, return_index=False, out=None):
+        """
+        Return a poisoned version of dataset x, y
+            if return_index, return x, y, index
+
+        Poisoned x is written to out, if given, as with DatasetPoisoner. It may be x
+            itself, to poison in place.
+        """
         if self.categorical:
             y = to_categorical(y)
 
@@ -36,6 +43,16 @@ class CleanDatasetPoisoner:
                     f"len(x_poison) {len(x_poison)} != len(x) {len(x)}. Returning []"
                 )
             poison_index = np.array(poison_index)
+
+        if out is not None:
+            if np.shape(x_poison) != out.shape:
+                raise ValueError(
+                    f"x_poison shape {np.shape(x_poison)} != out shape {out.shape}"
+                )
+            out[...] = x_poison
+            x_poison = out
+
+        if return_index:
             return x_poison, y_poison, poison_index
         return x_poison, y_poison
 
@@ -6,20 +6,28 @@ import copy
 import json
 import logging
 import os
+import pickle
+import random
 import sys
 import time
 from typing import Optional
 
+import numpy as np
 from tqdm import tqdm
 
 import armory
 from armory import Config, paths
-from armory.utils import config_loading, metrics
+from armory.utils import config_loading, export, metrics
 from armory.utils.export import SampleExporter
+from armory.utils.instrumentation import Instrumentation
 
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_FILE = "checkpoint.pkl"
+# Minimum number of seconds between checkpoints of evaluate_all
+CHECKPOINT_INTERVAL = 300
+
 
 class Scenario:
     """
@@ -37,6 +45,8 @@ class Scenario:
         skip_misclassified: Optional[bool] = False,
         mongo_host: Optional[str] = None,
         check_run: bool = False,
+        resume: bool = False,
+        checkpoint_interval: Optional[float] = CHECKPOINT_INTERVAL,
     ):
         self.check_run = bool(check_run)
         if num_eval_batches is not None and num_eval_batches < 0:
@@ -66,7 +76,14 @@ class Scenario:
         if skip_attack:
             logger.info("Skipping attack generation...")
         self.mongo_host = mongo_host
+        self.resume = bool(resume)
+        if checkpoint_interval is not None and checkpoint_interval < 0:
+            raise ValueError("checkpoint_interval cannot be negative")
+        self.checkpoint_interval = checkpoint_interval
         self.time_stamp = time.time()
+        self.instrumentation = Instrumentation(
+            trace_allocations=(config.get("metric") or {}).get("trace_allocations")
+        )
         if self.mongo_host is not None:  # fail fast if pymongo is not installed
             from armory.scenarios import mongo  # noqa: F401
 
@@ -227,10 +244,17 @@ class Scenario:
             computational_resource_dict=metrics_logger.computational_resource_dict,
         )
 
-        export_samples = self.config["scenario"].get("export_samples")
+        scenario_config = self.config["scenario"]
+        export_samples = scenario_config.get("export_samples")
         if export_samples is not None and export_samples > 0:
             sample_exporter = SampleExporter(
-                self.scenario_output_dir, self.test_dataset.context, export_samples
+                self.scenario_output_dir,
+                self.test_dataset.context,
+                export_samples,
+                num_workers=scenario_config.get(
+                    "export_workers", export.DEFAULT_NUM_WORKERS
+                ),
+                export_frames=scenario_config.get("export_video_frames", True),
             )
         else:
             sample_exporter = None
@@ -250,22 +274,137 @@ class Scenario:
 
     def evaluate_all(self):
         logger.info("Running inference on benign and adversarial examples")
-        for _ in tqdm(range(len(self.test_dataset)), desc="Evaluation"):
+        num_batches = len(self.test_dataset)
+        checkpoint = self._load_checkpoint() if self.resume else None
+        start = 0
+        if checkpoint is not None:
+            start = checkpoint["num_batches"]
+            logger.info(f"Resuming evaluation after batch {start} of {num_batches}")
+            for _ in tqdm(range(start), desc="Skipping evaluated batches"):
+                next(self.test_dataset)
+            self.i = start - 1
+            self._restore_checkpoint(checkpoint)
+
+        generator = getattr(self.test_dataset, "armory_generator", self.test_dataset)
+        if hasattr(generator, "instrumentation"):
+            generator.instrumentation = self.instrumentation
+        last_checkpoint = time.time()
+        for batch in tqdm(
+            range(start, num_batches),
+            desc="Evaluation",
+            initial=start,
+            total=num_batches,
+        ):
             self.next()
             self.evaluate_current()
+            if (
+                self.checkpoint_interval is not None
+                and batch + 1 < num_batches
+                and time.time() - last_checkpoint >= self.checkpoint_interval
+            ):
+                self._save_checkpoint(batch + 1)
+                last_checkpoint = time.time()
 
     def next(self):
-        x, y = next(self.test_dataset)
+        with self.instrumentation.stage("data_load"):
+            x, y = next(self.test_dataset)
         i = self.i + 1
         self.i, self.x, self.y = i, x, y
         self.y_pred, self.y_target, self.x_adv, self.y_pred_adv = None, None, None, None
 
+    def _checkpoint_path(self):
+        return os.path.join(self.scenario_output_dir, CHECKPOINT_FILE)
+
+    def _checkpoint_config(self):
+        """
+        Return everything that must match for a checkpoint to be resumed
+        """
+        config = {
+            k: self.config.get(k)
+            for k in ("adhoc", "attack", "dataset", "defense", "metric", "model")
+        }
+        config["scenario"] = {
+            k: self.config["scenario"].get(k) for k in ("module", "name")
+        }
+        config["cli"] = dict(
+            num_eval_batches=self.num_eval_batches,
+            skip_benign=self.skip_benign,
+            skip_attack=self.skip_attack,
+            skip_misclassified=self.skip_misclassified,
+            check_run=self.check_run,
+        )
+        config = json.loads(json.dumps(config, sort_keys=True))
+        # load_attack sets the summary writer to a path that differs between runs
+        if config["attack"] and "summary_writer" in config["attack"].get("kwargs", {}):
+            del config["attack"]["kwargs"]["summary_writer"]
+        return config
+
+    def _save_checkpoint(self, num_batches):
+        """
+        Save the state of an evaluation after num_batches batches to the output dir
+
+        The state consists of the results of all metrics, the export progress, stage
+        measurements, and the python, numpy, and torch random number generators.
+        """
+        checkpoint = {
+            "config": self._checkpoint_config(),
+            "num_batches": num_batches,
+            "metrics": {
+                name: value.state_dict()
+                for name, value in vars(self).items()
+                if isinstance(value, (metrics.MetricsLogger, metrics.MetricList))
+            },
+            "sample_exporter": (
+                None
+                if getattr(self, "sample_exporter", None) is None
+                else self.sample_exporter.state_dict()
+            ),
+            "instrumentation": self.instrumentation.state_dict(),
+            "rng": _get_rng_state(),
+        }
+        path = self._checkpoint_path()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(checkpoint, f)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved checkpoint after batch {num_batches} to {path}")
+
+    def _load_checkpoint(self):
+        path = self._checkpoint_path()
+        if not os.path.isfile(path):
+            logger.warning(f"No checkpoint at {path}. Evaluating from the start")
+            return None
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+        if checkpoint["config"] != self._checkpoint_config():
+            raise ValueError(
+                f"Checkpoint {path} was saved by an evaluation with a different config"
+            )
+        return checkpoint
+
+    def _restore_checkpoint(self, checkpoint):
+        for name, state in checkpoint["metrics"].items():
+            getattr(self, name).load_state_dict(state)
+        if checkpoint["sample_exporter"] is not None:
+            self.sample_exporter.load_state_dict(checkpoint["sample_exporter"])
+        self.instrumentation.load_state_dict(checkpoint["instrumentation"])
+        _set_rng_state(checkpoint["rng"])
+
+    def _remove_checkpoint(self):
+        try:
+            os.remove(self._checkpoint_path())
+        except FileNotFoundError:
+            pass
+
     def run_benign(self):
         x, y = self.x, self.y
         x.flags.writeable = False
-        with metrics.resource_context(name="Inference", **self.profiler_kwargs):
+        with self.instrumentation.stage("benign_predict"), metrics.resource_context(
+            name="Inference", **self.profiler_kwargs
+        ):
             y_pred = self.model.predict(x, **self.predict_kwargs)
-        self.metrics_logger.update_task(y, y_pred)
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y, y_pred)
         self.y_pred = y_pred
 
         if self.skip_misclassified:
@@ -274,7 +413,9 @@ class Scenario:
     def run_attack(self):
         x, y, y_pred = self.x, self.y, self.y_pred
 
-        with metrics.resource_context(name="Attack", **self.profiler_kwargs):
+        with self.instrumentation.stage("attack_generate"), metrics.resource_context(
+            name="Attack", **self.profiler_kwargs
+        ):
             if self.skip_misclassified and self.misclassified:
                 y_target = None
 
@@ -304,17 +445,20 @@ class Scenario:
         else:
             # Ensure that input sample isn't overwritten by model
             x_adv.flags.writeable = False
-            y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
-
-        self.metrics_logger.update_task(y, y_pred_adv, adversarial=True)
-        if self.targeted:
-            self.metrics_logger.update_task(
-                y_target, y_pred_adv, adversarial=True, targeted=True
-            )
-        self.metrics_logger.update_perturbation(x, x_adv)
+            with self.instrumentation.stage("adversarial_predict"):
+                y_pred_adv = self.model.predict(x_adv, **self.predict_kwargs)
+
+        with self.instrumentation.stage("metric_update"):
+            self.metrics_logger.update_task(y, y_pred_adv, adversarial=True)
+            if self.targeted:
+                self.metrics_logger.update_task(
+                    y_target, y_pred_adv, adversarial=True, targeted=True
+                )
+            self.metrics_logger.update_perturbation(x, x_adv)
 
         if self.sample_exporter is not None:
-            self.sample_exporter.export(x, x_adv, y, y_pred_adv)
+            with self.instrumentation.stage("export"):
+                self.sample_exporter.export(x, x_adv, y, y_pred_adv)
 
         self.x_adv, self.y_target, self.y_pred_adv = x_adv, y_target, y_pred_adv
 
@@ -325,6 +469,8 @@ class Scenario:
             self.run_attack()
 
     def finalize_results(self):
+        if self.sample_exporter is not None:
+            self.sample_exporter.flush()
         metrics_logger = self.metrics_logger
         metrics_logger.log_task()
         metrics_logger.log_task(adversarial=True)
@@ -360,8 +506,10 @@ class Scenario:
 
         if results is None:
             logger.warning(f"{self._evaluate} returned None, not a dict")
+        self.instrumentation.log_summary()
         output = self._prepare_results(self.config, results)
         self._save(output)
+        self._remove_checkpoint()
         if self.mongo_host is not None:
             self._send_to_mongo(self.mongo_host, output)
 
@@ -380,6 +528,7 @@ class Scenario:
             "config": config,
             "results": results,
             "timestamp": int(self.time_stamp),
+            "instrumentation": self.instrumentation.summary(),
         }
         return output
 
@@ -400,6 +549,13 @@ class Scenario:
         with open(os.path.join(self.scenario_output_dir, filename), "w") as f:
             f.write(json.dumps(output, sort_keys=True, indent=4) + "\n")
 
+        instrumentation_filename = (
+            f"{scenario_name}_{output['timestamp']}_instrumentation.json"
+        )
+        self.instrumentation.save(
+            os.path.join(self.scenario_output_dir, instrumentation_filename)
+        )
+
     def _send_to_mongo(self, output: dict):
         """
         Send results to a Mongo database at mongo_host
@@ -407,3 +563,25 @@ class Scenario:
         import mongo
 
         mongo.send_to_db(output, self.mongo_host)
+
+
+def _get_rng_state():
+    state = {"random": random.getstate(), "numpy": np.random.get_state()}
+    if "torch" in sys.modules:
+        import torch
+
+        state["torch"] = torch.get_rng_state()
+        if torch.cuda.is_available():
+            state["torch_cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    if "torch" in state:
+        import torch
+
+        torch.set_rng_state(state["torch"])
+        if "torch_cuda" in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["torch_cuda"])
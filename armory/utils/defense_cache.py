@@ -0,0 +1,242 @@
+"""
+On-disk cache of the classifiers trained for poison filtering defenses
+
+Each cache entry resides in its own subdirectory under <saved_model_dir>/defense_cache
+named after a hash of everything that determines the trained classifier, such as the
+poisoned training set, poison index, defense model config, training epochs, and seed.
+It holds the fitted weights, and the activations extracted from the training set by
+the defense, so that runs which only vary the detection kwargs skip training.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from armory import __version__
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUBDIR = "defense_cache"
+RNG_STATE_FILE = "rng_state.pkl"
+
+# Number of samples hashed at a time, to bound memory for memory-mapped arrays
+HASH_CHUNK_SIZE = 1024
+
+
+def array_digest(array) -> str:
+    """
+    Return the sha256 hex digest of the shape, dtype, and contents of array
+    """
+    array = np.asarray(array)
+    digest = hashlib.sha256(f"{array.shape} {array.dtype}".encode())
+    for start in range(0, len(array), HASH_CHUNK_SIZE):
+        digest.update(np.ascontiguousarray(array[start : start + HASH_CHUNK_SIZE]))
+    return digest.hexdigest()
+
+
+def _framework(classifier):
+    """
+    Return the framework of the model wrapped by classifier, if its weights can be saved
+    """
+    model = getattr(classifier, "model", None)
+    try:
+        import torch
+
+        if isinstance(model, torch.nn.Module):
+            return "pytorch"
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+
+        if isinstance(model, tf.keras.Model):
+            return "keras"
+    except ImportError:
+        pass
+    return None
+
+
+def _row_range(x, x_batch):
+    """
+    Return (start, stop) if x_batch is x or a view of consecutive samples of x, else None
+    """
+    if x_batch is x:
+        return 0, len(x)
+    if (
+        not isinstance(x_batch, np.ndarray)
+        or not isinstance(x, np.ndarray)
+        or x_batch.dtype != x.dtype
+        or x_batch.shape[1:] != x.shape[1:]
+        or x_batch.strides != x.strides
+        or not len(x_batch)
+    ):
+        return None
+    offset = x_batch.__array_interface__["data"][0] - x.__array_interface__["data"][0]
+    if offset < 0 or offset % x.strides[0]:
+        return None
+    start = offset // x.strides[0]
+    stop = start + len(x_batch)
+    if stop > len(x):
+        return None
+    return start, stop
+
+
+class DefenseCache:
+    """
+    A single cache entry, keyed on the configuration of the defense classifier
+
+    config - JSON-serializable dict with everything that determines the fitted weights
+    """
+
+    def __init__(self, saved_model_dir: str, config: dict):
+        self.config = dict(config, armory_version=__version__)
+        self.key = hashlib.sha256(
+            json.dumps(self.config, sort_keys=True).encode()
+        ).hexdigest()
+        self.path = os.path.join(saved_model_dir, CACHE_SUBDIR, self.key)
+        self._partial_activations = {}
+
+    def supports(self, classifier) -> bool:
+        """
+        Return whether the weights of classifier can be cached
+        """
+        return _framework(classifier) is not None
+
+    def _weights_path(self, framework):
+        extension = {"keras": "h5", "pytorch": "pt"}[framework]
+        return os.path.join(self.path, f"weights.{extension}")
+
+    def load_weights(self, classifier) -> bool:
+        """
+        Load cached weights into classifier, returning whether they were found
+        """
+        framework = _framework(classifier)
+        if framework is None or not os.path.isfile(self._weights_path(framework)):
+            return False
+
+        filepath = self._weights_path(framework)
+        if framework == "keras":
+            classifier.model.load_weights(filepath)
+        else:
+            import torch
+
+            classifier.model.load_state_dict(
+                torch.load(filepath, map_location=classifier.device)
+            )
+        logger.info(f"Loaded defense classifier weights from {filepath}")
+        return True
+
+    def save_weights(self, classifier):
+        """
+        Save the weights of classifier, if its framework is supported
+        """
+        framework = _framework(classifier)
+        if framework is None:
+            logger.warning(
+                f"Not caching defense classifier: cannot save weights of {type(classifier)}"
+            )
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        filepath = self._weights_path(framework)
+        # Keep the extension, from which keras infers the format
+        root, extension = os.path.splitext(filepath)
+        tmp_filepath = f"{root}.tmp-{os.getpid()}{extension}"
+        if framework == "keras":
+            classifier.model.save_weights(tmp_filepath)
+        else:
+            import torch
+
+            torch.save(classifier.model.state_dict(), tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+        with open(os.path.join(self.path, "config.json"), "w") as f:
+            json.dump(self.config, f, sort_keys=True)
+        logger.info(f"Cached defense classifier weights to {filepath}")
+
+    def load_rng_state(self):
+        """
+        Return the random state saved after fitting, or None
+        """
+        filepath = os.path.join(self.path, RNG_STATE_FILE)
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath, "rb") as f:
+            return pickle.load(f)
+
+    def save_rng_state(self, state):
+        os.makedirs(self.path, exist_ok=True)
+        filepath = os.path.join(self.path, RNG_STATE_FILE)
+        tmp_filepath = f"{filepath}.tmp-{os.getpid()}"
+        with open(tmp_filepath, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_filepath, filepath)
+
+    def cache_activations(self, classifier, x):
+        """
+        Wrap classifier.get_activations to cache the activations of x, layer by layer
+
+        Calls on x or on views of consecutive samples of x, as made by defenses that
+            process x in batches, read from and write to a memory-mapped array of the
+            activations of all of x. Other calls are passed through.
+        """
+        get_activations = classifier.get_activations
+
+        def cached_get_activations(x_batch, layer, *args, **kwargs):
+            rows = _row_range(x, x_batch)
+            if (
+                rows is None
+                or kwargs.get("framework")
+                or not isinstance(layer, (int, str))
+            ):
+                return get_activations(x_batch, layer, *args, **kwargs)
+
+            start, stop = rows
+            filepath = os.path.join(self.path, f"activations_{layer}.npy")
+            if os.path.isfile(filepath):
+                return np.array(np.load(filepath, mmap_mode="r")[start:stop])
+
+            activations = get_activations(x_batch, layer, *args, **kwargs)
+            if self._partial_activations.get(filepath, ()) is not None:
+                self._record_activations(filepath, len(x), start, stop, activations)
+            return activations
+
+        classifier.get_activations = cached_get_activations
+
+    def _record_activations(self, filepath, num_samples, start, stop, activations):
+        """
+        Write activations of samples start to stop, completing the cache file once all
+            samples have been written
+        """
+        activations = np.asarray(activations)
+        if filepath not in self._partial_activations:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_filepath = f"{filepath}.tmp-{os.getpid()}"
+            array = np.lib.format.open_memmap(
+                tmp_filepath,
+                mode="w+",
+                dtype=activations.dtype,
+                shape=(num_samples,) + activations.shape[1:],
+            )
+            written = np.zeros(num_samples, dtype=bool)
+            self._partial_activations[filepath] = (tmp_filepath, array, written)
+
+        tmp_filepath, array, written = self._partial_activations[filepath]
+        if (
+            activations.dtype != array.dtype
+            or activations.shape != (stop - start,) + array.shape[1:]
+        ):
+            logger.warning(f"Not caching activations: {filepath} varies in shape")
+            os.remove(tmp_filepath)
+            self._partial_activations[filepath] = None
+            return
+        array[start:stop] = activations
+        written[start:stop] = True
+        if written.all():
+            array.flush()
+            del self._partial_activations[filepath]
+            os.replace(tmp_filepath, filepath)
+            logger.info(f"Cached defense activations to {filepath}")
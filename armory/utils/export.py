@@ -1,5 +1,7 @@
+import collections
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import ffmpeg
 import pickle
@@ -7,25 +9,54 @@ import time
 from PIL import Image
 from scipy.io import wavfile
 
-from armory.data.datasets import ImageContext, VideoContext, AudioContext, So2SatContext
+from armory.data.datasets import (
+    ImageContext,
+    VideoContext,
+    AudioContext,
+    So2SatContext,
+    unpad_batch,
+)
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_NUM_WORKERS = 2
+
 
 class SampleExporter:
-    def __init__(self, base_output_dir, context, num_samples):
+    """
+    Exports the first num_samples benign and adversarial samples passed to export
+
+    Samples are written in the background by a pool of num_workers threads, from
+        copies of the arrays, so that encoding images and videos does not hold up the
+        evaluation. At most twice as many samples as workers are pending at a time.
+        If num_workers is 0, export writes the samples itself.
+    Call flush to wait until all samples are written.
+
+    export_frames - whether to also export each frame of videos as PNG files, rather
+        than only the mp4 files
+    """
+
+    def __init__(
+        self,
+        base_output_dir,
+        context,
+        num_samples,
+        num_workers=DEFAULT_NUM_WORKERS,
+        export_frames=True,
+    ):
         self.base_output_dir = base_output_dir
         self.context = context
         self.num_samples = num_samples
         self.saved_samples = 0
         self.output_dir = None
         self.y_dict = {}
+        self.export_frames = bool(export_frames)
 
         if isinstance(self.context, VideoContext):
             self.export_fn = self._export_video
         elif isinstance(self.context, ImageContext):
-            self.export_fn = self._export_images
+            self.export_fn = self._export_image
         elif isinstance(self.context, AudioContext):
             self.export_fn = self._export_audio
         elif isinstance(self.context, So2SatContext):
@@ -36,16 +67,90 @@ class SampleExporter:
             )
         self._make_output_dir()
 
+        num_workers = int(num_workers)
+        if num_workers < 0:
+            raise ValueError(f"num_workers {num_workers} must be nonnegative")
+        self._executor = None
+        if num_workers:
+            self._executor = ThreadPoolExecutor(
+                max_workers=num_workers, thread_name_prefix="SampleExporter"
+            )
+        self._max_pending = 2 * num_workers
+        self._pending = collections.deque()
+        self._predictions_saved = False
+
     def export(self, x, x_adv, y, y_adv):
 
         if self.saved_samples < self.num_samples:
+            # Export the samples of padded batches without their padding
+            x_adv = unpad_batch(x_adv, x)
+            x = unpad_batch(x)
 
             self.y_dict[self.saved_samples] = {"ground truth": y, "predicted": y_adv}
-            self.export_fn(x, x_adv)
+            for x_i, x_adv_i in zip(x, x_adv):
+                if self.saved_samples == self.num_samples:
+                    break
+                self._submit(self.saved_samples, x_i, x_adv_i)
+                self.saved_samples += 1
 
             if self.saved_samples == self.num_samples:
-                with open(os.path.join(self.output_dir, "predictions.pkl"), "wb") as f:
-                    pickle.dump(self.y_dict, f)
+                self.flush()
+
+    def _submit(self, index, x_i, x_adv_i):
+        if self._executor is None:
+            self.export_fn(index, x_i, x_adv_i)
+            return
+
+        while len(self._pending) >= self._max_pending:
+            self._pending.popleft().result()
+        # Copy the samples, as the scenario may reuse or modify its arrays
+        self._pending.append(
+            self._executor.submit(
+                self.export_fn, index, np.array(x_i), np.array(x_adv_i)
+            )
+        )
+
+    def flush(self):
+        """
+        Wait until all samples passed to export are written, raising any write error
+
+        Once all num_samples are written, also write the predictions and stop the
+            worker threads
+        """
+        while self._pending:
+            self._pending.popleft().result()
+
+        if self.saved_samples == self.num_samples and not self._predictions_saved:
+            with open(os.path.join(self.output_dir, "predictions.pkl"), "wb") as f:
+                pickle.dump(self.y_dict, f)
+            self._predictions_saved = True
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def state_dict(self):
+        """
+        Return the export progress, e.g. for checkpointing an evaluation
+        """
+        self.flush()
+        return {
+            "output_dir": self.output_dir,
+            "saved_samples": self.saved_samples,
+            "y_dict": self.y_dict,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Continue the export of state_dict() in its output directory
+        """
+        if state["output_dir"] != self.output_dir and os.path.isdir(
+            state["output_dir"]
+        ):
+            if not os.listdir(self.output_dir):
+                os.rmdir(self.output_dir)
+            self.output_dir = state["output_dir"]
+        self.saved_samples = state["saved_samples"]
+        self.y_dict = state["y_dict"]
 
     def _make_output_dir(self):
         assert os.path.exists(self.base_output_dir) and os.path.isdir(
@@ -64,257 +169,217 @@ class SampleExporter:
             )
         os.mkdir(self.output_dir)
 
-    def _export_images(self, x, x_adv):
-        for x_i, x_adv_i in zip(x, x_adv):
-
-            if self.saved_samples == self.num_samples:
-                break
-
-            assert np.all(
-                x_i.shape == x_adv_i.shape
-            ), f"Benign and adversarial images are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
-            if x_i.min() < 0.0 or x_i.max() > 1.0:
-                logger.warning(
-                    "Benign image out of expected range. Clipping to [0, 1]."
-                )
-            if x_adv_i.min() < 0.0 or x_adv_i.max() > 1.0:
-                logger.warning(
-                    "Adversarial image out of expected range. Clipping to [0, 1]."
-                )
-
-            if x_i.shape[-1] == 1:
-                mode = "L"
-                x_i_mode = np.squeeze(x_i, axis=2)
-                x_adv_i_mode = np.squeeze(x_adv_i, axis=2)
-            elif x_i.shape[-1] == 3:
-                mode = "RGB"
-                x_i_mode = x_i
-                x_adv_i_mode = x_adv_i
-            elif x_i.shape[-1] == 6:
-                mode = "RGB"
-                x_i_mode = x_i[..., :3]
-                x_adv_i_mode = x_adv_i[..., :3]
-                x_i_depth = x_i[..., 3:]
-                depth_image = Image.fromarray(
-                    np.uint8(np.clip(x_i_depth, 0.0, 1.0) * 255.0), mode
-                )
-                depth_image.save(
-                    os.path.join(self.output_dir, f"{self.saved_samples}_depth.png")
-                )
-            else:
-                raise ValueError(f"Expected 1 or 3 channels, found {x_i.shape[-1]}")
+    def _export_image(self, index, x_i, x_adv_i):
+        assert np.all(
+            x_i.shape == x_adv_i.shape
+        ), f"Benign and adversarial images are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
+        if x_i.min() < 0.0 or x_i.max() > 1.0:
+            logger.warning("Benign image out of expected range. Clipping to [0, 1].")
+        if x_adv_i.min() < 0.0 or x_adv_i.max() > 1.0:
+            logger.warning(
+                "Adversarial image out of expected range. Clipping to [0, 1]."
+            )
 
-            benign_image = Image.fromarray(
-                np.uint8(np.clip(x_i_mode, 0.0, 1.0) * 255.0), mode
+        if x_i.shape[-1] == 1:
+            mode = "L"
+            x_i_mode = np.squeeze(x_i, axis=2)
+            x_adv_i_mode = np.squeeze(x_adv_i, axis=2)
+        elif x_i.shape[-1] == 3:
+            mode = "RGB"
+            x_i_mode = x_i
+            x_adv_i_mode = x_adv_i
+        elif x_i.shape[-1] == 6:
+            mode = "RGB"
+            x_i_mode = x_i[..., :3]
+            x_adv_i_mode = x_adv_i[..., :3]
+            x_i_depth = x_i[..., 3:]
+            depth_image = Image.fromarray(
+                np.uint8(np.clip(x_i_depth, 0.0, 1.0) * 255.0), mode
+            )
+            depth_image.save(os.path.join(self.output_dir, f"{index}_depth.png"))
+        else:
+            raise ValueError(f"Expected 1 or 3 channels, found {x_i.shape[-1]}")
+
+        benign_image = Image.fromarray(
+            np.uint8(np.clip(x_i_mode, 0.0, 1.0) * 255.0), mode
+        )
+        adversarial_image = Image.fromarray(
+            np.uint8(np.clip(x_adv_i_mode, 0.0, 1.0) * 255.0), mode
+        )
+        benign_image.save(os.path.join(self.output_dir, f"{index}_benign.png"))
+        adversarial_image.save(
+            os.path.join(self.output_dir, f"{index}_adversarial.png")
+        )
+
+    def _export_so2sat(self, index, x_i, x_adv_i):
+        assert np.all(
+            x_i.shape == x_adv_i.shape
+        ), f"Benign and adversarial images are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
+        if x_i[..., :4].min() < -1.0 or x_i[..., :4].max() > 1.0:
+            logger.warning(
+                "Benign SAR images out of expected range. Clipping to [-1, 1]."
             )
-            adversarial_image = Image.fromarray(
-                np.uint8(np.clip(x_adv_i_mode, 0.0, 1.0) * 255.0), mode
+        if x_adv_i[..., :4].min() < -1.0 or x_adv_i[..., :4].max() > 1.0:
+            logger.warning(
+                "Adversarial SAR images out of expected range. Clipping to [-1, 1]."
             )
-            benign_image.save(
-                os.path.join(self.output_dir, f"{self.saved_samples}_benign.png")
+        if x_i[..., 4:].min() < 0.0 or x_i[..., 4:].max() > 1.0:
+            logger.warning(
+                "Benign EO images out of expected range. Clipping to [0, 1]."
             )
-            adversarial_image.save(
-                os.path.join(self.output_dir, f"{self.saved_samples}_adversarial.png")
+        if x_adv_i[..., 4:].min() < 0.0 or x_adv_i[..., 4:].max() > 1.0:
+            logger.warning(
+                "Adversarial EO images out of expected range. Clipping to [0, 1]."
             )
 
-            self.saved_samples += 1
-
-    def _export_so2sat(self, x, x_adv):
-        for x_i, x_adv_i in zip(x, x_adv):
-
-            if self.saved_samples == self.num_samples:
-                break
-
-            assert np.all(
-                x_i.shape == x_adv_i.shape
-            ), f"Benign and adversarial images are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
-            if x_i[..., :4].min() < -1.0 or x_i[..., :4].max() > 1.0:
-                logger.warning(
-                    "Benign SAR images out of expected range. Clipping to [-1, 1]."
-                )
-            if x_adv_i[..., :4].min() < -1.0 or x_adv_i[..., :4].max() > 1.0:
-                logger.warning(
-                    "Adversarial SAR images out of expected range. Clipping to [-1, 1]."
-                )
-            if x_i[..., 4:].min() < 0.0 or x_i[..., 4:].max() > 1.0:
-                logger.warning(
-                    "Benign EO images out of expected range. Clipping to [0, 1]."
-                )
-            if x_adv_i[..., 4:].min() < 0.0 or x_adv_i[..., 4:].max() > 1.0:
-                logger.warning(
-                    "Adversarial EO images out of expected range. Clipping to [0, 1]."
-                )
-
-            folder = str(self.saved_samples)
-            os.mkdir(os.path.join(self.output_dir, folder))
+        folder = str(index)
+        os.mkdir(os.path.join(self.output_dir, folder))
 
-            sar_eps = 1e-9 + 1j * 1e-9
-            x_vh = np.log10(
-                np.abs(
-                    np.complex128(
-                        np.clip(x_i[..., 0], -1.0, 1.0)
-                        + 1j * np.clip(x_i[..., 1], -1.0, 1.0)
-                    )
-                    + sar_eps
+        sar_eps = 1e-9 + 1j * 1e-9
+        x_vh = np.log10(
+            np.abs(
+                np.complex128(
+                    np.clip(x_i[..., 0], -1.0, 1.0)
+                    + 1j * np.clip(x_i[..., 1], -1.0, 1.0)
                 )
+                + sar_eps
             )
-            x_vv = np.log10(
-                np.abs(
-                    np.complex128(
-                        np.clip(x_i[..., 2], -1.0, 1.0)
-                        + 1j * np.clip(x_i[..., 3], -1.0, 1.0)
-                    )
-                    + sar_eps
+        )
+        x_vv = np.log10(
+            np.abs(
+                np.complex128(
+                    np.clip(x_i[..., 2], -1.0, 1.0)
+                    + 1j * np.clip(x_i[..., 3], -1.0, 1.0)
                 )
+                + sar_eps
             )
-            x_adv_vh = np.log10(
-                np.abs(
-                    np.complex128(
-                        np.clip(x_adv_i[..., 0], -1.0, 1.0)
-                        + 1j * np.clip(x_adv_i[..., 1], -1.0, 1.0)
-                    )
-                    + sar_eps
+        )
+        x_adv_vh = np.log10(
+            np.abs(
+                np.complex128(
+                    np.clip(x_adv_i[..., 0], -1.0, 1.0)
+                    + 1j * np.clip(x_adv_i[..., 1], -1.0, 1.0)
                 )
+                + sar_eps
             )
-            x_adv_vv = np.log10(
-                np.abs(
-                    np.complex128(
-                        np.clip(x_adv_i[..., 2], -1.0, 1.0)
-                        + 1j * np.clip(x_adv_i[..., 3], -1.0, 1.0)
-                    )
-                    + sar_eps
+        )
+        x_adv_vv = np.log10(
+            np.abs(
+                np.complex128(
+                    np.clip(x_adv_i[..., 2], -1.0, 1.0)
+                    + 1j * np.clip(x_adv_i[..., 3], -1.0, 1.0)
                 )
+                + sar_eps
             )
-            sar_min = np.min((x_vh.min(), x_vv.min(), x_adv_vh.min(), x_adv_vv.min()))
-            sar_max = np.max((x_vh.max(), x_vv.max(), x_adv_vh.max(), x_adv_vv.max()))
-            sar_scale = 255.0 / (sar_max - sar_min)
-
-            benign_vh = Image.fromarray(np.uint8(sar_scale * (x_vh - sar_min)), "L")
-            benign_vv = Image.fromarray(np.uint8(sar_scale * (x_vv - sar_min)), "L")
-            adversarial_vh = Image.fromarray(
-                np.uint8(sar_scale * (x_adv_vh - sar_min)), "L"
-            )
-            adversarial_vv = Image.fromarray(
-                np.uint8(sar_scale * (x_adv_vv - sar_min)), "L"
+        )
+        sar_min = np.min((x_vh.min(), x_vv.min(), x_adv_vh.min(), x_adv_vv.min()))
+        sar_max = np.max((x_vh.max(), x_vv.max(), x_adv_vh.max(), x_adv_vv.max()))
+        sar_scale = 255.0 / (sar_max - sar_min)
+
+        benign_vh = Image.fromarray(np.uint8(sar_scale * (x_vh - sar_min)), "L")
+        benign_vv = Image.fromarray(np.uint8(sar_scale * (x_vv - sar_min)), "L")
+        adversarial_vh = Image.fromarray(
+            np.uint8(sar_scale * (x_adv_vh - sar_min)), "L"
+        )
+        adversarial_vv = Image.fromarray(
+            np.uint8(sar_scale * (x_adv_vv - sar_min)), "L"
+        )
+        benign_vh.save(os.path.join(self.output_dir, folder, "vh_benign.png"))
+        benign_vv.save(os.path.join(self.output_dir, folder, "vv_benign.png"))
+        adversarial_vh.save(os.path.join(self.output_dir, folder, "vh_adversarial.png"))
+        adversarial_vv.save(os.path.join(self.output_dir, folder, "vv_adversarial.png"))
+
+        eo_min = np.min((x_i[..., 4:].min(), x_adv_i[..., 4:].min()))
+        eo_max = np.max((x_i[..., 4:].max(), x_adv_i[..., 4:].max()))
+        eo_scale = 255.0 / (eo_max - eo_min)
+        for c in range(4, 14):
+            benign_eo = Image.fromarray(
+                np.uint8(eo_scale * (np.clip(x_i[..., c], 0.0, 1.0) - eo_min)), "L"
             )
-            benign_vh.save(os.path.join(self.output_dir, folder, "vh_benign.png"))
-            benign_vv.save(os.path.join(self.output_dir, folder, "vv_benign.png"))
-            adversarial_vh.save(
-                os.path.join(self.output_dir, folder, "vh_adversarial.png")
+            adversarial_eo = Image.fromarray(
+                np.uint8(eo_scale * (np.clip(x_adv_i[..., c], 0.0, 1.0) - eo_min)), "L",
             )
-            adversarial_vv.save(
-                os.path.join(self.output_dir, folder, "vv_adversarial.png")
+            benign_eo.save(os.path.join(self.output_dir, folder, f"eo{c-4}_benign.png"))
+            adversarial_eo.save(
+                os.path.join(self.output_dir, folder, f"eo{c-4}_adversarial.png")
             )
 
-            eo_min = np.min((x_i[..., 4:].min(), x_adv[..., 4:].min()))
-            eo_max = np.max((x_i[..., 4:].max(), x_adv[..., 4:].max()))
-            eo_scale = 255.0 / (eo_max - eo_min)
-            for c in range(4, 14):
-                benign_eo = Image.fromarray(
-                    np.uint8(eo_scale * (np.clip(x_i[..., c], 0.0, 1.0) - eo_min)), "L"
-                )
-                adversarial_eo = Image.fromarray(
-                    np.uint8(eo_scale * (np.clip(x_adv_i[..., c], 0.0, 1.0) - eo_min)),
-                    "L",
-                )
-                benign_eo.save(
-                    os.path.join(self.output_dir, folder, f"eo{c-4}_benign.png")
-                )
-                adversarial_eo.save(
-                    os.path.join(self.output_dir, folder, f"eo{c-4}_adversarial.png")
-                )
-
-            self.saved_samples += 1
+    def _export_audio(self, index, x_i, x_adv_i):
+        assert np.all(
+            x_i.shape == x_adv_i.shape
+        ), f"Benign and adversarial audio are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
+        if x_i.min() < -1.0 or x_i.max() > 1.0:
+            logger.warning("Benign audio out of expected range. Clipping to [-1, 1]")
+        if x_adv_i.min() < -1.0 or x_adv_i.max() > 1.0:
+            logger.warning(
+                "Adversarial audio out of expected range. Clipping to [-1, 1]"
+            )
 
-    def _export_audio(self, x, x_adv):
-        for x_i, x_adv_i in zip(x, x_adv):
+        wavfile.write(
+            os.path.join(self.output_dir, f"{index}_benign.wav"),
+            rate=self.context.sample_rate,
+            data=np.clip(x_i, -1.0, 1.0),
+        )
+        wavfile.write(
+            os.path.join(self.output_dir, f"{index}_adversarial.wav"),
+            rate=self.context.sample_rate,
+            data=np.clip(x_adv_i, -1.0, 1.0),
+        )
+
+    def _export_video(self, index, x_i, x_adv_i):
+        assert np.all(
+            x_i.shape == x_adv_i.shape
+        ), f"Benign and adversarial videos are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
+        if x_i.min() < 0.0 or x_i.max() > 1.0:
+            logger.warning("Benign video out of expected range. Clipping to [0, 1]")
+        if x_adv_i.min() < 0.0 or x_adv_i.max() > 1.0:
+            logger.warning(
+                "Adversarial video out of expected range. Clipping to [0, 1]"
+            )
 
-            if self.saved_samples == self.num_samples:
-                break
-
-            assert np.all(
-                x_i.shape == x_adv_i.shape
-            ), f"Benign and adversarial audio are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
-            if x_i.min() < -1.0 or x_i.max() > 1.0:
-                logger.warning(
-                    "Benign audio out of expected range. Clipping to [-1, 1]"
-                )
-            if x_adv_i.min() < -1.0 or x_adv_i.max() > 1.0:
-                logger.warning(
-                    "Adversarial audio out of expected range. Clipping to [-1, 1]"
-                )
+        folder = str(index)
+        os.mkdir(os.path.join(self.output_dir, folder))
 
-            wavfile.write(
-                os.path.join(self.output_dir, f"{self.saved_samples}_benign.wav"),
-                rate=self.context.sample_rate,
-                data=np.clip(x_i, -1.0, 1.0),
+        benign_process = (
+            ffmpeg.input(
+                "pipe:",
+                format="rawvideo",
+                pix_fmt="rgb24",
+                s=f"{x_i.shape[2]}x{x_i.shape[1]}",
             )
-            wavfile.write(
-                os.path.join(self.output_dir, f"{self.saved_samples}_adversarial.wav"),
-                rate=self.context.sample_rate,
-                data=np.clip(x_adv_i, -1.0, 1.0),
+            .output(
+                os.path.join(self.output_dir, folder, "video_benign.mp4"),
+                pix_fmt="yuv420p",
+                vcodec="libx264",
+                r=self.context.frame_rate,
             )
-
-            self.saved_samples += 1
-
-    def _export_video(self, x, x_adv):
-        for x_i, x_adv_i in zip(x, x_adv):
-
-            if self.saved_samples == self.num_samples:
-                break
-
-            assert np.all(
-                x_i.shape == x_adv_i.shape
-            ), f"Benign and adversarial videos are different shapes: {x_i.shape} vs. {x_adv_i.shape}"
-            if x_i.min() < 0.0 or x_i.max() > 1.0:
-                logger.warning("Benign video out of expected range. Clipping to [0, 1]")
-            if x_adv_i.min() < 0.0 or x_adv_i.max() > 1.0:
-                logger.warning(
-                    "Adversarial video out of expected range. Clipping to [0, 1]"
-                )
-
-            folder = str(self.saved_samples)
-            os.mkdir(os.path.join(self.output_dir, folder))
-
-            benign_process = (
-                ffmpeg.input(
-                    "pipe:",
-                    format="rawvideo",
-                    pix_fmt="rgb24",
-                    s=f"{x_i.shape[2]}x{x_i.shape[1]}",
-                )
-                .output(
-                    os.path.join(self.output_dir, folder, "video_benign.mp4"),
-                    pix_fmt="yuv420p",
-                    vcodec="libx264",
-                    r=self.context.frame_rate,
-                )
-                .overwrite_output()
-                .run_async(pipe_stdin=True, quiet=True)
+            .overwrite_output()
+            .run_async(pipe_stdin=True, quiet=True)
+        )
+
+        adversarial_process = (
+            ffmpeg.input(
+                "pipe:",
+                format="rawvideo",
+                pix_fmt="rgb24",
+                s=f"{x_i.shape[2]}x{x_i.shape[1]}",
             )
-
-            adversarial_process = (
-                ffmpeg.input(
-                    "pipe:",
-                    format="rawvideo",
-                    pix_fmt="rgb24",
-                    s=f"{x_i.shape[2]}x{x_i.shape[1]}",
-                )
-                .output(
-                    os.path.join(self.output_dir, folder, "video_adversarial.mp4"),
-                    pix_fmt="yuv420p",
-                    vcodec="libx264",
-                    r=self.context.frame_rate,
-                )
-                .overwrite_output()
-                .run_async(pipe_stdin=True, quiet=True)
+            .output(
+                os.path.join(self.output_dir, folder, "video_adversarial.mp4"),
+                pix_fmt="yuv420p",
+                vcodec="libx264",
+                r=self.context.frame_rate,
             )
+            .overwrite_output()
+            .run_async(pipe_stdin=True, quiet=True)
+        )
 
-            for n_frame, (x_frame, x_adv_frame) in enumerate(zip(x_i, x_adv_i)):
+        for n_frame, (x_frame, x_adv_frame) in enumerate(zip(x_i, x_adv_i)):
 
-                benign_pixels = np.uint8(np.clip(x_frame, 0.0, 1.0) * 255.0)
-                adversarial_pixels = np.uint8(np.clip(x_adv_frame, 0.0, 1.0) * 255.0)
+            benign_pixels = np.uint8(np.clip(x_frame, 0.0, 1.0) * 255.0)
+            adversarial_pixels = np.uint8(np.clip(x_adv_frame, 0.0, 1.0) * 255.0)
 
+            if self.export_frames:
                 benign_image = Image.fromarray(benign_pixels, "RGB")
                 adversarial_image = Image.fromarray(adversarial_pixels, "RGB")
                 benign_image.save(
@@ -328,11 +393,10 @@ class SampleExporter:
                     )
                 )
 
-                benign_process.stdin.write(benign_pixels.tobytes())
-                adversarial_process.stdin.write(adversarial_pixels.tobytes())
+            benign_process.stdin.write(benign_pixels.tobytes())
+            adversarial_process.stdin.write(adversarial_pixels.tobytes())
 
-            benign_process.stdin.close()
-            benign_process.wait()
-            adversarial_process.stdin.close()
-            adversarial_process.wait()
-            self.saved_samples += 1
+        benign_process.stdin.close()
+        benign_process.wait()
+        adversarial_process.stdin.close()
+        adversarial_process.wait()
@@ -0,0 +1,152 @@
+"""
+Per-batch latency and memory measurements of the stages of a scenario
+"""
+
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+MB = 2 ** 20
+
+
+def peak_rss() -> int:
+    """
+    Return the peak resident set size of the process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    # Linux reports kilobytes
+    return peak * 1024
+
+
+class Instrumentation:
+    """
+    Records the duration of every execution of named stages of a scenario, such as
+    data loading, attack generation, and metric updates
+
+    For each execution, it also records how much the peak resident set size of the
+    process grew, and if trace_allocations is True, the net memory allocated by Python
+    as traced by tracemalloc. Tracing slows down allocation-heavy code, so it is off
+    by default. Stages may be executed from several threads, e.g. preprocessing in the
+    dataset prefetch thread, in which case allocation deltas overlap.
+    """
+
+    def __init__(self, trace_allocations: bool = False):
+        self.trace_allocations = bool(trace_allocations)
+        self.records = defaultdict(
+            lambda: {"time_s": [], "rss_growth_bytes": [], "alloc_bytes": []}
+        )
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_allocations:
+            alloc_start = tracemalloc.get_traced_memory()[0]
+        rss_start = peak_rss()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        rss_growth = peak_rss() - rss_start
+        if self.trace_allocations:
+            alloc = tracemalloc.get_traced_memory()[0] - alloc_start
+
+        with self._lock:
+            record = self.records[name]
+            record["time_s"].append(elapsed)
+            record["rss_growth_bytes"].append(rss_growth)
+            if self.trace_allocations:
+                record["alloc_bytes"].append(alloc)
+
+    def state_dict(self) -> dict:
+        """
+        Return the measurements recorded so far, e.g. for checkpointing an evaluation
+        """
+        with self._lock:
+            return {
+                name: {key: list(values) for key, values in record.items()}
+                for name, record in self.records.items()
+            }
+
+    def load_state_dict(self, state: dict):
+        """
+        Replace the measurements recorded so far with those of state_dict()
+        """
+        with self._lock:
+            self.records.clear()
+            for name, record in state.items():
+                self.records[name].update(
+                    {key: list(values) for key, values in record.items()}
+                )
+
+    def summary(self) -> dict:
+        """
+        Return the count, total, mean, percentiles, and maximum of the duration of each
+        stage, along with its share of the total time of all stages and memory usage
+        """
+        records = self.state_dict()
+        total_time = sum(sum(r["time_s"]) for r in records.values())
+        stages = {}
+        for name, record in records.items():
+            times = np.array(record["time_s"])
+            stage = {
+                "count": len(times),
+                "total_s": float(times.sum()),
+                "mean_s": float(times.mean()),
+            }
+            for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+                stage[f"p{p}_s"] = float(value)
+            stage["max_s"] = float(times.max())
+            stage["fraction_of_total"] = (
+                float(times.sum() / total_time) if total_time else 0.0
+            )
+            stage["rss_growth_mb"] = sum(record["rss_growth_bytes"]) / MB
+            if record["alloc_bytes"]:
+                alloc = np.array(record["alloc_bytes"])
+                stage["mean_alloc_mb"] = float(alloc.mean() / MB)
+                stage["max_alloc_mb"] = float(alloc.max() / MB)
+            stages[name] = stage
+        return {"peak_rss_mb": peak_rss() / MB, "stages": stages}
+
+    def log_summary(self):
+        summary = self.summary()
+        for name, stage in summary["stages"].items():
+            logger.info(
+                f"{name}: {stage['count']} executions, {stage['total_s']:.3f} s total "
+                f"({stage['fraction_of_total']:.1%}), p50 {stage['p50_s']:.4f} s, "
+                f"p99 {stage['p99_s']:.4f} s"
+            )
+        logger.info(f"Peak resident set size: {summary['peak_rss_mb']:.1f} MB")
+
+    def save(self, filepath: str):
+        """
+        Write the per-execution measurements of each stage to filepath as compact JSON
+        """
+        with self._lock:
+            records = {
+                name: {
+                    key: [round(v, 6) for v in values] if key == "time_s" else values
+                    for key, values in record.items()
+                    if values
+                }
+                for name, record in self.records.items()
+            }
+        with open(filepath, "w") as f:
+            json.dump(
+                {"peak_rss_bytes": peak_rss(), "stages": records},
+                f,
+                separators=(",", ":"),
+            )
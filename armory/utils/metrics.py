@@ -17,6 +17,7 @@ import cProfile
 import pstats
 
 from armory.data.adversarial_datasets import ADV_PATCH_MAGIC_NUMBER_LABEL_ID
+from armory.data.datasets import unpad_batch
 from armory.data.adversarial.apricot_metadata import APRICOT_PATCHES
 
 
@@ -190,39 +191,106 @@ def _snr_spectrogram(x_i, x_adv_i):
 def word_error_rate(y, y_pred):
     """
     Return the word error rate for a batch of transcriptions.
+
+    Each value is a tuple (edit distance, number of words in the reference), so that
+    MetricList.total_wer() can compute the error rate over all transcriptions.
+    """
+    if len(y) != len(y_pred):
+        raise ValueError(f"len(y) {len(y)} != len(y_pred) {len(y_pred)}")
+    references = [_decode_reference(y_i).split() for y_i in y]
+    hypotheses = [y_pred_i.split() for y_pred_i in y_pred]
+    return _error_rate_tuples(references, hypotheses)
+
+
+def character_error_rate(y, y_pred):
+    """
+    Return the character error rate for a batch of transcriptions.
+
+    Runs of whitespace count as a single space. As for word_error_rate, each value is
+    a tuple (edit distance, number of characters in the reference).
     """
     if len(y) != len(y_pred):
         raise ValueError(f"len(y) {len(y)} != len(y_pred) {len(y_pred)}")
-    return [_word_error_rate(y_i, y_pred_i) for (y_i, y_pred_i) in zip(y, y_pred)]
+    references = [list(" ".join(_decode_reference(y_i).split())) for y_i in y]
+    hypotheses = [list(" ".join(y_pred_i.split())) for y_pred_i in y_pred]
+    return _error_rate_tuples(references, hypotheses)
 
 
-def _word_error_rate(y_i, y_pred_i):
+# Metrics reported as a total over all samples by MetricList.total_wer()
+ERROR_RATE_METRICS = {
+    "word_error_rate": "Word error rate",
+    "character_error_rate": "Character error rate",
+}
+
+
+def _decode_reference(y_i):
     if isinstance(y_i, str):
-        reference = y_i.split()
+        return y_i
     elif isinstance(y_i, bytes):
-        reference = y_i.decode("utf-8").split()
-    else:
-        raise TypeError(f"y_i is of type {type(y_i)}, expected string or bytes")
-    hypothesis = y_pred_i.split()
-    r_length = len(reference)
-    h_length = len(hypothesis)
-    matrix = np.zeros((r_length + 1, h_length + 1))
-    for i in range(r_length + 1):
-        for j in range(h_length + 1):
-            if i == 0:
-                matrix[0][j] = j
-            elif j == 0:
-                matrix[i][0] = i
-    for i in range(1, r_length + 1):
-        for j in range(1, h_length + 1):
-            if reference[i - 1] == hypothesis[j - 1]:
-                matrix[i][j] = matrix[i - 1][j - 1]
-            else:
-                substitute = matrix[i - 1][j - 1] + 1
-                insertion = matrix[i][j - 1] + 1
-                deletion = matrix[i - 1][j] + 1
-                matrix[i][j] = min(substitute, insertion, deletion)
-    return (matrix[r_length][h_length], r_length)
+        return y_i.decode("utf-8")
+    raise TypeError(f"y_i is of type {type(y_i)}, expected string or bytes")
+
+
+def _error_rate_tuples(references, hypotheses):
+    """
+    Return (edit distance, reference length) tuples for lists of token sequences
+    """
+    # Map tokens to integer ids shared by the whole batch
+    token_ids = {}
+    references = [
+        [token_ids.setdefault(t, len(token_ids)) for t in r] for r in references
+    ]
+    hypotheses = [
+        [token_ids.setdefault(t, len(token_ids)) for t in h] for h in hypotheses
+    ]
+    distances = _levenshtein_distances(references, hypotheses)
+    return [
+        (float(distance), len(reference))
+        for distance, reference in zip(distances, references)
+    ]
+
+
+def _levenshtein_distances(references, hypotheses):
+    """
+    Return the Levenshtein distance between each pair of integer id sequences
+
+    The dynamic programming table is computed one reference token at a time for the
+    whole batch, keeping only the current row of shape (batch, max hypothesis length + 1).
+    Within a row, insertions form a prefix minimum, which is computed with
+    np.minimum.accumulate. Sequences are padded with ids that never match. Since each
+    entry only depends on entries to its left and above, padding does not affect the
+    entries of the unpadded table, and the distance of each pair is read from its row
+    once its reference is exhausted.
+    """
+    batch_size = len(references)
+    ref_lengths = np.array([len(r) for r in references], dtype=np.int64)
+    hyp_lengths = np.array([len(h) for h in hypotheses], dtype=np.int64)
+    max_ref_length = int(ref_lengths.max(initial=0))
+    max_hyp_length = int(hyp_lengths.max(initial=0))
+
+    ref_ids = np.full((batch_size, max_ref_length), -1, dtype=np.int64)
+    hyp_ids = np.full((batch_size, max_hyp_length), -2, dtype=np.int64)
+    for i, (reference, hypothesis) in enumerate(zip(references, hypotheses)):
+        ref_ids[i, : len(reference)] = reference
+        hyp_ids[i, : len(hypothesis)] = hypothesis
+
+    batch_index = np.arange(batch_size)
+    columns = np.arange(max_hyp_length + 1, dtype=np.int64)
+    row = np.tile(columns, (batch_size, 1))
+    distances = np.zeros(batch_size, dtype=np.int64)
+    done = ref_lengths == 0
+    distances[done] = hyp_lengths[done]
+    for i in range(max_ref_length):
+        substitution = row[:, :-1] + (ref_ids[:, i : i + 1] != hyp_ids)
+        deletion = row[:, 1:] + 1
+        row = np.empty_like(row)
+        row[:, 0] = i + 1
+        row[:, 1:] = np.minimum(substitution, deletion)
+        # insertion: row[j] = min over k <= j of row[k] + (j - k)
+        row = np.minimum.accumulate(row - columns, axis=1) + columns
+        done = ref_lengths == i + 1
+        distances[done] = row[batch_index[done], hyp_lengths[done]]
+    return distances
 
 
 # Metrics specific to MARS model preprocessing in video UCF101 scenario
@@ -277,34 +345,37 @@ def resource_context(name="Name", profiler=None, computational_resource_dict=Non
     profiler_types = ["Basic", "Deterministic"]
     if profiler is not None and profiler not in profiler_types:
         raise ValueError(f"Profiler {profiler} is not one of {profiler_types}.")
-    if profiler == "Deterministic":
+    if name not in computational_resource_dict:
+        computational_resource_dict[name] = defaultdict(lambda: 0)
+    comp = computational_resource_dict[name]
+    if profiler == "Deterministic" and "profile" not in comp:
         logger.warn(
             "Using Deterministic profiler. This may reduce timing accuracy and result in a large results file."
         )
-        pr = cProfile.Profile()
-        pr.enable()
+        # A single profile accumulates all executions and is formatted only once,
+        # by MetricsLogger.results
+        comp["profile"] = cProfile.Profile()
+    if profiler == "Deterministic":
+        comp["profile"].enable()
     startTime = time.perf_counter()
     yield
     elapsedTime = time.perf_counter() - startTime
     if profiler == "Deterministic":
-        pr.disable()
-        s = io.StringIO()
-        sortby = "cumulative"
-        ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-        ps.print_stats()
-        stats = s.getvalue()
-    if name not in computational_resource_dict:
-        computational_resource_dict[name] = defaultdict(lambda: 0)
-        if profiler == "Deterministic":
-            computational_resource_dict[name]["stats"] = ""
-    comp = computational_resource_dict[name]
+        comp["profile"].disable()
     comp["execution_count"] += 1
     comp["total_time"] += elapsedTime
-    if profiler == "Deterministic":
-        comp["stats"] += stats
     return 0
 
 
+def _profiler_stats(profile):
+    """
+    Return the stats of a cProfile.Profile sorted by cumulative time, as a string
+    """
+    s = io.StringIO()
+    pstats.Stats(profile, stream=s).sort_stats("cumulative").print_stats()
+    return s.getvalue()
+
+
 def snr_spectrogram(x, x_adv):
     """
     Return the SNR of a batch of samples with spectrogram input
@@ -477,6 +548,50 @@ def _intersection_over_union(box_1, box_2):
     return iou
 
 
+def _intersection_over_union_matrix(boxes_1, boxes_2):
+    """
+    Pairwise version of _intersection_over_union
+
+    boxes_1 (np.ndarray): of shape (N, 4)
+    boxes_2 (np.ndarray): of shape (M, 4)
+    Both are assumed to have format [y1, x1, y2, x2] or [x1, y1, x2, y2]
+
+    returns: an array of shape (N, M) whose (i, j) entry is the iou of boxes_1[i] and boxes_2[j]
+    """
+    boxes_1 = np.asarray(boxes_1).reshape((-1, 4))
+    boxes_2 = np.asarray(boxes_2).reshape((-1, 4))
+    for boxes in boxes_1, boxes_2:
+        assert (boxes[:, 2] >= boxes[:, 0]).all()
+        assert (boxes[:, 3] >= boxes[:, 1]).all()
+
+    if len(boxes_1) and len(boxes_2):
+        is_normalized_1 = (boxes_1 <= 1.0).all(axis=1)
+        is_normalized_2 = (boxes_2 <= 1.0).all(axis=1)
+        if (is_normalized_1.any() and not is_normalized_2.all()) or (
+            is_normalized_2.any() and not is_normalized_1.all()
+        ):
+            logger.warning(
+                "One set of boxes appears to be normalized while the other is not"
+            )
+
+    # Determine coordinates of intersection boxes
+    x_left = np.maximum(boxes_1[:, np.newaxis, 1], boxes_2[np.newaxis, :, 1])
+    x_right = np.minimum(boxes_1[:, np.newaxis, 3], boxes_2[np.newaxis, :, 3])
+    y_top = np.maximum(boxes_1[:, np.newaxis, 0], boxes_2[np.newaxis, :, 0])
+    y_bottom = np.minimum(boxes_1[:, np.newaxis, 2], boxes_2[np.newaxis, :, 2])
+
+    intersect_area = np.maximum(0, x_right - x_left) * np.maximum(0, y_bottom - y_top)
+
+    box_1_area = (boxes_1[:, 3] - boxes_1[:, 1]) * (boxes_1[:, 2] - boxes_1[:, 0])
+    box_2_area = (boxes_2[:, 3] - boxes_2[:, 1]) * (boxes_2[:, 2] - boxes_2[:, 0])
+    union_area = box_1_area[:, np.newaxis] + box_2_area[np.newaxis, :] - intersect_area
+
+    # Boxes which do not intersect have an iou of 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = np.where(intersect_area == 0, 0, intersect_area / union_area)
+    return iou
+
+
 def video_tracking_mean_iou(y, y_pred):
     """
     Mean IOU between ground-truth and predicted boxes, averaged over all frames for a video.
@@ -526,166 +641,161 @@ def object_detection_AP_per_class(
 
     returns: a dictionary mapping each class to the average precision (AP) for the class.
     """
-    _check_object_detection_input(y_list, y_pred_list)
+    accumulator = ObjectDetectionAPAccumulator(
+        iou_threshold=iou_threshold, class_list=class_list
+    )
+    accumulator.update(y_list, y_pred_list)
+    return accumulator.compute()
 
-    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
-    RECALL_POINTS = np.linspace(0, 1, 11)
 
-    # Converting all boxes to a list of dicts (a list for predicted boxes, and a
-    # separate list for ground truth boxes), where each dict corresponds to a box and
-    # has the following keys "img_idx", "label", "box", as well as "score" for predicted boxes
-    pred_boxes_list = []
-    gt_boxes_list = []
-    for img_idx, (y, y_pred) in enumerate(zip(y_list, y_pred_list)):
-        img_labels = y["labels"].flatten()
-        img_boxes = y["boxes"].reshape((-1, 4))
-        for gt_box_idx in range(img_labels.flatten().shape[0]):
-            label = img_labels[gt_box_idx]
-            box = img_boxes[gt_box_idx]
-            gt_box_dict = {"img_idx": img_idx, "label": label, "box": box}
-            gt_boxes_list.append(gt_box_dict)
-
-        for pred_box_idx in range(y_pred["labels"].flatten().shape[0]):
-            pred_label = y_pred["labels"][pred_box_idx]
-            pred_box = y_pred["boxes"][pred_box_idx]
-            pred_score = y_pred["scores"][pred_box_idx]
-            pred_box_dict = {
-                "img_idx": img_idx,
-                "label": pred_label,
-                "box": pred_box,
-                "score": pred_score,
-            }
-            pred_boxes_list.append(pred_box_dict)
+def _object_detection_flatten_boxes(box_dicts, with_scores=False):
+    """
+    Concatenate the boxes from a list of per-image dicts into flat arrays
+
+    box_dicts (list): of dicts with "labels" and "boxes" keys, and "scores" if with_scores
+    with_scores (bool): whether to also return the flattened scores
+
+    returns: a tuple (img_idx, labels, boxes) or (img_idx, labels, boxes, scores), where
+        img_idx[i] is the index in box_dicts of the dict that the ith box came from
+    """
+    img_idx, labels, boxes, scores = [], [], [], []
+    for i, box_dict in enumerate(box_dicts):
+        img_labels = np.asarray(box_dict["labels"]).flatten()
+        img_idx.append(np.full(len(img_labels), i, dtype=np.int64))
+        labels.append(img_labels)
+        boxes.append(np.asarray(box_dict["boxes"]).reshape((-1, 4)))
+        if with_scores:
+            scores.append(np.asarray(box_dict["scores"]).flatten())
+
+    if box_dicts:
+        flattened = [
+            np.concatenate(img_idx),
+            np.concatenate(labels),
+            np.concatenate(boxes),
+        ]
+    else:
+        flattened = [np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 4))]
+    if with_scores:
+        flattened.append(np.concatenate(scores) if box_dicts else np.zeros(0))
+    return tuple(flattened)
+
+
+def _object_detection_best_gt_matches(
+    gt_img_idx, gt_labels, gt_boxes, pred_img_idx, pred_labels, pred_boxes
+):
+    """
+    For each predicted box, find the ground-truth box from the same image and with the same
+    label that has the highest iou with it. As in a sequential scan with a `>=` comparison,
+    ties are resolved in favor of the ground-truth box that comes last.
+
+    Inputs are the flat arrays returned by _object_detection_flatten_boxes, which are
+    sorted by image index. One pairwise iou matrix is computed per image.
+
+    returns: a tuple (best_gt_idx, best_iou) of arrays of shape (num_pred_boxes,). If no
+        ground-truth box shares a predicted box's image and label, its best_gt_idx is -1
+        and its best_iou is -inf.
+    """
+    num_pred_boxes = len(pred_img_idx)
+    best_gt_idx = np.full(num_pred_boxes, -1, dtype=np.int64)
+    best_iou = np.full(num_pred_boxes, -np.inf)
+    if num_pred_boxes == 0 or len(gt_img_idx) == 0:
+        return best_gt_idx, best_iou
+
+    num_images = max(gt_img_idx[-1], pred_img_idx[-1]) + 1
+    gt_bounds = np.searchsorted(gt_img_idx, np.arange(num_images + 1))
+    pred_bounds = np.searchsorted(pred_img_idx, np.arange(num_images + 1))
+    for img_idx in range(num_images):
+        gt_start, gt_end = gt_bounds[img_idx], gt_bounds[img_idx + 1]
+        pred_start, pred_end = pred_bounds[img_idx], pred_bounds[img_idx + 1]
+        if gt_start == gt_end or pred_start == pred_end:
+            continue
+
+        ious = _intersection_over_union_matrix(
+            pred_boxes[pred_start:pred_end], gt_boxes[gt_start:gt_end]
+        )
+        same_label = (
+            pred_labels[pred_start:pred_end, np.newaxis]
+            == gt_labels[np.newaxis, gt_start:gt_end]
+        )
+        ious = np.where(same_label, ious, -np.inf)
+
+        # argmax over the reversed columns picks the last of several equal maxima
+        last_best = ious.shape[1] - 1 - np.argmax(ious[:, ::-1], axis=1)
+        img_best_iou = ious[np.arange(len(ious)), last_best]
+        best_iou[pred_start:pred_end] = img_best_iou
+        best_gt_idx[pred_start:pred_end] = np.where(
+            np.isfinite(img_best_iou), gt_start + last_best, -1
+        )
+
+    return best_gt_idx, best_iou
+
+
+def _object_detection_greedy_match(pred_scores, best_gt_idx, is_candidate):
+    """
+    Greedily assign predicted boxes to the ground-truth boxes they were matched with.
 
-    # Union of (1) the set of all true classes and (2) the set of all predicted classes
-    set_of_class_ids = set([i["label"] for i in gt_boxes_list]) | set(
-        [i["label"] for i in pred_boxes_list]
+    Predicted boxes are processed by descending confidence, with ties kept in their original
+    order. A candidate prediction is a true positive if it is the first to be assigned to its
+    ground-truth box (best_gt_idx). Any later candidate assigned to the same ground-truth box
+    is a duplicate. Predictions that are not candidates are neither.
+
+    Since ground-truth boxes are specific to a single image and label, this gives the same
+    result whether it is run on all images at once or on one batch of images at a time.
+
+    returns: a tuple (is_true_positive, is_duplicate) of boolean arrays, in the original
+        order of the predicted boxes
+    """
+    order = np.argsort(-pred_scores, kind="stable")
+    candidate_positions = np.where(is_candidate[order])[0]
+    _, first_match_positions = np.unique(
+        best_gt_idx[order][candidate_positions], return_index=True
     )
 
-    if class_list:
-        # Filter out classes not in class_list
-        set_of_class_ids = set(i for i in set_of_class_ids if i in class_list)
-
-    # Remove the class ID that corresponds to a physical adversarial patch in APRICOT
-    # dataset, if present
-    set_of_class_ids.discard(ADV_PATCH_MAGIC_NUMBER_LABEL_ID)
-
-    # Initialize dict that will store AP for each class
-    average_precisions_by_class = {}
-
-    # Compute AP for each class
-    for class_id in set_of_class_ids:
-
-        # Build lists that contain all the predicted/ground-truth boxes with a
-        # label of class_id
-        class_predicted_boxes = []
-        class_gt_boxes = []
-        for pred_box in pred_boxes_list:
-            if pred_box["label"] == class_id:
-                class_predicted_boxes.append(pred_box)
-        for gt_box in gt_boxes_list:
-            if gt_box["label"] == class_id:
-                class_gt_boxes.append(gt_box)
-
-        # Determine how many gt boxes (of class_id) there are in each image
-        num_gt_boxes_per_img = Counter([gt["img_idx"] for gt in class_gt_boxes])
-
-        # Initialize dict where we'll keep track of whether a gt box has been matched to a
-        # prediction yet. This is necessary because if multiple predicted boxes of class_id
-        # overlap with a single gt box, only one of the predicted boxes can be considered a
-        # true positive
-        img_idx_to_gtboxismatched_array = {}
-        for img_idx, num_gt_boxes in num_gt_boxes_per_img.items():
-            img_idx_to_gtboxismatched_array[img_idx] = np.zeros(num_gt_boxes)
-
-        # Sort all predicted boxes (of class_id) by descending confidence
-        class_predicted_boxes.sort(key=lambda x: x["score"], reverse=True)
-
-        # Initialize arrays. Once filled in, true_positives[i] indicates (with a 1 or 0)
-        # whether the ith predicted box (of class_id) is a true positive. Likewise for
-        # false_positives array
-        true_positives = np.zeros(len(class_predicted_boxes))
-        false_positives = np.zeros(len(class_predicted_boxes))
-
-        # Iterating over all predicted boxes of class_id
-        for pred_idx, pred_box in enumerate(class_predicted_boxes):
-            # Only compare gt boxes from the same image as the predicted box
-            gt_boxes_from_same_img = [
-                gt_box
-                for gt_box in class_gt_boxes
-                if gt_box["img_idx"] == pred_box["img_idx"]
-            ]
+    is_true_positive = np.zeros(len(pred_scores), dtype=bool)
+    is_true_positive[order[candidate_positions[first_match_positions]]] = True
+    is_duplicate = is_candidate & ~is_true_positive
+    return is_true_positive, is_duplicate
 
-            # If there are no gt boxes in the predicted box's image that have the predicted class
-            if len(gt_boxes_from_same_img) == 0:
-                false_positives[pred_idx] = 1
-                continue
-
-            # Iterate over all gt boxes (of class_id) from the same image as the predicted box,
-            # determining which gt box has the highest iou with the predicted box
-            highest_iou = 0
-            for gt_idx, gt_box in enumerate(gt_boxes_from_same_img):
-                iou = _intersection_over_union(pred_box["box"], gt_box["box"])
-                if iou >= highest_iou:
-                    highest_iou = iou
-                    highest_iou_gt_idx = gt_idx
-
-            if highest_iou > iou_threshold:
-                # If the gt box has not yet been covered
-                if (
-                    img_idx_to_gtboxismatched_array[pred_box["img_idx"]][
-                        highest_iou_gt_idx
-                    ]
-                    == 0
-                ):
-                    true_positives[pred_idx] = 1
-
-                    # Record that we've now covered this gt box. Any subsequent
-                    # pred boxes that overlap with it are considered false positives
-                    img_idx_to_gtboxismatched_array[pred_box["img_idx"]][
-                        highest_iou_gt_idx
-                    ] = 1
-                else:
-                    # This gt box was already covered previously (i.e a different predicted
-                    # box was deemed a true positive after overlapping with this gt box)
-                    false_positives[pred_idx] = 1
-            else:
-                false_positives[pred_idx] = 1
 
-        # Cumulative sums of false/true positives across all predictions which were sorted by
-        # descending confidence
-        tp_cumulative_sum = np.cumsum(true_positives)
-        fp_cumulative_sum = np.cumsum(false_positives)
+def _interpolated_average_precision(is_true_positive, total_gt_boxes):
+    """
+    Compute the 11-point interpolated average precision of a single class
 
-        # Total number of gt boxes with a label of class_id
-        total_gt_boxes = len(class_gt_boxes)
+    is_true_positive (np.ndarray): boolean array indicating whether each prediction, sorted by
+        descending confidence, is a true positive (True) or a false positive (False)
+    total_gt_boxes (int): the number of ground-truth boxes of the class
+    """
+    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
+    RECALL_POINTS = np.linspace(0, 1, 11)
 
-        if total_gt_boxes > 0:
-            recalls = tp_cumulative_sum / total_gt_boxes
-        else:
-            recalls = np.zeros_like(tp_cumulative_sum)
-
-        precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
-
-        interpolated_precisions = np.zeros(len(RECALL_POINTS))
-        # Interpolate the precision at each recall level by taking the max precision for which
-        # the corresponding recall exceeds the recall point
-        # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
-        for i, recall_point in enumerate(RECALL_POINTS):
-            precisions_points = precisions[np.where(recalls >= recall_point)]
-            # If there's no cutoff at which the recall > recall_point
-            if len(precisions_points) == 0:
-                interpolated_precisions[i] = 0
-            else:
-                interpolated_precisions[i] = max(precisions_points)
+    # Cumulative sums of false/true positives across all predictions which were sorted by
+    # descending confidence
+    tp_cumulative_sum = np.cumsum(is_true_positive)
+    fp_cumulative_sum = np.cumsum(~is_true_positive)
 
-        # Compute mean precision across the different recall levels
-        average_precision = interpolated_precisions.mean()
-        average_precisions_by_class[int(class_id)] = np.around(
-            average_precision, decimals=2
-        )
+    if total_gt_boxes > 0:
+        recalls = tp_cumulative_sum / total_gt_boxes
+    else:
+        recalls = np.zeros_like(tp_cumulative_sum)
+
+    precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
 
-    return average_precisions_by_class
+    # Interpolate the precision at each recall level by taking the max precision for which
+    # the corresponding recall exceeds the recall point
+    # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
+    # Recalls are non-decreasing, so this is the suffix max of the precisions, starting at
+    # the first cutoff whose recall exceeds the recall point
+    interpolated_precisions = np.zeros(len(RECALL_POINTS))
+    if len(precisions):
+        suffix_max_precisions = np.maximum.accumulate(precisions[::-1])[::-1]
+        cutoffs = np.searchsorted(recalls, RECALL_POINTS, side="left")
+        # If there's no cutoff at which the recall > recall_point, the precision is 0
+        has_cutoff = cutoffs < len(precisions)
+        interpolated_precisions[has_cutoff] = suffix_max_precisions[cutoffs[has_cutoff]]
+
+    # Compute mean precision across the different recall levels
+    average_precision = interpolated_precisions.mean()
+    return np.around(average_precision, decimals=2)
 
 
 def object_detection_mAP(y_list, y_pred_list, iou_threshold=0.5, class_list=None):
@@ -738,6 +848,8 @@ def _object_detection_get_tpr_mr_dr_hr(
     to the number of images.
     """
 
+    _check_object_detection_input(y_list, y_pred_list)
+
     true_positive_rate_per_img = []
     misclassification_rate_per_img = []
     disappearance_rate_per_img = []
@@ -752,15 +864,6 @@ def _object_detection_get_tpr_mr_dr_hr(
             gt_boxes = y["boxes"]
             gt_labels = y["labels"]
 
-        # initialize count of hallucinations
-        num_hallucinations = 0
-        num_gt_boxes = len(gt_boxes)
-
-        # Initialize arrays that will indicate whether each respective ground-truth
-        # box is a true positive or misclassified
-        true_positive_array = np.zeros((num_gt_boxes,))
-        misclassification_array = np.zeros((num_gt_boxes,))
-
         # Only consider the model's confident predictions
         conf_pred_indices = np.where(y_pred["scores"] > score_threshold)[0]
         if class_list:
@@ -768,37 +871,29 @@ def _object_detection_get_tpr_mr_dr_hr(
             conf_pred_indices = conf_pred_indices[
                 np.isin(y_pred["labels"][conf_pred_indices], class_list)
             ]
+        conf_pred_boxes = y_pred["boxes"][conf_pred_indices]
+        conf_pred_labels = y_pred["labels"][conf_pred_indices]
+
+        # Compute the iou between every confident predicted box and every ground-truth box,
+        # and determine which pairs overlap
+        ious = _intersection_over_union_matrix(conf_pred_boxes, gt_boxes)
+        overlaps = ious.astype(float) > iou_threshold
+        same_label = np.reshape(conf_pred_labels, (-1, 1)) == np.reshape(
+            gt_labels, (1, -1)
+        )
 
-        # For each confident prediction
-        for y_pred_idx in conf_pred_indices:
-            y_pred_box = y_pred["boxes"][y_pred_idx]
-
-            # Compute the iou between the predicted box and the ground-truth boxes
-            ious = np.array([_intersection_over_union(y_pred_box, a) for a in gt_boxes])
-
-            # Determine which ground-truth boxes, if any, the predicted box overlaps with
-            overlap_indices = np.where(ious > iou_threshold)[0]
-
-            # If the predicted box doesn't overlap with any ground-truth boxes, increment
-            # the hallucination counter and move on to the next predicted box
-            if len(overlap_indices) == 0:
-                num_hallucinations += 1
-                continue
+        # A predicted box that doesn't overlap with any ground-truth boxes is a hallucination
+        num_hallucinations = int(np.count_nonzero(~overlaps.any(axis=1)))
 
-            # For each ground-truth box that the prediction overlaps with
-            for y_idx in overlap_indices:
-                # If the predicted label is correct, mark that the ground-truth
-                # box has a true positive prediction
-                if gt_labels[y_idx] == y_pred["labels"][y_pred_idx]:
-                    true_positive_array[y_idx] = 1
-                else:
-                    # Otherwise mark that the ground-truth box has a misclassification
-                    misclassification_array[y_idx] = 1
+        # A ground-truth box is a true positive if an overlapping predicted box has the
+        # correct label, and is misclassified if an overlapping predicted box has an
+        # incorrect label. Multiple predicted boxes overlapping with a single ground-truth
+        # box are not double-counted
+        true_positive_array = (overlaps & same_label).any(axis=0)
+        misclassification_array = (overlaps & ~same_label).any(axis=0)
 
-        # Convert these arrays to binary to avoid double-counting (i.e. when multiple
-        # predicted boxes overlap with a single ground-truth box)
-        true_positive_rate = (true_positive_array > 0).mean()
-        misclassification_rate = (misclassification_array > 0).mean()
+        true_positive_rate = true_positive_array.mean()
+        misclassification_rate = misclassification_array.mean()
 
         # Any ground-truth box that had no overlapping predicted box is considered a
         # disappearance
@@ -836,7 +931,6 @@ def object_detection_true_positive_rate(
     returns: a list of length equal to the number of images.
     """
 
-    _check_object_detection_input(y_list, y_pred_list)
     true_positive_rate_per_img, _, _, _ = _object_detection_get_tpr_mr_dr_hr(
         y_list,
         y_pred_list,
@@ -866,8 +960,7 @@ def object_detection_misclassification_rate(
     returns: a list of length equal to the number of images
     """
 
-    _check_object_detection_input(y_list, y_pred_list)
-    _, misclassification_rate_per_image, _, _ = _object_detection_get_tpr_mr_dr_hr(
+    (_, misclassification_rate_per_image, _, _,) = _object_detection_get_tpr_mr_dr_hr(
         y_list,
         y_pred_list,
         iou_threshold=iou_threshold,
@@ -897,7 +990,6 @@ def object_detection_disappearance_rate(
     returns: a list of length equal to the number of images
     """
 
-    _check_object_detection_input(y_list, y_pred_list)
     _, _, disappearance_rate_per_img, _ = _object_detection_get_tpr_mr_dr_hr(
         y_list,
         y_pred_list,
@@ -927,7 +1019,6 @@ def object_detection_hallucinations_per_image(
     returns: a list of length equal to the number of images
     """
 
-    _check_object_detection_input(y_list, y_pred_list)
     _, _, _, hallucinations_per_image = _object_detection_get_tpr_mr_dr_hr(
         y_list,
         y_pred_list,
@@ -1045,160 +1136,9 @@ def apricot_patch_targeted_AP_per_class(y_list, y_pred_list, iou_threshold=0.1):
         list should be a dict with "labels", "boxes", and "scores" keys mapping to a numpy
         array of shape (N,), (N, 4), and (N,) respectively where N = number of boxes.
     """
-    _check_object_detection_input(y_list, y_pred_list)
-
-    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
-    RECALL_POINTS = np.linspace(0, 1, 11)
-
-    # Converting boxes to a list of dicts (a list for predicted boxes that overlap with the patch,
-    # and a separate list for ground truth patch boxes), where each dict corresponds to a box and
-    # has the following keys "img_idx", "label", "box", as well as "score" for predicted boxes
-    patch_boxes_list = []
-    overlappping_pred_boxes_list = []
-    for img_idx, (y, y_pred) in enumerate(zip(y_list, y_pred_list)):
-        idx_of_patch = np.where(
-            y["labels"].flatten() == ADV_PATCH_MAGIC_NUMBER_LABEL_ID
-        )[0]
-        patch_box = y["boxes"].reshape((-1, 4))[idx_of_patch].flatten()
-        patch_id = int(y["patch_id"].flatten()[idx_of_patch])
-        patch_target_label = APRICOT_PATCHES[patch_id]["adv_target"]
-        patch_box_dict = {
-            "img_idx": img_idx,
-            "label": patch_target_label,
-            "box": patch_box,
-        }
-        patch_boxes_list.append(patch_box_dict)
-
-        for pred_box_idx in range(y_pred["labels"].size):
-            box = y_pred["boxes"][pred_box_idx]
-            if _intersection_over_union(box, patch_box) > iou_threshold:
-                label = y_pred["labels"][pred_box_idx]
-                score = y_pred["scores"][pred_box_idx]
-                pred_box_dict = {
-                    "img_idx": img_idx,
-                    "label": label,
-                    "box": box,
-                    "score": score,
-                }
-                overlappping_pred_boxes_list.append(pred_box_dict)
-
-    # Union of (1) the set of classes targeted by patches and (2) the set of all classes
-    # predicted at a location that overlaps the patch in the image
-    set_of_class_ids = set([i["label"] for i in patch_boxes_list]) | set(
-        [i["label"] for i in overlappping_pred_boxes_list]
-    )
-
-    # Initialize dict that will store AP for each class
-    average_precisions_by_class = {}
-
-    # Compute AP for each class
-    for class_id in set_of_class_ids:
-        # Build lists that contain all the predicted and patch boxes with a
-        # label of class_id
-        class_predicted_boxes = []
-        class_patch_boxes = []
-        for pred_box in overlappping_pred_boxes_list:
-            if pred_box["label"] == class_id:
-                class_predicted_boxes.append(pred_box)
-        for patch_box in patch_boxes_list:
-            if patch_box["label"] == class_id:
-                class_patch_boxes.append(patch_box)
-
-        # Determine how many patch boxes (of class_id) there are in each image
-        num_patch_boxes_per_img = Counter([gt["img_idx"] for gt in class_patch_boxes])
-
-        # Initialize dict where we'll keep track of whether a patch box has been matched to a
-        # prediction yet. This is necessary because if multiple predicted boxes of class_id
-        # overlap with a patch box, only one of the predicted boxes can be considered a
-        # true positive. The rest will be ignored
-        img_idx_to_patchboxismatched_array = {}
-        for img_idx, num_patch_boxes in num_patch_boxes_per_img.items():
-            img_idx_to_patchboxismatched_array[img_idx] = np.zeros(num_patch_boxes)
-
-        # Sort all predicted boxes (of class_id) by descending confidence
-        class_predicted_boxes.sort(key=lambda x: x["score"], reverse=True)
-
-        # Initialize list. Once filled in, true_positives[i] indicates (with a 1 or 0)
-        # whether the ith predicted box (of class_id) is a true positive or false positive
-        is_true_positive = []
-
-        # Iterating over all predicted boxes of class_id
-        for pred_idx, pred_box in enumerate(class_predicted_boxes):
-            # Only compare patch boxes from the same image as the predicted box
-            patch_boxes_from_same_img = [
-                patch_box
-                for patch_box in class_patch_boxes
-                if patch_box["img_idx"] == pred_box["img_idx"]
-            ]
-
-            # If there are no patch boxes in the predicted box's image that target the predicted class
-            if len(patch_boxes_from_same_img) == 0:
-                is_true_positive.append(0)
-                continue
-
-            # Iterate over all patch boxes (of class_id) from the same image as the predicted box,
-            # determining which patch box has the highest iou with the predicted box.
-            highest_iou = 0
-            for patch_idx, patch_box in enumerate(patch_boxes_from_same_img):
-                iou = _intersection_over_union(pred_box["box"], patch_box["box"])
-                if iou >= highest_iou:
-                    highest_iou = iou
-                    highest_iou_patch_idx = patch_idx
-
-            # If the patch box has not yet been covered
-            if (
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ]
-                == 0
-            ):
-                is_true_positive.append(1)
-
-                # Record that we've now covered this patch box. Any subsequent
-                # pred boxes that overlap with it are ignored
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ] = 1
-            else:
-                # This patch box was already covered previously (i.e a different predicted
-                # box was deemed a true positive after overlapping with this patch box).
-                # The predicted box is thus ignored.
-                continue
-
-        # Cumulative sums of false/true positives across all predictions which were sorted by
-        # descending confidence
-        tp_cumulative_sum = np.cumsum(is_true_positive)
-        fp_cumulative_sum = np.cumsum([not i for i in is_true_positive])
-
-        # Total number of patch boxes with a label of class_id
-        total_patch_boxes = len(class_patch_boxes)
-
-        if total_patch_boxes > 0:
-            recalls = tp_cumulative_sum / total_patch_boxes
-        else:
-            recalls = np.zeros_like(tp_cumulative_sum)
-
-        precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
-
-        interpolated_precisions = np.zeros(len(RECALL_POINTS))
-        # Interpolate the precision at each recall level by taking the max precision for which
-        # the corresponding recall exceeds the recall point
-        # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
-        for i, recall_point in enumerate(RECALL_POINTS):
-            precisions_points = precisions[np.where(recalls >= recall_point)]
-            # If there's no cutoff at which the recall > recall_point
-            if len(precisions_points) == 0:
-                interpolated_precisions[i] = 0
-            else:
-                interpolated_precisions[i] = max(precisions_points)
-
-        # Compute mean precision across the different recall levels
-        average_precision = interpolated_precisions.mean()
-        average_precisions_by_class[int(class_id)] = np.around(
-            average_precision, decimals=2
-        )
-
-    return average_precisions_by_class
+    accumulator = ApricotPatchTargetedAPAccumulator(iou_threshold=iou_threshold)
+    accumulator.update(y_list, y_pred_list)
+    return accumulator.compute()
 
 
 def dapricot_patch_targeted_AP_per_class(y_list, y_pred_list, iou_threshold=0.1):
@@ -1234,154 +1174,261 @@ def dapricot_patch_targeted_AP_per_class(y_list, y_pred_list, iou_threshold=0.1)
         array of shape (N,), (N, 4), and (N,) respectively where N = number of boxes.
 
     """
-    _check_object_detection_input(y_list, y_pred_list)
+    accumulator = DApricotPatchTargetedAPAccumulator(iou_threshold=iou_threshold)
+    accumulator.update(y_list, y_pred_list)
+    return accumulator.compute()
 
-    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
-    RECALL_POINTS = np.linspace(0, 1, 11)
 
-    # Converting boxes to a list of dicts (a list for predicted boxes that overlap with the patch,
-    # and a separate list for ground truth patch boxes), where each dict corresponds to a box and
-    # has the following keys "img_idx", "label", "box", as well as "score" for predicted boxes
-    patch_boxes_list = []
-    overlappping_pred_boxes_list = []
-    for img_idx, (y, y_pred) in enumerate(zip(y_list, y_pred_list)):
-        patch_box = y["boxes"].flatten()
-        patch_target_label = int(y["labels"])
-        patch_box_dict = {
-            "img_idx": img_idx,
-            "label": patch_target_label,
-            "box": patch_box,
-        }
-        patch_boxes_list.append(patch_box_dict)
-
-        for pred_box_idx in range(y_pred["labels"].size):
-            box = y_pred["boxes"][pred_box_idx]
-            if _intersection_over_union(box, patch_box) > iou_threshold:
-                label = y_pred["labels"][pred_box_idx]
-                score = y_pred["scores"][pred_box_idx]
-                pred_box_dict = {
-                    "img_idx": img_idx,
-                    "label": label,
-                    "box": box,
-                    "score": score,
-                }
-                overlappping_pred_boxes_list.append(pred_box_dict)
+class AveragePrecisionAccumulator:
+    """
+    Incrementally computes an average precision metric for object detection
 
-    # Only compute AP of classes targeted by patches. The D-APRICOT dataset in some
-    # cases contains unlabeled COCO objects in the background
-    set_of_class_ids = set([i["label"] for i in patch_boxes_list])
-
-    # Initialize dict that will store AP for each class
-    average_precisions_by_class = {}
-
-    # Compute AP for each class
-    for class_id in set_of_class_ids:
-        # Build lists that contain all the predicted and patch boxes with a
-        # label of class_id
-        class_predicted_boxes = []
-        class_patch_boxes = []
-        for pred_box in overlappping_pred_boxes_list:
-            if pred_box["label"] == class_id:
-                class_predicted_boxes.append(pred_box)
-        for patch_box in patch_boxes_list:
-            if patch_box["label"] == class_id:
-                class_patch_boxes.append(patch_box)
-
-        # Determine how many patch boxes (of class_id) there are in each image
-        num_patch_boxes_per_img = Counter([gt["img_idx"] for gt in class_patch_boxes])
-
-        # Initialize dict where we'll keep track of whether a patch box has been matched to a
-        # prediction yet. This is necessary because if multiple predicted boxes of class_id
-        # overlap with a patch box, only one of the predicted boxes can be considered a
-        # true positive. The rest will be ignored
-        img_idx_to_patchboxismatched_array = {}
-        for img_idx, num_patch_boxes in num_patch_boxes_per_img.items():
-            img_idx_to_patchboxismatched_array[img_idx] = np.zeros(num_patch_boxes)
-
-        # Sort all predicted boxes (of class_id) by descending confidence
-        class_predicted_boxes.sort(key=lambda x: x["score"], reverse=True)
-
-        # Initialize list. Once filled in, true_positives[i] indicates (with a 1 or 0)
-        # whether the ith predicted box (of class_id) is a true positive or false positive
-        is_true_positive = []
-
-        # Iterating over all predicted boxes of class_id
-        for pred_idx, pred_box in enumerate(class_predicted_boxes):
-            # Only compare patch boxes from the same image as the predicted box
-            patch_boxes_from_same_img = [
-                patch_box
-                for patch_box in class_patch_boxes
-                if patch_box["img_idx"] == pred_box["img_idx"]
-            ]
+    Rather than retaining every label and prediction until the end of an evaluation, each
+    call to update() matches a batch's predicted boxes to its ground-truth boxes right away.
+    Only the scores and true positive indicators of the predicted boxes and the number of
+    ground-truth boxes are kept for each class. compute() can be called at any point to get
+    the AP per class of all samples seen so far.
 
-            # If there are no patch boxes in the predicted box's image that target the predicted class
-            if len(patch_boxes_from_same_img) == 0:
-                is_true_positive.append(0)
-                continue
-
-            # Iterate over all patch boxes (of class_id) from the same image as the predicted box,
-            # determining which patch box has the highest iou with the predicted box.
-            highest_iou = 0
-            for patch_idx, patch_box in enumerate(patch_boxes_from_same_img):
-                iou = _intersection_over_union(pred_box["box"], patch_box["box"])
-                if iou >= highest_iou:
-                    highest_iou = iou
-                    highest_iou_patch_idx = patch_idx
-
-            # If the patch box has not yet been covered
-            if (
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ]
-                == 0
-            ):
-                is_true_positive.append(1)
+    Subclasses implement _match(), which is called on each batch.
+    """
 
-                # Record that we've now covered this patch box. Any subsequent
-                # pred boxes that overlap with it are ignored
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ] = 1
-            else:
-                # This patch box was already covered previously (i.e a different predicted
-                # box was deemed a true positive after overlapping with this patch box).
-                # The predicted box is thus ignored.
-                continue
+    # Whether classes which are only predicted, and not in the ground truth, are reported
+    include_predicted_classes = True
 
-        # Cumulative sums of false/true positives across all predictions which were sorted by
-        # descending confidence
-        tp_cumulative_sum = np.cumsum(is_true_positive)
-        fp_cumulative_sum = np.cumsum([not i for i in is_true_positive])
+    def __init__(self):
+        self.clear()
 
-        # Total number of patch boxes with a label of class_id
-        total_patch_boxes = len(class_patch_boxes)
+    def clear(self):
+        self._gt_counts = Counter()
+        # dicts are used as insertion-ordered sets of the class ids seen so far
+        self._gt_class_ids = {}
+        self._pred_class_ids = {}
+        self._pred_scores = defaultdict(list)
+        self._pred_is_true_positive = defaultdict(list)
+
+    def _match(self, y_list, y_pred_list):
+        """
+        Match the predicted boxes of a batch to its ground-truth boxes
 
-        if total_patch_boxes > 0:
-            recalls = tp_cumulative_sum / total_patch_boxes
-        else:
-            recalls = np.zeros_like(tp_cumulative_sum)
-
-        precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
-
-        interpolated_precisions = np.zeros(len(RECALL_POINTS))
-        # Interpolate the precision at each recall level by taking the max precision for which
-        # the corresponding recall exceeds the recall point
-        # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
-        for i, recall_point in enumerate(RECALL_POINTS):
-            precisions_points = precisions[np.where(recalls >= recall_point)]
-            # If there's no cutoff at which the recall > recall_point
-            if len(precisions_points) == 0:
-                interpolated_precisions[i] = 0
-            else:
-                interpolated_precisions[i] = max(precisions_points)
+        returns: a tuple (gt_labels, pred_labels, pred_scores, is_true_positive) of flat
+            arrays, where predictions that should be ignored have already been removed
+        """
+        raise NotImplementedError
+
+    def _filter_class_ids(self, set_of_class_ids):
+        return set_of_class_ids
+
+    def update(self, y_list, y_pred_list):
+        _check_object_detection_input(y_list, y_pred_list)
+        gt_labels, pred_labels, pred_scores, is_true_positive = self._match(
+            y_list, y_pred_list
+        )
+
+        gt_labels = gt_labels.tolist()
+        self._gt_counts.update(gt_labels)
+        self._gt_class_ids.update(dict.fromkeys(gt_labels))
+
+        # Split the predictions by class
+        order = np.argsort(pred_labels, kind="stable")
+        class_ids, class_starts = np.unique(pred_labels[order], return_index=True)
+        class_ids = class_ids.tolist()
+        self._pred_class_ids.update(dict.fromkeys(pred_labels.tolist()))
+        for class_id, class_indices in zip(
+            class_ids, np.split(order, class_starts[1:])
+        ):
+            self._pred_scores[class_id].append(pred_scores[class_indices])
+            self._pred_is_true_positive[class_id].append(
+                is_true_positive[class_indices]
+            )
+
+    def _class_predictions(self, class_id):
+        """
+        Return the scores and true positive indicators of all predictions of class_id
+        """
+        if class_id not in self._pred_scores:
+            return np.zeros(0), np.zeros(0, dtype=bool)
+        # Consolidate the per-batch arrays so that later calls don't concatenate them again
+        scores = np.concatenate(self._pred_scores[class_id])
+        is_true_positive = np.concatenate(self._pred_is_true_positive[class_id])
+        self._pred_scores[class_id] = [scores]
+        self._pred_is_true_positive[class_id] = [is_true_positive]
+        return scores, is_true_positive
+
+    def compute(self):
+        """
+        Return a dictionary mapping each class to its average precision (AP)
+        """
+        set_of_class_ids = set(self._gt_class_ids)
+        if self.include_predicted_classes:
+            set_of_class_ids |= set(self._pred_class_ids)
+        set_of_class_ids = self._filter_class_ids(set_of_class_ids)
+
+        average_precisions_by_class = {}
+        for class_id in set_of_class_ids:
+            scores, is_true_positive = self._class_predictions(class_id)
+            # Sort all predicted boxes (of class_id) by descending confidence. Predictions
+            # were stored in the order they were seen, so a stable sort breaks ties by image
+            order = np.argsort(-scores, kind="stable")
+            average_precisions_by_class[
+                int(class_id)
+            ] = _interpolated_average_precision(
+                is_true_positive[order], self._gt_counts[class_id]
+            )
+        return average_precisions_by_class
+
+
+class ObjectDetectionAPAccumulator(AveragePrecisionAccumulator):
+    """
+    Incremental version of object_detection_AP_per_class
+    """
+
+    def __init__(self, iou_threshold=0.5, class_list=None):
+        self.iou_threshold = iou_threshold
+        self.class_list = class_list
+        super().__init__()
+
+    def _filter_class_ids(self, set_of_class_ids):
+        if self.class_list:
+            # Filter out classes not in class_list
+            set_of_class_ids = set(i for i in set_of_class_ids if i in self.class_list)
+
+        # Remove the class ID that corresponds to a physical adversarial patch in APRICOT
+        # dataset, if present
+        set_of_class_ids.discard(ADV_PATCH_MAGIC_NUMBER_LABEL_ID)
+        return set_of_class_ids
+
+    def _match(self, y_list, y_pred_list):
+        gt_img_idx, gt_labels, gt_boxes = _object_detection_flatten_boxes(y_list)
+        (
+            pred_img_idx,
+            pred_labels,
+            pred_boxes,
+            pred_scores,
+        ) = _object_detection_flatten_boxes(y_pred_list, with_scores=True)
+
+        # For each predicted box, find the gt box of the same image and class with which it
+        # has the highest iou. Only the most confident prediction whose iou with a gt box
+        # exceeds the threshold is a true positive; any others are false positives
+        best_gt_idx, best_iou = _object_detection_best_gt_matches(
+            gt_img_idx, gt_labels, gt_boxes, pred_img_idx, pred_labels, pred_boxes
+        )
+        is_true_positive, _ = _object_detection_greedy_match(
+            pred_scores, best_gt_idx, best_iou > self.iou_threshold
+        )
+        return gt_labels, pred_labels, pred_scores, is_true_positive
+
+
+class CarlaODAPAccumulator(ObjectDetectionAPAccumulator):
+    """
+    Incremental version of carla_od_AP_per_class
+    """
+
+    def __init__(self, iou_threshold=0.5):
+        super().__init__(iou_threshold=iou_threshold, class_list=[1, 2, 3])
+
+
+class _PatchTargetedAPAccumulator(AveragePrecisionAccumulator):
+    """
+    Shared implementation of the APRICOT and D-APRICOT patch targeted AP accumulators.
+
+    Subclasses implement _patch_boxes(), which returns a list of dicts, one per image, with
+    "labels" and "boxes" keys holding the patch's target label and its box.
+    """
 
-        # Compute mean precision across the different recall levels
-        average_precision = interpolated_precisions.mean()
-        average_precisions_by_class[int(class_id)] = np.around(
-            average_precision, decimals=2
+    def __init__(self, iou_threshold=0.1):
+        self.iou_threshold = iou_threshold
+        super().__init__()
+
+    def _patch_boxes(self, y_list):
+        raise NotImplementedError
+
+    def _match(self, y_list, y_pred_list):
+        patch_img_idx, patch_labels, patch_boxes = _object_detection_flatten_boxes(
+            self._patch_boxes(y_list)
+        )
+        (
+            pred_img_idx,
+            pred_labels,
+            pred_boxes,
+            pred_scores,
+        ) = _object_detection_flatten_boxes(y_pred_list, with_scores=True)
+
+        # Only keep the predicted boxes that overlap with the patch in their image
+        overlaps_patch = np.zeros(len(pred_img_idx), dtype=bool)
+        pred_bounds = np.searchsorted(pred_img_idx, np.arange(len(patch_boxes) + 1))
+        for img_idx, patch_box in enumerate(patch_boxes):
+            pred_start, pred_end = pred_bounds[img_idx], pred_bounds[img_idx + 1]
+            ious = _intersection_over_union_matrix(
+                pred_boxes[pred_start:pred_end], patch_box[np.newaxis]
+            )
+            # Compare in float64, as boxes may be float32
+            overlaps_patch[pred_start:pred_end] = (
+                ious[:, 0].astype(float) > self.iou_threshold
+            )
+        pred_img_idx = pred_img_idx[overlaps_patch]
+        pred_labels = pred_labels[overlaps_patch]
+        pred_boxes = pred_boxes[overlaps_patch]
+        pred_scores = pred_scores[overlaps_patch]
+
+        # Every overlapping prediction of the patch's target class is matched to the patch.
+        # Since the patch can only be covered once, duplicate matches are ignored
+        best_gt_idx, _ = _object_detection_best_gt_matches(
+            patch_img_idx,
+            patch_labels,
+            patch_boxes,
+            pred_img_idx,
+            pred_labels,
+            pred_boxes,
+        )
+        is_true_positive, is_duplicate = _object_detection_greedy_match(
+            pred_scores, best_gt_idx, best_gt_idx >= 0
         )
+        keep = ~is_duplicate
+        return (
+            patch_labels,
+            pred_labels[keep],
+            pred_scores[keep],
+            is_true_positive[keep],
+        )
+
+
+class ApricotPatchTargetedAPAccumulator(_PatchTargetedAPAccumulator):
+    """
+    Incremental version of apricot_patch_targeted_AP_per_class
+    """
+
+    # Classes predicted at a location that overlaps the patch are also reported
+    include_predicted_classes = True
+
+    def _patch_boxes(self, y_list):
+        patch_boxes_list = []
+        for y in y_list:
+            idx_of_patch = np.where(
+                y["labels"].flatten() == ADV_PATCH_MAGIC_NUMBER_LABEL_ID
+            )[0]
+            patch_box = y["boxes"].reshape((-1, 4))[idx_of_patch].flatten()
+            patch_id = int(y["patch_id"].flatten()[idx_of_patch])
+            patch_target_label = APRICOT_PATCHES[patch_id]["adv_target"]
+            patch_boxes_list.append(
+                {"labels": np.array([patch_target_label]), "boxes": patch_box}
+            )
+        return patch_boxes_list
+
 
-    return average_precisions_by_class
+class DApricotPatchTargetedAPAccumulator(_PatchTargetedAPAccumulator):
+    """
+    Incremental version of dapricot_patch_targeted_AP_per_class
+    """
+
+    # Only compute AP of classes targeted by patches. The D-APRICOT dataset in some
+    # cases contains unlabeled COCO objects in the background
+    include_predicted_classes = False
+
+    def _patch_boxes(self, y_list):
+        return [
+            {"labels": np.array([int(y["labels"])]), "boxes": y["boxes"].flatten()}
+            for y in y_list
+        ]
 
 
 def dapricot_patch_target_success(
@@ -1451,6 +1498,7 @@ SUPPORTED_METRICS = {
     "mars_mean_l2": mars_mean_l2,
     "mars_mean_patch": mars_mean_patch,
     "word_error_rate": word_error_rate,
+    "character_error_rate": character_error_rate,
     "object_detection_AP_per_class": object_detection_AP_per_class,
     "object_detection_mAP": object_detection_mAP,
     "object_detection_disappearance_rate": object_detection_disappearance_rate,
@@ -1496,6 +1544,53 @@ for metric_name in "l0", "l1", "l2", "linf", "image_circle_patch_diameter":
         new_metric = video_metric(metric, frame_average=prefix)
         SUPPORTED_METRICS[new_metric_name] = new_metric
 
+# Non-elementwise metrics which can be updated batch by batch, so that the labels and
+# predictions of every sample don't need to be kept until the end of the evaluation
+SUPPORTED_ACCUMULATORS = {
+    "object_detection_AP_per_class": ObjectDetectionAPAccumulator,
+    "carla_od_AP_per_class": CarlaODAPAccumulator,
+    "apricot_patch_targeted_AP_per_class": ApricotPatchTargetedAPAccumulator,
+    "dapricot_patch_targeted_AP_per_class": DApricotPatchTargetedAPAccumulator,
+}
+
+# Elementwise metrics whose values are one of the lists returned by a function that they
+# share, along with the arguments that the metric fixes. When MetricsLogger updates these
+# metrics with a batch, the shared function is only called once per set of arguments
+SHARED_RESULT_METRICS = {
+    "object_detection_true_positive_rate": (_object_detection_get_tpr_mr_dr_hr, 0, {}),
+    "object_detection_misclassification_rate": (
+        _object_detection_get_tpr_mr_dr_hr,
+        1,
+        {},
+    ),
+    "object_detection_disappearance_rate": (_object_detection_get_tpr_mr_dr_hr, 2, {}),
+    "object_detection_hallucinations_per_image": (
+        _object_detection_get_tpr_mr_dr_hr,
+        3,
+        {},
+    ),
+    "carla_od_true_positive_rate": (
+        _object_detection_get_tpr_mr_dr_hr,
+        0,
+        {"class_list": [1, 2, 3]},
+    ),
+    "carla_od_misclassification_rate": (
+        _object_detection_get_tpr_mr_dr_hr,
+        1,
+        {"class_list": [1, 2, 3]},
+    ),
+    "carla_od_disappearance_rate": (
+        _object_detection_get_tpr_mr_dr_hr,
+        2,
+        {"class_list": [1, 2, 3]},
+    ),
+    "carla_od_hallucinations_per_image": (
+        _object_detection_get_tpr_mr_dr_hr,
+        3,
+        {"class_list": [1, 2, 3]},
+    ),
+}
+
 
 class MetricList:
     """
@@ -1516,14 +1611,56 @@ class MetricList:
         self._values = []
         self._input_labels = []
         self._input_preds = []
+        if function is None:
+            self._accumulator_class = SUPPORTED_ACCUMULATORS.get(name)
+            self._shared_result = SHARED_RESULT_METRICS.get(name)
+        else:
+            self._accumulator_class = None
+            self._shared_result = None
+        self._accumulator = None
 
     def clear(self):
         self._values.clear()
+        self._input_labels.clear()
+        self._input_preds.clear()
+        self._accumulator = None
 
-    def add_results(self, *args, **kwargs):
-        value = self.function(*args, **kwargs)
+    def add_results(self, *args, batch_results=None, **kwargs):
+        """
+        batch_results - optional dict in which the results of the functions in
+            SHARED_RESULT_METRICS are kept, shared by the metrics updated with a batch
+        """
+        if batch_results is None or self._shared_result is None:
+            value = self.function(*args, **kwargs)
+        else:
+            function, index, fixed_kwargs = self._shared_result
+            kwargs = {**kwargs, **fixed_kwargs}
+            key = (function, repr(sorted(kwargs.items())))
+            if key not in batch_results:
+                batch_results[key] = function(*args, **kwargs)
+            value = batch_results[key][index]
         self._values.extend(value)
 
+    def state_dict(self):
+        """
+        Return the results recorded so far, e.g. for checkpointing an evaluation
+        """
+        return {
+            "values": list(self._values),
+            "input_labels": list(self._input_labels),
+            "input_preds": list(self._input_preds),
+            "accumulator": self._accumulator,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Replace the results recorded so far with those of state_dict()
+        """
+        self._values = list(state["values"])
+        self._input_labels = list(state["input_labels"])
+        self._input_preds = list(state["input_preds"])
+        self._accumulator = state["accumulator"]
+
     def __iter__(self):
         return self._values.__iter__()
 
@@ -1554,9 +1691,30 @@ class MetricList:
                 total_words += wer_tuple[1]
             return float(total_edit_distance / total_words)
         else:
-            raise ValueError("total_wer() only for WER metric")
+            raise ValueError("total_wer() only for WER and CER metrics")
+
+    def add_non_elementwise_results(self, y, y_pred, **kwargs):
+        """
+        Record a batch of labels and predictions for a metric computed over all samples
+
+        If the metric has an accumulator in SUPPORTED_ACCUMULATORS, the batch is processed
+        right away and only the accumulator's compact state is kept. Otherwise, the labels
+        and predictions are retained until compute_non_elementwise_metric() is called.
+        """
+        if self._accumulator_class is None:
+            self.append_input_label(y)
+            self.append_input_pred(y_pred)
+            return
+        if self._accumulator is None:
+            self._accumulator = self._accumulator_class(**kwargs)
+        self._accumulator.update(y, y_pred)
 
     def compute_non_elementwise_metric(self, **kwargs):
+        """
+        Compute the metric over all samples seen so far. This may be called mid-evaluation.
+        """
+        if self._accumulator is not None:
+            return self._accumulator.compute()
         return self.function(self._input_labels, self._input_preds, **kwargs)
 
 
@@ -1665,6 +1823,41 @@ class MetricsLogger:
         for metric in self.tasks + self.adversarial_tasks + self.perturbations:
             metric.clear()
 
+    def state_dict(self):
+        """
+        Return the results recorded so far, e.g. for checkpointing an evaluation
+
+        Deterministic profiler stats are not included, only execution counts and times
+        """
+        state = {
+            key: [metric.state_dict() for metric in getattr(self, key)]
+            for key in ("tasks", "adversarial_tasks", "targeted_tasks", "perturbations")
+        }
+        state["computational_resources"] = {
+            name: {
+                "execution_count": entry["execution_count"],
+                "total_time": entry["total_time"],
+            }
+            for name, entry in self.computational_resource_dict.items()
+        }
+        return state
+
+    def load_state_dict(self, state):
+        """
+        Replace the results recorded so far with those of state_dict()
+        """
+        for key in "tasks", "adversarial_tasks", "targeted_tasks", "perturbations":
+            metrics = getattr(self, key)
+            if len(metrics) != len(state[key]):
+                raise ValueError(
+                    f"state has {len(state[key])} {key} metrics, not {len(metrics)}"
+                )
+            for metric, metric_state in zip(metrics, state[key]):
+                metric.load_state_dict(metric_state)
+        self.computational_resource_dict.clear()
+        for name, entry in state["computational_resources"].items():
+            self.computational_resource_dict[name] = defaultdict(lambda: 0, entry)
+
     def update_task(self, y, y_pred, adversarial=False, targeted=False):
         if targeted and not adversarial:
             raise ValueError("benign task cannot be targeted")
@@ -1675,17 +1868,31 @@ class MetricsLogger:
             if adversarial
             else self.tasks
         )
+        # Results shared by several metrics are only computed once for this batch
+        batch_results = {}
         for task_idx, metric in enumerate(tasks):
             if metric.name in self.non_elementwise_metrics:
-                metric.append_input_label(y)
-                metric.append_input_pred(y_pred)
+                if self.task_kwargs:
+                    metric.add_non_elementwise_results(
+                        y, y_pred, **self.task_kwargs[task_idx]
+                    )
+                else:
+                    metric.add_non_elementwise_results(y, y_pred)
             else:
                 if self.task_kwargs:
-                    metric.add_results(y, y_pred, **self.task_kwargs[task_idx])
+                    metric.add_results(
+                        y,
+                        y_pred,
+                        batch_results=batch_results,
+                        **self.task_kwargs[task_idx],
+                    )
                 else:
-                    metric.add_results(y, y_pred)
+                    metric.add_results(y, y_pred, batch_results=batch_results)
 
     def update_perturbation(self, x, x_adv):
+        # Padded batches are compared sample by sample, without their padding
+        x_adv = unpad_batch(x_adv, x)
+        x = unpad_batch(x)
         for metric in self.perturbations:
             metric.add_results(x, x_adv)
 
@@ -1714,11 +1921,11 @@ class MetricsLogger:
             task_type = "benign"
 
         for task_idx, metric in enumerate(metrics):
-            # Do not calculate mean WER, calcuate total WER
-            if metric.name == "word_error_rate":
+            # Do not calculate mean WER or CER, calcuate total WER or CER
+            if metric.name in ERROR_RATE_METRICS:
                 logger.info(
-                    f"Word error rate on {task_type} examples relative to {wrt} labels: "
-                    f"{metric.total_wer():.2%}"
+                    f"{ERROR_RATE_METRICS[metric.name]} on {task_type} examples "
+                    f"relative to {wrt} labels: {metric.total_wer():.2%}"
                 )
             elif metric.name in self.non_elementwise_metrics:
                 if self.task_kwargs:
@@ -1788,12 +1995,13 @@ class MetricsLogger:
                         raise ZeroDivisionError(
                             f"No values to calculate mean in {prefix}_{metric.name}"
                         )
-                if metric.name == "word_error_rate":
+                if metric.name in ERROR_RATE_METRICS:
                     try:
                         results[f"{prefix}_total_{metric.name}"] = metric.total_wer()
                     except ZeroDivisionError:
                         raise ZeroDivisionError(
-                            f"No values to calculate WER in {prefix}_{metric.name}"
+                            f"No values to calculate {ERROR_RATE_METRICS[metric.name]} "
+                            f"in {prefix}_{metric.name}"
                         )
 
         for name in self.computational_resource_dict:
@@ -1808,6 +2016,6 @@ class MetricsLogger:
             results[
                 f"Avg. CPU time (s) for {execution_count} executions of {name}"
             ] = average_time
-            if "stats" in entry:
-                results[f"{name} profiler stats"] = entry["stats"]
+            if "profile" in entry:
+                results[f"{name} profiler stats"] = _profiler_stats(entry["profile"])
         return results
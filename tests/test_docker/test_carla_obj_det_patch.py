@@ -0,0 +1,109 @@
+"""
+Test cases for the CARLA DPatch attack
+"""
+
+import logging
+
+import numpy as np
+from art.estimators.estimator import BaseEstimator, LossGradientsMixin
+from art.estimators.object_detection.object_detector import ObjectDetectorMixin
+
+from armory.art_experimental.attacks import carla_obj_det_patch
+
+
+class FakeDetector(ObjectDetectorMixin, LossGradientsMixin, BaseEstimator):
+    """
+    CPU object detector with random loss gradients, defined at module level so that
+        spawned worker processes can unpickle it
+    """
+
+    estimator_params = BaseEstimator.estimator_params
+    native_label_is_pytorch_format = True
+    channels_first = False
+    input_shape = (48, 64, 3)
+    device = None
+
+    def __init__(self):
+        super().__init__(model=None, clip_values=(0.0, 1.0))
+
+    def predict(self, x, **kwargs):
+        return [
+            {
+                "boxes": np.array([[1.0, 1.0, 5.0, 5.0]]),
+                "labels": np.array([1]),
+                "scores": np.array([x_i.mean()]),
+            }
+            for x_i in x
+        ]
+
+    def loss_gradient(self, x, y, **kwargs):
+        return np.sin(7.0 * x) + 0.1 * np.random.rand(*x.shape)
+
+    def fit(self, x, y, **kwargs):
+        raise NotImplementedError
+
+    def compute_loss(self, x, y, **kwargs):
+        raise NotImplementedError
+
+    def get_activations(self, x, layer, batch_size, framework=False):
+        raise NotImplementedError
+
+
+def make_batch(num_imgs):
+    rng = np.random.RandomState(0)
+    height, width, _ = FakeDetector.input_shape
+    x = rng.rand(num_imgs, height, width, 3).astype(np.float32)
+    patch_metadata = []
+    for _ in range(num_imgs):
+        x0, y0 = rng.randint(5, 15, size=2)
+        gs_coords = np.array(
+            [[x0, y0], [x0 + 30, y0 + 2], [x0 + 31, y0 + 25], [x0 - 1, y0 + 24]]
+        )
+        cc_ground_truth = rng.rand(24, 3) * 255
+        patch_metadata.append(
+            {
+                "gs_coords": gs_coords,
+                "shape": "rect",
+                "mask": (rng.rand(height, width, 3) > 0.1).astype(np.uint8),
+                "cc_ground_truth": cc_ground_truth,
+                "cc_scene": np.clip(cc_ground_truth * 0.8 + 10, 0, 255),
+            }
+        )
+    return x, patch_metadata
+
+
+def generate(estimator, x, patch_metadata, **kwargs):
+    attack = carla_obj_det_patch.CARLADapricotPatch(
+        estimator,
+        max_iter=5,
+        learning_rate=0.1,
+        brightness_range=(0.8, 1.2),
+        verbose=False,
+        **kwargs,
+    )
+    return attack.generate(x, y_patch_metadata=patch_metadata)
+
+
+def test_seeded_pool_matches_serial(caplog):
+    x, patch_metadata = make_batch(3)
+    serial = generate(FakeDetector(), x, patch_metadata, seed=5)
+    with caplog.at_level(logging.INFO):
+        pool = generate(FakeDetector(), x, patch_metadata, seed=5, num_workers=2)
+    assert "Optimizing 3 patches with 2 processes" in caplog.text
+    assert np.array_equal(serial, pool)
+    assert not np.array_equal(serial, x)
+    # Each image has its own seed
+    assert not np.array_equal(
+        serial[1:], generate(FakeDetector(), x[1:], patch_metadata[1:], seed=5)
+    )
+
+
+def test_unpicklable_attack_is_serial(caplog):
+    x, patch_metadata = make_batch(2)
+    estimator = FakeDetector()
+    estimator.callback = lambda: None
+    serial = generate(estimator, x, patch_metadata, seed=5)
+    with caplog.at_level(logging.WARNING):
+        pool = generate(estimator, x, patch_metadata, seed=5, num_workers=2)
+    assert "cannot pickle attack" in caplog.text
+    assert np.array_equal(serial, pool)
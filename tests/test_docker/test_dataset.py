@@ -2,13 +2,16 @@
 Test cases for ARMORY datasets.
 """
 
+import importlib.util
 import os
 
 import pytest
 import numpy as np
+import tensorflow_datasets as tfds
 
 from armory.data import datasets
 from armory.data import adversarial_datasets
+from armory.data import preprocessed_cache
 from armory import paths
 
 DATASET_DIR = paths.DockerPaths().dataset_dir
@@ -168,6 +171,27 @@ def test_filter_by_str_slice():
         assert (target == ys_index).all()
 
 
+def test_select_records():
+    labels = np.array([0, 1, 2, 1, 1, 0, 2, 1])
+    assert datasets._select_records(8).tolist() == list(range(8))
+    assert datasets._select_records(8, labels, class_ids=[1]).tolist() == [1, 3, 4, 7]
+    selected = datasets._select_records(8, labels, class_ids=[1, 2], index=[4, 0, 0])
+    assert selected.tolist() == [1, 6]
+    selected = datasets._select_records(8, labels, class_ids=[0], index="[1:]")
+    assert selected.tolist() == [5]
+    assert datasets._select_records(8, index=":3").tolist() == [0, 1, 2]
+
+    for class_ids, index in (([], None), ([3], None), ([0], [2]), (None, "[8:]")):
+        with pytest.raises(ValueError):
+            datasets._select_records(8, labels, class_ids=class_ids, index=index)
+
+    assert datasets._split_from_records("test", np.array([1, 2, 3, 7, 9, 10])) == [
+        "test[1:4]",
+        "test[7:8]",
+        "test[9:11]",
+    ]
+
+
 def test_parse_split_index_ordering():
     """
     Ensure that output order is deterministic for multiple splits
@@ -723,3 +747,226 @@ def test_numpy_generator():
     )
     x, y = dataset.get_batch()
     assert isinstance(x, np.ndarray)
+
+
+def test_prefetch_batches():
+    def batches(n):
+        for i in range(n):
+            yield np.full((2, 3), i, dtype=np.uint8), np.array([i, i])
+
+    def preprocessing_fn(x):
+        return x.astype(np.float32) / 255
+
+    expected = list(
+        datasets.ArmoryDataGenerator(
+            batches(5),
+            size=10,
+            epochs=1,
+            batch_size=2,
+            preprocessing_fn=preprocessing_fn,
+        )
+    )
+    dataset = datasets.ArmoryDataGenerator(
+        batches(5),
+        size=10,
+        epochs=1,
+        batch_size=2,
+        preprocessing_fn=preprocessing_fn,
+        prefetch_batches=2,
+    )
+    prefetched = list(dataset)
+    assert len(prefetched) == len(expected) == 5
+    for (x, y), (x_expected, y_expected) in zip(prefetched, expected):
+        assert x.dtype == np.float32
+        assert (x == x_expected).all()
+        assert (y == y_expected).all()
+    with pytest.raises(StopIteration):
+        dataset.get_batch()
+
+    with pytest.raises(ValueError):
+        datasets.ArmoryDataGenerator(
+            batches(1), size=2, epochs=1, batch_size=2, prefetch_batches=-1
+        )
+
+
+def test_preprocessed_cache(tmp_path):
+    def batches(n):
+        for i in range(n):
+            yield np.full((2, 3), i, dtype=np.float32), np.array([i, i])
+
+    config = {"dataset_name": "test:1.0.0", "split": "test"}
+    cache = preprocessed_cache.PreprocessedCache(str(tmp_path), config)
+    assert not cache.is_complete()
+
+    # Two epochs of 3 samples in batches of 2
+    recorded = list(cache.record(batches(3), size=3))
+    assert len(recorded) == 3
+    assert cache.is_complete()
+    assert cache.size() == 3
+
+    x, y = cache.load()
+    assert (x[:, 0] == [0, 0, 1]).all()
+    assert (y == [0, 0, 1]).all()
+
+    served = list(cache.batches(batch_size=2, epochs=2))
+    assert len(served) == 3
+    assert (served[1][0][:, 0] == [1, 0]).all()
+    assert (served[2][1] == [0, 1]).all()
+
+    uncached = preprocessed_cache.PreprocessedCache(str(tmp_path), {"split": "train"})
+    y_list = [{"labels": np.array([1])}]
+    assert len(list(uncached.record([(np.zeros((1, 3)), y_list)], size=1))) == 1
+    assert not uncached.is_complete()
+
+
+def test_function_cache_key():
+    key = preprocessed_cache.function_cache_key
+    mnist_key = key(datasets.mnist_canonical_preprocessing)
+    assert mnist_key["function"] == "armory.data.datasets.mnist_canonical_preprocessing"
+    assert mnist_key != key(datasets.cifar10_canonical_preprocessing)
+    chain = datasets.preprocessing_chain(
+        datasets.mnist_canonical_preprocessing, datasets.cifar10_canonical_preprocessing
+    )
+    assert key(chain)["chain"][1] == key(datasets.cifar10_canonical_preprocessing)
+
+    def scale(factor):
+        return lambda x: x * factor
+
+    assert key(scale(2)) == key(scale(2))
+    assert key(scale(2)) != key(scale(3))
+    assert key(scale(np.ones(1))) is None
+    assert key(np.mean) is None
+
+
+def test_function_cache_key_module_function(tmp_path):
+    module_path = tmp_path / "cache_key_module.py"
+
+    def load(body):
+        module_path.write_text(f"def preprocess(x, scale=2):\n    return {body}\n")
+        spec = importlib.util.spec_from_file_location("cache_key_module", module_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return preprocessed_cache.function_cache_key(module.preprocess)
+
+    key = load("x * scale")
+    assert key["function"] == "cache_key_module.preprocess"
+    assert load("x * scale") == key
+    # Editing the body of a module-level function invalidates its cache entries
+    assert load("x * scale + 1") != key
+    assert load("x / scale") != key
+
+
+def test_padded_batches():
+    import tensorflow as tf
+
+    lengths = [3, 7, 2, 6, 4]
+
+    def samples():
+        for i, n in enumerate(lengths):
+            yield np.arange(1, n + 1, dtype=np.int64) * 100, i
+
+    ds = tf.data.Dataset.from_generator(
+        samples, (tf.int64, tf.int64), (tf.TensorShape([None]), tf.TensorShape([]))
+    )
+    batches = list(datasets._padded_batch(ds, 2).as_numpy_iterator())
+    assert [x.shape for x, _, _ in batches] == [(2, 7), (2, 6), (1, 4)]
+    assert batches[0][1].tolist() == [[3], [7]]
+
+    buckets = datasets._padded_batch(ds, 2, bucket_boundaries=[5])
+    batch_lengths = [s[:, 0].tolist() for _, s, _ in buckets.as_numpy_iterator()]
+    assert batch_lengths == [[3, 2], [7, 6], [4]]
+
+    generator = datasets.ArmoryDataGenerator(
+        iter(batches),
+        size=5,
+        epochs=1,
+        batch_size=2,
+        padded=True,
+        preprocessing_fn=datasets.librispeech_canonical_preprocessing,
+    )
+    x, y = generator.get_batch()
+    assert isinstance(x, np.ma.MaskedArray)
+    assert x.dtype == np.float32
+    assert x.shape == (2, 7)
+    assert np.ma.getmaskarray(x)[0].tolist() == [False] * 3 + [True] * 4
+    assert y.tolist() == [0, 1]
+
+    samples = datasets.unpad_batch(x)
+    assert samples.dtype == object
+    assert [len(x_i) for x_i in samples] == [3, 7]
+    assert (samples[0] == np.array([100, 200, 300], dtype=np.float32) / 2 ** 15).all()
+
+    x_adv = np.ma.getdata(x) + 1
+    samples_adv = datasets.unpad_batch(x_adv, x)
+    assert [len(x_i) for x_i in samples_adv] == [3, 7]
+    assert datasets.unpad_batch(x_adv) is x_adv
+
+
+def test_bucketed_batches():
+    import tensorflow as tf
+
+    lengths = [3, 7, 2, 6, 4, 8, 1, 9, 2, 5]
+
+    def samples():
+        for i, n in enumerate(lengths):
+            yield np.full(n, i + 1, dtype=np.int64), i
+
+    ds = tf.data.Dataset.from_generator(
+        samples, (tf.int64, tf.int64), (tf.TensorShape([None]), tf.TensorShape([]))
+    )
+    epochs = 2
+    for shuffle_files in False, True:
+        batched, batches_per_epoch = datasets._batch_dataset(
+            ds,
+            4,
+            epochs,
+            shuffle_files=shuffle_files,
+            variable_length=True,
+            variable_y=False,
+            padded=True,
+            bucket_boundaries=[5],
+        )
+        # 5 samples in each bucket, each ending with a partial batch
+        assert batches_per_epoch == 4
+
+        generator = datasets.ArmoryDataGenerator(
+            iter(tfds.as_numpy(batched)),
+            size=len(lengths),
+            epochs=epochs,
+            batch_size=4,
+            padded=True,
+            batches_per_epoch=batches_per_epoch,
+        )
+        assert len(generator) == epochs * batches_per_epoch
+        for epoch in range(epochs):
+            seen = []
+            for _ in range(batches_per_epoch):
+                x, y = generator.get_batch()
+                assert (x.max(axis=1) == y + 1).all()
+                seen.extend(y.tolist())
+            assert sorted(seen) == list(range(len(lengths)))
+        with pytest.raises(StopIteration):
+            generator.get_batch()
+
+
+def test_canonical_preprocessing():
+    x = np.random.randint(0, 256, size=(3, 28, 28, 1), dtype=np.uint8)
+    x[0, 0, 0, 0] = 255
+    x_canonical = datasets.mnist_canonical_preprocessing(x)
+    assert x_canonical.dtype == np.float32
+    assert (x_canonical == x.astype(np.float32) / 255).all()
+
+    images = np.empty(2, dtype=object)
+    images[0] = np.random.randint(0, 256, size=(28, 28, 3), dtype=np.uint8)
+    images[1] = np.random.randint(0, 256, size=(20, 24, 3), dtype=np.uint8)
+    images_canonical = datasets.gtsrb_canonical_preprocessing(images)
+    for x_i, x_i_canonical in zip(images, images_canonical):
+        assert x_i_canonical.dtype == np.float32
+        assert (x_i_canonical == x_i.astype(np.float32) / 255).all()
+
+    audio = np.array([[-(2 ** 15), 0, 2 ** 15 - 1]], dtype=np.int64)
+    audio_canonical = datasets.librispeech_canonical_preprocessing(audio)
+    assert audio_canonical.dtype == np.float32
+    assert audio_canonical.tolist() == [[-1.0, 0.0, (2 ** 15 - 1) / 2 ** 15]]
+    with pytest.raises(AssertionError):
+        datasets.librispeech_canonical_preprocessing(audio * 2)
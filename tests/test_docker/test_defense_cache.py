@@ -0,0 +1,39 @@
+"""
+Test cases for the cache of poison filtering defense classifiers
+"""
+
+import numpy as np
+
+from armory.utils import defense_cache
+
+
+class FakeClassifier:
+    def __init__(self):
+        self.calls = 0
+
+    def get_activations(self, x, layer, batch_size=128, framework=False):
+        self.calls += 1
+        return x.reshape(len(x), -1).sum(axis=1, keepdims=True) * (layer + 1)
+
+
+def test_cache_activations(tmp_path):
+    x = np.random.rand(10, 4, 3).astype(np.float32)
+    config = {"x_poison": defense_cache.array_digest(x)}
+    expected = FakeClassifier().get_activations(x, 2)
+
+    for cached_run in False, True:
+        classifier = FakeClassifier()
+        cache = defense_cache.DefenseCache(str(tmp_path), config)
+        cache.cache_activations(classifier, x)
+        batches = [classifier.get_activations(x[i : i + 4], 2) for i in (0, 4, 8)]
+        assert np.array_equal(np.concatenate(batches), expected)
+        assert np.array_equal(classifier.get_activations(x, 2), expected)
+        assert classifier.calls == (0 if cached_run else 3)
+
+        # Copies of x are not cached
+        classifier.get_activations(x.copy(), 2)
+        assert classifier.calls == (1 if cached_run else 4)
+
+    other = defense_cache.DefenseCache(str(tmp_path), {"x_poison": "other"})
+    assert other.path != cache.path
+    assert defense_cache.array_digest(x) != defense_cache.array_digest(x[:-1])
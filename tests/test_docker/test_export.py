@@ -0,0 +1,156 @@
+"""
+Test cases for the background writes of SampleExporter
+"""
+
+import os
+import pickle
+import threading
+
+import numpy as np
+import pytest
+
+from armory.data.datasets import AudioContext, ImageContext, So2SatContext
+from armory.utils import export
+from armory.utils.export import SampleExporter
+
+
+def image_batch(rng, batch_size):
+    return rng.rand(batch_size, 8, 8, 3).astype(np.float32)
+
+
+def audio_batch(rng, batch_size):
+    return rng.uniform(-1, 1, (batch_size, 400)).astype(np.float32)
+
+
+CONTEXTS = {
+    "image": (ImageContext(x_shape=(8, 8, 3)), image_batch),
+    "audio": (AudioContext(x_shape=(None,), sample_rate=16000), audio_batch),
+}
+
+
+@pytest.fixture(params=sorted(CONTEXTS))
+def context(request):
+    return CONTEXTS[request.param]
+
+
+def export_batches(output_dir, context, num_workers, num_samples=7):
+    context, make_batch = context
+    rng = np.random.RandomState(0)
+    exporter = SampleExporter(
+        str(output_dir), context, num_samples, num_workers=num_workers
+    )
+    for i in range(3):
+        x = make_batch(rng, 3)
+        x_adv = np.clip(x + 0.1, -1, 1)
+        exporter.export(x, x_adv, np.arange(i, i + 3), np.arange(i + 1, i + 4))
+        # The scenario may reuse its arrays once export returns
+        x[...] = 0
+        x_adv[...] = 0
+    exporter.flush()
+    return exporter
+
+
+def read_files(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as f:
+            files[name] = f.read()
+    return files
+
+
+def test_export_matches_synchronous(tmp_path, context):
+    os.mkdir(tmp_path / "sync")
+    os.mkdir(tmp_path / "pool")
+    sync = export_batches(tmp_path / "sync", context, num_workers=0)
+    pool = export_batches(tmp_path / "pool", context, num_workers=2)
+
+    sync_files = read_files(sync.output_dir)
+    assert len(sync_files) == 2 * 7 + 1
+    assert read_files(pool.output_dir) == sync_files
+    assert pool._executor is None
+
+
+def test_flush_raises_export_error(tmp_path, context):
+    def export_fn(index, x_i, x_adv_i):
+        if index == 1:
+            raise ValueError("cannot write sample 1")
+
+    _, make_batch = context
+    x = make_batch(np.random.RandomState(0), 3)
+    exporter = SampleExporter(str(tmp_path), context[0], 10, num_workers=2)
+    exporter.export_fn = export_fn
+    exporter.export(x, x, np.arange(3), np.arange(3))
+    with pytest.raises(ValueError, match="cannot write sample 1"):
+        exporter.flush()
+
+
+def test_export_blocks_when_pending(tmp_path, context):
+    num_workers = 2
+    started = []
+    release = threading.Event()
+
+    def export_fn(index, x_i, x_adv_i):
+        started.append(index)
+        release.wait(10)
+
+    _, make_batch = context
+    x = make_batch(np.random.RandomState(0), 2 * num_workers)
+    exporter = SampleExporter(str(tmp_path), context[0], 10, num_workers=num_workers)
+    exporter.export_fn = export_fn
+    exporter.export(x, x, np.arange(len(x)), np.arange(len(x)))
+    assert len(exporter._pending) == 2 * num_workers
+
+    thread = threading.Thread(
+        target=exporter.export, args=(x[:1], x[:1], np.arange(1), np.arange(1))
+    )
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()
+    assert exporter.saved_samples == 2 * num_workers
+
+    release.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    exporter.flush()
+    assert sorted(started) == list(range(2 * num_workers + 1))
+
+
+def test_predictions_written_once(tmp_path, context, monkeypatch):
+    dumps = []
+    dump = pickle.dump
+
+    def counting_dump(obj, f, *args, **kwargs):
+        dumps.append(f.name)
+        return dump(obj, f, *args, **kwargs)
+
+    monkeypatch.setattr(export.pickle, "dump", counting_dump)
+    exporter = export_batches(tmp_path, context, num_workers=2)
+    exporter.flush()
+    # Exports past num_samples are ignored
+    exporter.export(None, None, [0], [0])
+    state = exporter.state_dict()
+
+    predictions = os.path.join(exporter.output_dir, "predictions.pkl")
+    assert dumps == [predictions]
+    with open(predictions, "rb") as f:
+        y_dict = pickle.load(f)
+    assert sorted(y_dict) == [0, 3, 6]
+    assert state["saved_samples"] == 7
+
+
+def test_so2sat_eo_scaled_per_sample(tmp_path):
+    rng = np.random.RandomState(0)
+    x = np.concatenate(
+        [rng.uniform(-1, 1, (2, 32, 32, 4)), rng.uniform(0.2, 0.6, (2, 32, 32, 10))],
+        axis=-1,
+    ).astype(np.float32)
+    x_adv = x.copy()
+    # The second adversarial sample extends the EO range of the batch
+    x_adv[1, ..., 4:] = rng.uniform(0, 1, (32, 32, 10))
+
+    files = []
+    for batch in [slice(0, 1), slice(0, 2)]:
+        exporter = SampleExporter(str(tmp_path), So2SatContext(), 1, num_workers=0)
+        exporter.export(x[batch], x_adv[batch], [0], [0])
+        files.append(read_files(os.path.join(exporter.output_dir, "0")))
+    assert files[1] == files[0]
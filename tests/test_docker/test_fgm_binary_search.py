@@ -0,0 +1,81 @@
+"""
+Test cases for the batched epsilon search of FGMBinarySearch
+"""
+
+import numpy as np
+from art.estimators.classification.scikitlearn import ScikitlearnLogisticRegression
+from sklearn.linear_model import LogisticRegression
+
+from armory.art_experimental.attacks import FGMBinarySearch
+
+
+class DtypeRecordingClassifier(ScikitlearnLogisticRegression):
+    """
+    Returns gradients in the input dtype, as the deep learning estimators do,
+    and records the dtypes of the predicted inputs
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.predict_dtypes = set()
+
+    def loss_gradient(self, x, y, **kwargs):
+        return super().loss_gradient(x, y, **kwargs).astype(x.dtype)
+
+    def predict(self, x, **kwargs):
+        self.predict_dtypes.add(x.dtype)
+        return super().predict(x, **kwargs)
+
+
+def per_sample_binary_search(attack, batch, batch_labels):
+    """
+    Reference search, one sample and one prediction at a time
+    """
+    adv_batch = batch.copy()
+    batch_classes = np.argmax(batch_labels, axis=1)
+    perturbation = attack._compute_perturbation(batch, batch_labels, None)
+    for i in range(len(batch)):
+        min_eps = 0
+        max_eps = attack.eps
+        while max_eps - min_eps > attack.eps_step:
+            mid_eps = (max_eps + min_eps) / 2
+            adv_i = attack._apply_perturbation(batch[[i]], perturbation[[i]], mid_eps)
+            adv_class = np.argmax(attack.estimator.predict(adv_i), axis=1)
+            if attack.targeted:
+                success = batch_classes[[i]] == adv_class
+            else:
+                success = batch_classes[[i]] != adv_class
+            if success:
+                adv_batch[[i]] = adv_i
+                max_eps = mid_eps
+            else:
+                min_eps = mid_eps
+    return adv_batch
+
+
+def test_binary_search_matches_per_sample():
+    rng = np.random.RandomState(0)
+    x = rng.rand(60, 5).astype(np.float32)
+    y = (x[:, :2].sum(axis=1) > x[:, 2:4].sum(axis=1)).astype(int)
+    model = LogisticRegression().fit(x, y)
+    classifier = DtypeRecordingClassifier(model, clip_values=(0.0, 1.0))
+    labels = np.eye(2, dtype=np.float32)[classifier.predict(x).argmax(axis=1)]
+
+    for targeted in False, True:
+        attack = FGMBinarySearch(
+            classifier, eps=0.7, eps_step=0.003, batch_size=16, targeted=targeted
+        )
+        y_attack = 1 - labels if targeted else labels
+        classifier.predict_dtypes.clear()
+        x_adv = attack.generate(x, y=y_attack)
+        assert x_adv.dtype == x.dtype
+        assert classifier.predict_dtypes == {x.dtype}
+
+        expected = np.concatenate(
+            [
+                per_sample_binary_search(attack, x[i : i + 16], y_attack[i : i + 16])
+                for i in range(0, len(x), 16)
+            ]
+        )
+        assert expected.dtype == x.dtype
+        assert np.array_equal(x_adv, expected)
@@ -0,0 +1,38 @@
+"""
+Test cases for the stage instrumentation of scenarios
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+from armory.utils.instrumentation import Instrumentation
+
+
+def test_instrumentation(tmp_path):
+    instrumentation = Instrumentation(trace_allocations=True)
+    for i in range(10):
+        with instrumentation.stage("data_load"):
+            pass
+        with instrumentation.stage("attack_generate"):
+            x = np.ones(2 ** 20, dtype=np.uint8)
+
+    summary = instrumentation.summary()
+    assert summary["peak_rss_mb"] > 0
+    stages = summary["stages"]
+    assert set(stages) == {"data_load", "attack_generate"}
+    for stage in stages.values():
+        assert stage["count"] == 10
+        assert 0 <= stage["p50_s"] <= stage["p90_s"] <= stage["p99_s"] <= stage["max_s"]
+        assert stage["total_s"] == pytest.approx(10 * stage["mean_s"])
+    assert sum(s["fraction_of_total"] for s in stages.values()) == pytest.approx(1)
+    assert stages["attack_generate"]["max_alloc_mb"] >= 1
+    del x
+
+    filepath = tmp_path / "instrumentation.json"
+    instrumentation.save(str(filepath))
+    with open(filepath) as f:
+        saved = json.load(f)
+    assert len(saved["stages"]["data_load"]["time_s"]) == 10
+    assert len(saved["stages"]["attack_generate"]["alloc_bytes"]) == 10
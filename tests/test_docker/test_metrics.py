@@ -3,6 +3,7 @@ Test cases for ARMORY datasets.
 """
 
 import json
+import pickle
 
 import pytest
 import numpy as np
@@ -211,3 +212,305 @@ def test_object_detection_metrics():
     assert isinstance(hallucinations_per_img, list)
     assert len(hallucinations_per_img) == 1
     assert hallucinations_per_img[0] == 1
+
+
+def test_intersection_over_union_matrix():
+    boxes_1 = np.array(
+        [[0.1, 0.1, 0.7, 0.7], [0.5, 0.4, 0.9, 0.9], [0.0, 0.0, 0.05, 0.05]]
+    )
+    boxes_2 = np.array([[0.12, 0.09, 0.68, 0.7], [0.3, 0.3, 0.4, 0.4]])
+    iou_matrix = metrics._intersection_over_union_matrix(boxes_1, boxes_2)
+    assert iou_matrix.shape == (3, 2)
+    for i, box_1 in enumerate(boxes_1):
+        for j, box_2 in enumerate(boxes_2):
+            assert iou_matrix[i, j] == metrics._intersection_over_union(box_1, box_2)
+    assert metrics._intersection_over_union_matrix(boxes_1, np.zeros((0, 4))).shape == (
+        3,
+        0,
+    )
+
+
+def test_mAP_multiple_images():
+    labels = [
+        {"labels": np.array([1, 1]), "boxes": np.array([[0, 0, 4, 4], [5, 5, 9, 9]])},
+        {"labels": np.array([2]), "boxes": np.array([[0, 0, 4, 4]])},
+    ]
+    preds = [
+        {
+            # The second prediction duplicates the first, so it is a false positive
+            "labels": np.array([1, 1, 1]),
+            "boxes": np.array([[0, 0, 4, 4], [0, 0, 4, 4], [5, 5, 9, 9]]),
+            "scores": np.array([0.9, 0.8, 0.7]),
+        },
+        {
+            "labels": np.array([1, 2]),
+            "boxes": np.array([[0, 0, 4, 4], [6, 6, 9, 9]]),
+            "scores": np.array([0.95, 0.9]),
+        },
+    ]
+
+    ap_per_class = metrics.object_detection_AP_per_class(labels, preds)
+    assert ap_per_class == {1: 0.5, 2: 0.0}
+    ap_per_class = metrics.object_detection_AP_per_class(labels, preds, class_list=[2])
+    assert ap_per_class == {2: 0.0}
+
+
+def test_mAP_accumulator():
+    labels = [
+        {"labels": np.array([1, 1]), "boxes": np.array([[0, 0, 4, 4], [5, 5, 9, 9]])},
+        {"labels": np.array([2]), "boxes": np.array([[0, 0, 4, 4]])},
+        {"labels": np.array([2]), "boxes": np.array([[1, 1, 5, 5]])},
+    ]
+    preds = [
+        {
+            "labels": np.array([1, 1, 1]),
+            "boxes": np.array([[0, 0, 4, 4], [0, 0, 4, 4], [5, 5, 9, 9]]),
+            "scores": np.array([0.9, 0.8, 0.7]),
+        },
+        {
+            "labels": np.array([1, 2]),
+            "boxes": np.array([[0, 0, 4, 4], [6, 6, 9, 9]]),
+            "scores": np.array([0.95, 0.9]),
+        },
+        {
+            "labels": np.array([2]),
+            "boxes": np.array([[1, 1, 5, 5]]),
+            "scores": np.array([0.8]),
+        },
+    ]
+
+    metrics_logger = metrics.MetricsLogger(
+        task=["object_detection_AP_per_class"], skip_attack=True
+    )
+    for i in range(len(labels)):
+        metrics_logger.update_task(labels[i : i + 1], preds[i : i + 1])
+        # Running results over the batches seen so far
+        assert metrics_logger.tasks[
+            0
+        ].compute_non_elementwise_metric() == metrics.object_detection_AP_per_class(
+            labels[: i + 1], preds[: i + 1]
+        )
+    results = metrics_logger.results()
+    assert results["benign_object_detection_AP_per_class"] == {1: 0.5, 2: 0.27}
+    assert results["benign_mean_object_detection_AP_per_class"] == 0.385
+    # Labels and predictions are not retained
+    assert metrics_logger.tasks[0]._input_labels == []
+
+
+def test_patch_targeted_AP_iou_threshold():
+    labels = [
+        {"labels": np.array([3]), "boxes": np.array([[0, 0, 10, 10]], np.float32)},
+        {"labels": np.array([3]), "boxes": np.array([[0, 0, 10, 10]], np.float32)},
+    ]
+    preds = [
+        {
+            # The first box has an iou of exactly 0.1 with the patch in float32,
+            # which is above the 0.1 threshold in float64
+            "labels": np.array([3, 3]),
+            "boxes": np.array([[0, 0, 1, 10], [20, 20, 30, 30]], np.float32),
+            "scores": np.array([0.8, 0.9], np.float32),
+        },
+        {
+            "labels": np.array([5, 3]),
+            "boxes": np.array([[0, 0, 10, 10], [0, 0, 5, 5]], np.float32),
+            "scores": np.array([0.95, 0.6], np.float32),
+        },
+    ]
+    iou = metrics._intersection_over_union(labels[0]["boxes"][0], preds[0]["boxes"][0])
+    assert iou.dtype == np.float32 and iou == np.float32(0.1)
+
+    ap_per_class = metrics.dapricot_patch_targeted_AP_per_class(labels, preds)
+    assert ap_per_class == {3: 1.0}
+
+
+def test_padded_perturbation():
+    x = np.ma.MaskedArray(
+        [[0.1, 0.2, 0.0], [0.1, 0.2, 0.3]],
+        mask=[[False, False, True], [False, False, False]],
+    )
+    # The perturbation of the padding is ignored
+    x_adv = np.array([[0.1, 0.3, 0.9], [0.1, 0.2, 0.5]])
+    metrics_logger = metrics.MetricsLogger(perturbation="snr", skip_benign=True)
+    metrics_logger.update_perturbation(x, x_adv)
+    assert metrics_logger.perturbations[0].values() == pytest.approx([5.0, 3.5])
+
+
+def test_object_detection_rates_share_matching(monkeypatch):
+    y = [
+        {
+            "labels": np.array([2, 7, 6]),
+            "boxes": np.array(
+                [[0.1, 0.1, 0.7, 0.7], [0.3, 0.3, 0.4, 0.4], [0.05, 0.05, 0.15, 0.15]]
+            ),
+        }
+    ]
+    y_pred = [
+        {
+            "labels": np.array([2, 9, 3]),
+            "boxes": np.array(
+                [
+                    [0.12, 0.09, 0.68, 0.7],
+                    [0.5, 0.4, 0.9, 0.9],
+                    [0.05, 0.05, 0.15, 0.15],
+                ]
+            ),
+            "scores": np.array([0.8, 0.8, 0.8]),
+        }
+    ]
+    num_calls = []
+    get_tpr_mr_dr_hr = metrics._object_detection_get_tpr_mr_dr_hr
+
+    def counting_get_tpr_mr_dr_hr(*args, **kwargs):
+        num_calls.append(1)
+        return get_tpr_mr_dr_hr(*args, **kwargs)
+
+    for name, (_, index, kwargs) in list(metrics.SHARED_RESULT_METRICS.items()):
+        monkeypatch.setitem(
+            metrics.SHARED_RESULT_METRICS,
+            name,
+            (counting_get_tpr_mr_dr_hr, index, kwargs),
+        )
+
+    rates = [
+        "true_positive_rate",
+        "misclassification_rate",
+        "disappearance_rate",
+        "hallucinations_per_image",
+    ]
+    task = [
+        f"{prefix}_{rate}"
+        for prefix in ("object_detection", "carla_od")
+        for rate in rates
+    ]
+    metrics_logger = metrics.MetricsLogger(task=task, skip_attack=True)
+    for _ in range(2):
+        metrics_logger.update_task(y, y_pred)
+    # Each batch is matched once with all classes and once with the CARLA classes
+    assert len(num_calls) == 4
+    for metric in metrics_logger.tasks:
+        assert metric.values() == 2 * metrics.SUPPORTED_METRICS[metric.name](y, y_pred)
+    assert metrics_logger.tasks[0].values() == [1.0 / 3.0] * 2
+    assert metrics_logger.tasks[3].values() == [1] * 2
+
+    # Metrics with different arguments do not share results
+    metrics_logger = metrics.MetricsLogger(
+        task=["object_detection_hallucinations_per_image"] * 2,
+        task_kwargs=[{}, {"iou_threshold": 0.99}],
+        skip_attack=True,
+    )
+    metrics_logger.update_task(y, y_pred)
+    assert [metric.values() for metric in metrics_logger.tasks] == [[1], [2]]
+
+
+def test_resource_context():
+    computational_resource_dict = {}
+    for _ in range(3):
+        with metrics.resource_context(
+            name="Attack",
+            profiler="Deterministic",
+            computational_resource_dict=computational_resource_dict,
+        ):
+            sorted(range(1000), reverse=True)
+    assert computational_resource_dict["Attack"]["execution_count"] == 3
+
+    metrics_logger = metrics.MetricsLogger()
+    metrics_logger.computational_resource_dict = computational_resource_dict
+    results = metrics_logger.results()
+    assert "Avg. CPU time (s) for 3 executions of Attack" in results
+    stats = results["Attack profiler stats"]
+    # A single cumulative profile, rather than one per execution
+    assert stats.count("function calls") == 1
+
+
+def test_metrics_logger_state_dict():
+    metrics_logger = metrics.MetricsLogger(
+        task=["categorical_accuracy", "object_detection_AP_per_class"],
+        perturbation="l2",
+    )
+    y = [{"labels": np.array([1]), "boxes": np.array([[0.0, 0.0, 1.0, 1.0]])}]
+    y_pred = [dict(y[0], scores=np.array([0.9]))]
+    metrics_logger.tasks[0].add_results([0, 1], [0, 0])
+    metrics_logger.tasks[1].add_non_elementwise_results(y, y_pred)
+    metrics_logger.update_perturbation(np.zeros((2, 3)), np.ones((2, 3)))
+    with metrics.resource_context(
+        name="Attack",
+        profiler="Basic",
+        computational_resource_dict=metrics_logger.computational_resource_dict,
+    ):
+        pass
+
+    restored = metrics.MetricsLogger(
+        task=["categorical_accuracy", "object_detection_AP_per_class"],
+        perturbation="l2",
+    )
+    restored.load_state_dict(pickle.loads(pickle.dumps(metrics_logger.state_dict())))
+    assert restored.tasks[0].values() == [1, 0]
+    assert restored.tasks[1].compute_non_elementwise_metric() == {1: 1.0}
+    assert (
+        restored.perturbations[0].values() == metrics_logger.perturbations[0].values()
+    )
+    assert restored.computational_resource_dict["Attack"]["execution_count"] == 1
+
+    with pytest.raises(ValueError):
+        metrics.MetricsLogger(task=["categorical_accuracy"]).load_state_dict(
+            metrics_logger.state_dict()
+        )
+
+
+def _reference_edit_distance(reference, hypothesis):
+    row = list(range(len(hypothesis) + 1))
+    for i, r in enumerate(reference, 1):
+        previous, row = row, [i]
+        for j, h in enumerate(hypothesis, 1):
+            row.append(min(previous[j - 1] + (r != h), previous[j] + 1, row[j - 1] + 1))
+    return row[-1]
+
+
+def test_word_error_rate():
+    y = [
+        "the cat sat on the mat",
+        b"the cat sat on the mat",
+        "",
+        "a b c",
+        "one",
+        "kitten sitting on a long sofa today",
+    ]
+    y_pred = [
+        "the cat sat on mat",
+        "the the cat sat on on the mat",
+        "a b",
+        "",
+        "one",
+        "sitting",
+    ]
+    assert metrics.word_error_rate(y, y_pred) == [
+        (1.0, 6),
+        (2.0, 6),
+        (2.0, 0),
+        (3.0, 3),
+        (0.0, 1),
+        (6.0, 7),
+    ]
+    assert metrics.word_error_rate([], []) == []
+    with pytest.raises(TypeError):
+        metrics.word_error_rate([1], ["one"])
+    with pytest.raises(ValueError):
+        metrics.word_error_rate(["one"], [])
+
+    cer = metrics.character_error_rate(["kitten  sitting"], ["sitting kitten"])
+    assert cer == [(_reference_edit_distance("kitten sitting", "sitting kitten"), 14)]
+
+    rng = np.random.default_rng(0)
+    words = ["a", "b", "c", "d"]
+    y = [" ".join(rng.choice(words, rng.integers(0, 12))) for _ in range(50)]
+    y_pred = [" ".join(rng.choice(words, rng.integers(0, 12))) for _ in range(50)]
+    for (edits, length), y_i, y_pred_i in zip(
+        metrics.word_error_rate(y, y_pred), y, y_pred
+    ):
+        assert edits == _reference_edit_distance(y_i.split(), y_pred_i.split())
+        assert length == len(y_i.split())
+
+    metric = metrics.MetricList("character_error_rate")
+    metric.add_results(["abcd"], ["abd"])
+    metric.add_results(["ab"], ["xy"])
+    assert metric.total_wer() == 0.5
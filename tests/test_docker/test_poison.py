@@ -0,0 +1,150 @@
+"""
+Test cases for poisoning dataset poisoners
+"""
+
+import numpy as np
+import pytest
+
+from armory.art_experimental.attacks.poison_loader import poison_loader_GTSRB
+from armory.scenarios.poison import DatasetPoisoner, Poison
+from armory.scenarios.poisoning_gtsrb_clbd import CleanDatasetPoisoner
+
+
+class FakeCleanLabelAttack:
+    """
+    Perturbs the samples of class 1, keeping all labels
+    """
+
+    def poison(self, x, y):
+        x_poison = np.array(x)
+        x_poison[y.argmax(axis=1) == 1] += 1
+        return x_poison, y
+
+
+class FakeTriggerAttack:
+    """
+    Adds a constant trigger to every sample it is given, relabeling them to y
+    """
+
+    def poison(self, x, y):
+        return x + 1, np.array(y)
+
+
+def per_sample_poison(x, y, source_class, target_class, fraction):
+    """
+    The original one-sample-at-a-time DatasetPoisoner logic
+    """
+    x_poison, y_poison = [], []
+    source_index = np.where(y == source_class)[0]
+    poison_count = int(fraction * len(source_index))
+    poison_index = np.sort(
+        np.random.choice(source_index, size=poison_count, replace=False)
+    )
+    for i in range(len(x)):
+        if i in poison_index:
+            poison_x_i, poison_y_i = FakeTriggerAttack().poison(x[i], [target_class])
+            x_poison.append(poison_x_i)
+            y_poison.append(poison_y_i[0])
+        else:
+            x_poison.append(x[i])
+            y_poison.append(y[i])
+    return np.array(x_poison), np.array(y_poison), poison_index
+
+
+@pytest.mark.parametrize("seed", [0, 7])
+def test_dataset_poisoner_matches_per_sample(seed):
+    x = np.random.rand(20, 4, 4, 3).astype(np.float32)
+    x_orig = x.copy()
+    y = np.arange(20) % 3
+    poisoner = DatasetPoisoner(FakeTriggerAttack(), 1, 2, fraction=0.5)
+
+    np.random.seed(seed)
+    x_expected, y_expected, index_expected = per_sample_poison(x, y, 1, 2, 0.5)
+    np.random.seed(seed)
+    x_poison, y_poison, poison_index = poisoner.poison_dataset(x, y, return_index=True)
+
+    assert poison_index.tolist() == index_expected.tolist()
+    assert np.array_equal(y_poison, y_expected)
+    assert np.array_equal(x_poison, x_expected)
+    assert x_poison is not x
+    assert np.array_equal(x, x_orig)
+
+
+def test_dataset_poisoner_out():
+    x = np.random.rand(8, 4, 4, 3).astype(np.float32)
+    y = np.array([0, 1, 2, 1, 0, 1, 1, 2])
+    x_expected = x.copy()
+    x_expected[y == 1] += 1
+    poisoner = DatasetPoisoner(FakeTriggerAttack(), 1, 0, fraction=1.0)
+
+    x_poison, y_poison = poisoner.poison_dataset(x, y, out=x)
+    assert x_poison is x
+    assert np.array_equal(x, x_expected)
+    assert np.array_equal(y_poison, np.where(y == 1, 0, y))
+
+    with pytest.raises(ValueError):
+        poisoner.poison_dataset(x, y, out=np.empty((7, 4, 4, 3), dtype=np.float32))
+
+
+def test_dataset_poisoner_memmap_out(tmp_path):
+    x = np.random.rand(8, 4, 4, 3).astype(np.float32)
+    y = np.array([0, 1, 2, 1, 0, 1, 1, 2])
+    x_expected = x.copy()
+    x_expected[y == 1] += 1
+    poisoner = DatasetPoisoner(FakeTriggerAttack(), 1, 0, fraction=1.0)
+
+    out = np.memmap(tmp_path / "x_poison.dat", dtype=x.dtype, mode="w+", shape=x.shape)
+    x_poison, _ = poisoner.poison_dataset(x, y, out=out)
+    assert x_poison is out
+    out.flush()
+    del out, x_poison
+    x_poison = np.memmap(
+        tmp_path / "x_poison.dat", dtype=x.dtype, mode="r", shape=x.shape
+    )
+    assert np.array_equal(x_poison, x_expected)
+    assert not np.array_equal(x, x_expected)
+
+
+@pytest.mark.parametrize("poison_type", ["pattern", "pixel"])
+def test_dataset_poisoner_trigger_placement(poison_type):
+    x = np.zeros((10, 8, 8, 3), dtype=np.float32)
+    y = np.array([1, 0] * 5)
+    attack = poison_loader_GTSRB(poison_type=poison_type)
+    x_trigger = np.zeros((8, 8, 3), dtype=np.float32)
+    x_trigger[8 - 2, 8 - 2] = 1
+    if poison_type == "pattern":
+        x_trigger[8 - 3, 8 - 3] = 1
+        x_trigger[8 - 2, 8 - 4] = 1
+        x_trigger[8 - 4, 8 - 2] = 1
+
+    poisoner = DatasetPoisoner(attack, 1, 0, fraction=1.0)
+    x_poison, y_poison = poisoner.poison_dataset(x, y)
+    assert np.array_equal(x_poison[y == 1], np.stack([x_trigger] * 5))
+    assert not x_poison[y == 0].any()
+    assert not y_poison.any()
+
+    x_batched, _ = poisoner.poison_dataset(x, y, batch_size=2)
+    assert np.array_equal(x_batched, x_poison)
+
+
+def test_clean_dataset_poisoner_in_place():
+    x = np.random.rand(6, 4, 4, 3).astype(np.float32)
+    y = np.array([0, 1, 2, 1, 0, 1])
+    x_expected = x.copy()
+    x_expected[y == 1] += 1
+
+    scenario = Poison.__new__(Poison)
+    scenario.use_poison = True
+    scenario.x_clean = x
+    scenario.y_clean = y
+    scenario.poisoner = CleanDatasetPoisoner(FakeCleanLabelAttack())
+    scenario.poison_dataset()
+
+    assert scenario.x_poison is x
+    assert np.array_equal(scenario.x_poison, x_expected)
+    assert np.array_equal(scenario.y_poison, y)
+    assert scenario.poison_index.tolist() == [1, 3, 5]
+
+    x_poison, y_poison = scenario.poisoner.poison_dataset(x_expected, y)
+    assert x_poison is not x_expected
+    assert np.array_equal(x_poison[y == 1], x_expected[y == 1] + 1)
@@ -0,0 +1,171 @@
+"""
+Test cases for checkpointing and resuming Scenario.evaluate_all
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from armory.data.datasets import ImageContext
+from armory.scenarios.scenario import CHECKPOINT_FILE, Scenario
+
+
+class FakeModel:
+    """
+    Predicts the class of the brighter of the first two channels
+    """
+
+    def __init__(self):
+        self.num_predict = 0
+
+    def predict(self, x):
+        self.num_predict += 1
+        return x[..., :2].mean(axis=(1, 2))
+
+
+class NoiseAttack:
+    """
+    Adds uniform noise from the numpy random number generator
+    """
+
+    targeted = False
+
+    def __init__(self, eps):
+        self.eps = eps
+
+    def generate(self, x, y=None):
+        noise = np.random.uniform(-self.eps, self.eps, x.shape)
+        return np.clip(x + noise, 0.0, 1.0).astype(np.float32)
+
+
+class FakeDataset:
+    """
+    Yields num_batches fixed batches, interrupting the evaluation before batch
+        interrupt_at, if given
+    """
+
+    def __init__(self, num_batches=5, batch_size=2, interrupt_at=None):
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(num_batches, batch_size, 4, 4, 3).astype(np.float32)
+        self.y = rng.randint(0, 2, (num_batches, batch_size))
+        self.context = ImageContext(x_shape=(4, 4, 3))
+        self.interrupt_at = interrupt_at
+        self.num_read = 0
+
+    def __len__(self):
+        return len(self.x)
+
+    def __next__(self):
+        if self.num_read == self.interrupt_at:
+            raise KeyboardInterrupt
+        i = self.num_read
+        self.num_read += 1
+        return self.x[i], self.y[i]
+
+
+def make_config(eps=0.1):
+    return {
+        "adhoc": None,
+        "attack": {
+            "knowledge": "white",
+            "kwargs": {"eps": eps},
+            "module": "test_scenario",
+            "name": "NoiseAttack",
+        },
+        "dataset": {"batch_size": 2, "module": "test_scenario", "name": "fake"},
+        "defense": None,
+        "eval_id": "test_scenario",
+        "metric": {
+            "means": True,
+            "perturbation": "linf",
+            "record_metric_per_sample": True,
+            "task": ["categorical_accuracy"],
+        },
+        "model": {"fit": False, "module": "test_scenario", "name": "FakeModel"},
+        "scenario": {"export_samples": 5, "export_workers": 0},
+    }
+
+
+def make_scenario(output_dir, dataset, config=None, resume=False):
+    """
+    Return a Scenario loaded with the fake model, attack, and dataset
+    """
+    if config is None:
+        config = make_config()
+    scenario = Scenario(config, resume=resume, checkpoint_interval=0)
+    scenario.scenario_output_dir = str(output_dir)
+    scenario.model = FakeModel()
+    scenario.predict_kwargs = {}
+    scenario.attack = NoiseAttack(**config["attack"]["kwargs"])
+    scenario.attack_type = None
+    scenario.targeted = False
+    scenario.use_label = False
+    scenario.generate_kwargs = {}
+    scenario.test_dataset = dataset
+    scenario.i = -1
+    scenario.load_metrics()
+    return scenario
+
+
+def exported_files(scenario):
+    files = {}
+    output_dir = scenario.sample_exporter.output_dir
+    for name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, name), "rb") as f:
+            files[name] = f.read()
+    return files
+
+
+def run_interrupted(output_dir, interrupt_at):
+    np.random.seed(0)
+    scenario = make_scenario(output_dir, FakeDataset(interrupt_at=interrupt_at))
+    with pytest.raises(KeyboardInterrupt):
+        scenario.evaluate_all()
+    assert os.path.isfile(os.path.join(output_dir, CHECKPOINT_FILE))
+
+
+def test_resume_matches_uninterrupted(tmp_path):
+    os.mkdir(tmp_path / "full")
+    os.mkdir(tmp_path / "resumed")
+    np.random.seed(0)
+    full = make_scenario(tmp_path / "full", FakeDataset())
+    full.evaluate_all()
+    full.finalize_results()
+
+    run_interrupted(tmp_path / "resumed", interrupt_at=3)
+    # The random state of the interrupted run is restored from the checkpoint
+    np.random.seed(1)
+    dataset = FakeDataset()
+    resumed = make_scenario(tmp_path / "resumed", dataset, resume=True)
+    resumed.evaluate_all()
+    resumed.finalize_results()
+
+    assert resumed.results == full.results
+    assert len(resumed.results["perturbation_linf"]) == 10
+    # Evaluated batches are read from the dataset, but not evaluated again
+    assert dataset.num_read == 5
+    assert resumed.model.num_predict == 2 * 2
+    assert resumed.i == 4
+    assert exported_files(resumed) == exported_files(full)
+    assert resumed.sample_exporter.output_dir.startswith(str(tmp_path / "resumed"))
+    stages = resumed.instrumentation.state_dict()
+    assert len(stages["attack_generate"]["time_s"]) == 5
+
+
+def test_resume_without_checkpoint(tmp_path):
+    np.random.seed(0)
+    dataset = FakeDataset()
+    scenario = make_scenario(tmp_path, dataset, resume=True)
+    scenario.evaluate_all()
+    assert dataset.num_read == 5
+    assert scenario.model.num_predict == 2 * 5
+
+
+def test_resume_config_mismatch(tmp_path):
+    run_interrupted(tmp_path, interrupt_at=2)
+    scenario = make_scenario(
+        tmp_path, FakeDataset(), config=make_config(eps=0.2), resume=True
+    )
+    with pytest.raises(ValueError, match="different config"):
+        scenario.evaluate_all()
@@ -0,0 +1,170 @@
+"""
+Test cases for the batched SNR searches of SNR_PGDRange and SNR_PGDRange2
+"""
+
+import numpy as np
+import pytest
+from art.estimators.classification.scikitlearn import ScikitlearnLogisticRegression
+from sklearn.linear_model import LogisticRegression
+
+from armory.art_experimental.attacks import snr_pgd
+from armory.art_experimental.attacks.snr_pgd import SNR_PGD_Numpy
+
+
+@pytest.fixture
+def numpy_snr_pgd(monkeypatch):
+    """
+    Runs the searches with SNR_PGD_Numpy, as the PyTorch attacks need a PyTorch model
+    """
+    monkeypatch.setattr(snr_pgd, "SNR_PGD", SNR_PGD_Numpy)
+
+
+def make_classifier():
+    rng = np.random.RandomState(0)
+    x = rng.randn(200, 8).astype(np.float32)
+    y = (x[:, :4].sum(axis=1) > x[:, 4:].sum(axis=1)).astype(int)
+    model = LogisticRegression().fit(x, y)
+    classifier = ScikitlearnLogisticRegression(model=model)
+    x_test = rng.randn(12, 8).astype(np.float32)
+    y_test = (x_test[:, :4].sum(axis=1) > x_test[:, 4:].sum(axis=1)).astype(int)
+    return classifier, x_test, y_test
+
+
+def one_sample_range(attack, x, y, **kwargs):
+    """
+    The original SNR_PGDRange search of a single sample
+    """
+    if attack.estimator.predict(x).argmax() != y:
+        return x, np.nan
+    i_min = 0
+    i_max = len(attack.eps_range)
+    x_best = x
+    eps_best = np.nan
+    while i_min < i_max:
+        i_mid = (i_min + i_max) // 2
+        x_adv = attack.attacks[i_mid].generate(x, y, **kwargs)
+        if attack.estimator.predict(x_adv).argmax() != y:
+            x_best = x_adv
+            eps_best = attack.eps_range[i_mid]
+            i_min = i_mid + 1
+        else:
+            i_max = i_mid
+    return x_best, eps_best
+
+
+def one_sample_range2(attack, x, y, **kwargs):
+    """
+    The original SNR_PGDRange2 search of a single sample
+    """
+    if attack.estimator.predict(x).argmax() != y:
+        return x, np.nan
+    x_adv = attack.max_attack.generate(x, y, **kwargs)
+    if attack.estimator.predict(x_adv).argmax() != y:
+        return x_adv, attack.eps_max
+    upper_eps = attack.eps_max
+
+    x_adv = attack.min_attack.generate(x, y, **kwargs)
+    if attack.estimator.predict(x_adv).argmax() != y:
+        lower_eps = attack.eps_min
+        x_best = x_adv
+        eps_best = lower_eps
+    else:
+        return x_adv, np.nan
+
+    while upper_eps - lower_eps > attack.tolerance:
+        mid_eps = (upper_eps + lower_eps) / 2
+        mid_attack = attack.Attack(attack.estimator, eps=mid_eps, **attack.kwargs)
+        x_adv = mid_attack.generate(x, y, **kwargs)
+        if attack.estimator.predict(x_adv).argmax() != y:
+            lower_eps = mid_eps
+            x_best = x_adv
+            eps_best = lower_eps
+        else:
+            upper_eps = mid_eps
+    return x_best, eps_best
+
+
+def make_range(classifier, warm_start):
+    return snr_pgd.SNR_PGDRange(
+        classifier,
+        eps_range=[-10, -5, 0, 5, 10, 15, 20, 30],
+        norm="snr_db",
+        eps_step=0.25,
+        max_iter=5,
+        warm_start=warm_start,
+    )
+
+
+def make_range2(classifier, warm_start):
+    return snr_pgd.SNR_PGDRange2(
+        classifier,
+        eps_min=-10,
+        eps_max=30,
+        tolerance=1,
+        norm="snr_db",
+        eps_step=0.25,
+        max_iter=5,
+        warm_start=warm_start,
+    )
+
+
+@pytest.mark.parametrize(
+    "make_attack,one_sample_search",
+    [(make_range, one_sample_range), (make_range2, one_sample_range2)],
+)
+def test_search_without_warm_start_matches_one_sample(
+    numpy_snr_pgd, make_attack, one_sample_search
+):
+    classifier, x, y = make_classifier()
+    y[:2] = 1 - y[:2]
+    attack = make_attack(classifier, warm_start=False)
+
+    x_adv = attack.generate(x, y)
+    for i in range(len(x)):
+        x_adv_i, eps_i = one_sample_search(attack, x[i : i + 1], y[i : i + 1])
+        assert np.allclose(x_adv[i : i + 1], x_adv_i)
+        assert np.array_equal(attack.eps_per_sample[i], eps_i, equal_nan=True)
+
+
+@pytest.mark.parametrize("make_attack", [make_range, make_range2])
+def test_search_batch(numpy_snr_pgd, make_attack):
+    classifier, x, y = make_classifier()
+    y[:2] = 1 - y[:2]
+    attack = make_attack(classifier, warm_start=True)
+
+    x_adv = attack.generate(x, np.eye(2)[y])
+    assert x_adv.shape == x.shape
+    assert np.isnan(attack.eps_per_sample[:2]).all()
+    assert np.array_equal(x_adv[:2], x[:2])
+
+    success = ~np.isnan(attack.eps_per_sample)
+    assert success[2:].mean() > 0.5
+    assert (classifier.predict(x_adv[success]).argmax(axis=1) != y[success]).all()
+    for i in np.flatnonzero(success):
+        snr_db = 10 * np.log10(
+            np.sum(x[i] ** 2) / np.sum((x_adv[i] - x[i]) ** 2).clip(min=1e-12)
+        )
+        assert snr_db >= attack.eps_per_sample[i] - 1e-3
+
+
+def test_x_init_projected_into_bound():
+    classifier, x, y = make_classifier()
+    x, y = x[:1], y[:1]
+    x_init = x + 100 * np.sign(np.random.RandomState(1).randn(*x.shape))
+    attack = SNR_PGD_Numpy(classifier, norm="snr", eps=4, eps_step=0.01, max_iter=1)
+    eps = np.linalg.norm(x) / 2
+
+    x_adv = attack.generate(x, y, x_init=x_init.astype(np.float32))
+    delta = (x_adv - x).ravel()
+    direction = (x_init - x).ravel()
+    assert np.linalg.norm(delta) <= eps * (1 + 1e-5)
+    assert np.linalg.norm(delta) > 0.9 * eps
+    assert np.dot(delta, direction) > 0.99 * np.linalg.norm(delta) * np.linalg.norm(
+        direction
+    )
+
+    x_adv = attack.generate(x, y)
+    assert np.linalg.norm(x_adv - x) < 0.1 * eps
+
+    with pytest.raises(ValueError):
+        attack.generate(x, y, x_init=np.concatenate([x_init, x_init]))
@@ -0,0 +1,75 @@
+"""
+Test cases for the SpectralSignatureDefense poison filter
+"""
+
+import logging
+
+import numpy as np
+import pytest
+
+from armory.art_experimental.poison_detection.spectral_signature_defense import (
+    SpectralSignatureDefense,
+)
+
+
+class FakeClassifier:
+    """
+    Returns x_train itself as the last-layer activations
+    """
+
+    layer_names = ["input", "features"]
+
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+
+    def nb_classes(self):
+        return self.n_classes
+
+    def get_activations(self, x, layer, batch_size=128, framework=False):
+        return x
+
+
+def svd_is_clean(x_train, y_train, eps_multiplier, ub_pct_poison):
+    """
+    Reference filter, scoring all activations of each class with an SVD
+    """
+    is_clean = np.zeros(len(y_train), dtype=int)
+    for label in np.unique(y_train):
+        in_class = y_train == label
+        scores = SpectralSignatureDefense.spectral_signature_scores(x_train[in_class])
+        score_cutoff = np.quantile(scores, max(1 - eps_multiplier * ub_pct_poison, 0.0))
+        is_clean[in_class] = scores[:, 0] < score_cutoff
+    return is_clean
+
+
+# Seed 101 has close top eigenvalues, where power iteration flagged other samples.
+# With dim 64, the covariances are larger than the activations, which are held instead
+@pytest.mark.parametrize("seed", [0, 1, 101])
+@pytest.mark.parametrize("dim", [32, 64])
+def test_detect_poison_matches_svd(seed, dim, caplog):
+    rng = np.random.RandomState(seed)
+    n_classes, n_samples, batch_size = 5, 203, 32
+    # Class 3 is absent from y_train
+    y_train = rng.choice([0, 1, 2, 4], n_samples)
+    x_train = rng.standard_normal((n_samples, dim)) + 3 * y_train[:, np.newaxis]
+    # Plant a cluster of outliers in class 0. The top eigenvalues of the other classes
+    # are close, so their signatures must be exact for the cutoffs to match
+    is_poison = (rng.rand(n_samples) < 0.1) & (y_train == 0)
+    x_train[is_poison] += 4 * rng.standard_normal(dim)
+
+    defense = SpectralSignatureDefense(
+        FakeClassifier(n_classes),
+        x_train,
+        y_train,
+        batch_size=batch_size,
+        eps_multiplier=1.5,
+        ub_pct_poison=0.2,
+    )
+    with caplog.at_level(logging.INFO):
+        _, is_clean = defense.detect_poison()
+    assert ("Holding activations in memory" in caplog.text) == (dim == 64)
+
+    expected = svd_is_clean(x_train, y_train, 1.5, 0.2)
+    assert np.array_equal(is_clean, expected)
+    # The planted outliers are filtered out
+    assert not is_clean[is_poison].any()
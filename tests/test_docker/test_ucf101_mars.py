@@ -0,0 +1,73 @@
+"""
+Test cases for the numpy preprocessing of the MARS UCF101 model
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("MARS")
+
+from MARS.dataset import preprocess_data  # noqa: E402
+from MARS.opts import parse_opts  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from armory.baseline_models.pytorch.ucf101_mars import (  # noqa: E402
+    preprocessing_fn_numpy,
+)
+
+
+def mars_preprocessing(x, sample_duration=16):
+    """
+    Reference preprocessing of one uint8 video with MARS' parse_opts and scale_crop
+    """
+    total_frames = x.shape[0]
+    if total_frames <= sample_duration:
+        x = np.vstack([x, x[: sample_duration - total_frames]])
+    opt = parse_opts(arguments=[])
+    opt.modality = "RGB"
+    opt.sample_size = 112
+    x_mars_preprocessed = preprocess_data.scale_crop(
+        [Image.fromarray(frame) for frame in x], 0, opt
+    )
+    x_reshaped = []
+    for ns in range(int(total_frames / sample_duration)):
+        np_frames = x_mars_preprocessed[
+            :, ns * sample_duration : (ns + 1) * sample_duration, :, :
+        ].numpy()
+        x_reshaped.append(np_frames)
+    return np.array(x_reshaped, dtype=np.float32)
+
+
+@pytest.mark.parametrize(
+    "shape",
+    [
+        (16, 112, 112, 3),
+        (40, 240, 320, 3),
+        (33, 112, 150, 3),
+        (20, 200, 120, 3),
+        (17, 128, 171, 3),
+    ],
+)
+def test_preprocessing_matches_mars(shape):
+    x = np.random.RandomState(0).randint(0, 256, shape, dtype=np.uint8)
+    (output,) = preprocessing_fn_numpy([x])
+    expected = mars_preprocessing(x)
+
+    assert output.shape == (shape[0] // 16, 3, 16, 112, 112)
+    assert output.dtype == np.float32
+    assert np.allclose(output, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("frames", [8, 15])
+def test_preprocessing_short_video(frames):
+    x = np.random.RandomState(0).randint(0, 256, (frames, 120, 160, 3), dtype=np.uint8)
+    (output,) = preprocessing_fn_numpy([x])
+
+    assert mars_preprocessing(x).size == 0
+    assert output.shape == (0, 3, 16, 112, 112)
+
+
+def test_preprocessing_too_short_video():
+    with pytest.raises(ValueError):
+        preprocessing_fn_numpy([np.zeros((7, 120, 160, 3), dtype=np.uint8)])
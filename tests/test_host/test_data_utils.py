@@ -0,0 +1,167 @@
+"""
+Test cases for downloads in armory.data.utils, served from a local HTTP server
+"""
+
+import hashlib
+import http.server
+import io
+import json
+import os
+import tarfile
+import threading
+
+import pytest
+
+from armory.data import utils
+
+FILE_CONTENTS = os.urandom(100000)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    contents = FILE_CONTENTS
+    accept_ranges = True
+    ranges_served = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_contents(self, include_body):
+        data = self.contents
+        range_header = self.headers.get("Range")
+        if range_header and self.accept_ranges:
+            start, end = range_header.split("=")[1].split("-")
+            start, end = int(start), int(end)
+            self.ranges_served.append((start, end))
+            data = data[start : end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(self.contents)}"
+            )
+        else:
+            self.send_response(200)
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_contents(include_body=False)
+
+    def do_GET(self):
+        self.send_contents(include_body=True)
+
+
+class NoRangeRequestHandler(RangeRequestHandler):
+    accept_ranges = False
+
+
+@pytest.fixture()
+def serve(monkeypatch):
+    monkeypatch.setattr(utils, "get_verify_ssl", lambda: True)
+    servers = []
+
+    def start(handler):
+        handler.ranges_served = []
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/file.bin"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("handler", [RangeRequestHandler, NoRangeRequestHandler])
+def test_download_requests(tmp_path, serve, handler):
+    url = serve(handler)
+    value = utils.download_requests(
+        url, str(tmp_path), "file.bin", num_connections=3, part_size=7000,
+    )
+    assert value == hashlib.sha256(FILE_CONTENTS).hexdigest()
+    assert (tmp_path / "file.bin").read_bytes() == FILE_CONTENTS
+    assert sorted(os.listdir(tmp_path)) == ["file.bin"]
+    if handler.accept_ranges:
+        assert len(handler.ranges_served) == 15
+
+
+def test_download_requests_resume(tmp_path, serve):
+    url = serve(RangeRequestHandler)
+    part_size = 7000
+    # Parts 0 and 2 were downloaded by an interrupted run
+    with open(tmp_path / "file.bin.part", "wb") as f:
+        f.truncate(len(FILE_CONTENTS))
+        for i in 0, 2:
+            f.seek(i * part_size)
+            f.write(FILE_CONTENTS[i * part_size : (i + 1) * part_size])
+    state = {
+        "url": url,
+        "size": len(FILE_CONTENTS),
+        "part_size": part_size,
+        "completed": [0, 2],
+    }
+    with open(tmp_path / "file.bin.part.json", "w") as f:
+        json.dump(state, f)
+
+    value = utils.download_requests(
+        url, str(tmp_path), "file.bin", num_connections=2, part_size=part_size
+    )
+    assert value == hashlib.sha256(FILE_CONTENTS).hexdigest()
+    assert (tmp_path / "file.bin").read_bytes() == FILE_CONTENTS
+    assert len(RangeRequestHandler.ranges_served) == 13
+    assert (0, part_size - 1) not in RangeRequestHandler.ranges_served
+
+
+def make_archive():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo("dataset/1.0.0/data.tfrecord")
+        info.size = len(FILE_CONTENTS)
+        tar.addfile(info, io.BytesIO(FILE_CONTENTS))
+    return buffer.getvalue()
+
+
+def serve_archive(tmp_path, serve, monkeypatch, archive, sha256):
+    class ArchiveRequestHandler(RangeRequestHandler):
+        contents = archive
+
+    url = serve(ArchiveRequestHandler)
+    checksums_dir = tmp_path / "checksums"
+    checksums_dir.mkdir()
+    with open(checksums_dir / "dataset.txt", "w") as f:
+        f.write(f"armory-public-data dataset.tar.gz {len(archive)} {sha256}\n")
+    monkeypatch.setattr(utils, "CHECKSUMS_DIRS", [str(checksums_dir)])
+
+    download_requests = utils.download_requests
+
+    def download_local(s3_url, *args, **kwargs):
+        return download_requests(url, *args, part_size=1000, **kwargs)
+
+    monkeypatch.setattr(utils, "download_requests", download_local)
+
+
+def test_download_verify_dataset_cache(tmp_path, serve, monkeypatch):
+    archive = make_archive()
+    sha256 = hashlib.sha256(archive).hexdigest()
+    serve_archive(tmp_path, serve, monkeypatch, archive, sha256)
+
+    dataset_dir = tmp_path / "datasets"
+    utils.download_verify_dataset_cache(str(dataset_dir), "dataset.txt", "dataset")
+    extracted = dataset_dir / "dataset" / "1.0.0" / "data.tfrecord"
+    assert extracted.read_bytes() == FILE_CONTENTS
+    assert (dataset_dir / "cache" / "dataset.tar.gz").read_bytes() == archive
+    assert os.listdir(dataset_dir / "cache") == ["dataset.tar.gz"]
+
+
+def test_download_verify_dataset_cache_hash_mismatch(tmp_path, serve, monkeypatch):
+    archive = make_archive()
+    serve_archive(tmp_path, serve, monkeypatch, archive, "0" * 64)
+
+    # Nothing is extracted from an archive that fails verification
+    dataset_dir = tmp_path / "datasets"
+    utils.download_verify_dataset_cache(str(dataset_dir), "dataset.txt", "dataset")
+    assert os.listdir(dataset_dir) == ["cache"]
+    assert os.listdir(dataset_dir / "cache") == []